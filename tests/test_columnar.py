@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+import json
+import zstandard as zstd
+
+from tweeter import cli
+from tweeter import columnar
+from tweeter import ingest
+from tweeter import model
+from tweeter import report
+
+def add_tweets(db, ids, *, now):
+    rows = []
+    for id in ids:
+        created_at = now - timedelta(hours=id)
+        db.add(model.Tweet(
+            id=id,
+            created_at=created_at,
+            text=f'tweet {id}',
+            source='test',
+            user_id=1,
+            user_created_at=created_at,
+            updated_at=created_at,
+        ))
+        rows.append(dict(
+            {name: None for name in columnar.SCHEMA.names},
+            id=id,
+            created_at=created_at,
+            user_id=1,
+            text=f'tweet {id}',
+        ))
+    db.flush()
+    return rows
+
+def mirrored_ids(path):
+    return sorted(columnar.open_dataset(path).to_table()['id'].to_pylist())
+
+def pending_files(path):
+    return [
+        name
+        for _, name, _, pending in columnar.iter_parts(path)
+        if pending
+    ]
+
+def test_catch_up(tmp_path):
+    db_path = str(tmp_path / 'test.db')
+    path = model.mirror_path_for(db_path)
+    db = model.connect(db_path)
+    now = datetime(2019, 4, 1)
+    add_tweets(db, range(1, 51), now=now)
+    db.commit()
+    columnar.build(db, path)
+    assert mirrored_ids(path) == list(range(1, 51))
+
+    # the database committed but the files were never made visible
+    mirror = columnar.MirrorWriter(path)
+    mirror.add(add_tweets(db, range(51, 61), now=now))
+    mirror.prepare(db)
+    db.commit()
+    assert pending_files(path)
+
+    # the files were written but the database rolled back
+    mirror = columnar.MirrorWriter(path)
+    mirror.add(add_tweets(db, range(61, 71), now=now))
+    mirror.prepare(db)
+    db.rollback()
+
+    # added without the mirror at all
+    add_tweets(db, range(71, 81), now=now)
+    db.commit()
+
+    assert columnar.MirrorWriter(path).catch_up(db) == 10
+    assert not pending_files(path)
+    assert mirrored_ids(path) == list(range(1, 61)) + list(range(71, 81))
+    assert columnar.MirrorWriter(path).catch_up(db) == 0
+
+def twitter_time(value):
+    return value.strftime('%a %b %d %H:%M:%S +0000 %Y')
+
+def make_status(id, created_at, text, hashtags):
+    return dict(
+        id=id,
+        created_at=twitter_time(created_at),
+        text=text,
+        entities=dict(hashtags=[dict(text=tag) for tag in hashtags]),
+        source='test',
+        lang='en',
+        user=dict(
+            id=1,
+            screen_name='user',
+            description=None,
+            verified=False,
+            followers_count=0,
+            friends_count=0,
+            listed_count=0,
+            statuses_count=0,
+            favourites_count=0,
+            created_at=twitter_time(created_at),
+        ),
+        in_reply_to_status_id=None,
+        in_reply_to_user_id=None,
+    )
+
+def write_archive(path, statuses):
+    data = ''.join(json.dumps(status) + '\n' for status in statuses)
+    with open(path, 'wb') as fp:
+        fp.write(zstd.ZstdCompressor().compress(data.encode('utf8')))
+
+def test_hashtags_match_like_the_database(tmp_path):
+    now = datetime(2019, 4, 1)
+    statuses = []
+    for i in range(40):
+        # only the entities make a hashtag, not text that looks like one
+        text, hashtags = [
+            ('#saam today', ['saam']),
+            ('see https://example.com/#saam', []),
+            ('#SAAMfoo', ['SAAMfoo']),
+            ('truncated...', ['Saam']),
+        ][i % 4]
+        statuses.append(make_status(
+            i + 1, now + timedelta(minutes=7 * i), text, hashtags))
+    first = str(tmp_path / 'first.zstd')
+    second = str(tmp_path / 'second.zstd')
+    write_archive(first, statuses[:20])
+    write_archive(second, statuses[20:])
+
+    app = cli.App(str(tmp_path / 'profile.yml'))
+    db_path = str(tmp_path / 'test.db')
+    path = model.mirror_path_for(db_path)
+    db = model.connect(db_path)
+    ingest.ingest_files(app, db, [first])
+    columnar.build(db, path)
+    # the rest through the mirror writer of ingest
+    ingest.ingest_files(app, db, [second], mirror_path=path)
+    report.add_plot_terms(db, ['#saam'])
+
+    def totals(rows):
+        return report.sum_buckets(rows, bucket_size='hour')
+
+    expected = totals(report.hourly_counts(db, '#saam'))
+    assert sum(expected.values()) == 20
+    assert totals(report.cached_hourly_counts(db, '#saam')) == expected
+    assert totals(columnar.hourly_counts(path, '#saam')) == expected
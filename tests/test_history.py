@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+import numpy as np
+
+from tweeter import history
+from tweeter import model
+
+START = datetime(2019, 4, 1)
+
+def add_stats(db, counts_by_id):
+    rows = []
+    for tweet_id, counts in counts_by_id.items():
+        for hour, count in enumerate(counts):
+            rows.append(dict(
+                tweet_id=tweet_id,
+                observed_at=START + timedelta(hours=hour),
+                favorite_count=count,
+                retweet_count=2 * count,
+                reply_count=0,
+                # not known for the first version
+                quote_count=None if hour == 0 else 1,
+            ))
+    db.connection().execute(model.TweetStats.__table__.insert(), rows)
+    db.commit()
+
+def hours(*values):
+    return np.array(
+        [START + timedelta(hours=h) for h in values], dtype='datetime64[us]')
+
+def test_series_from_rows():
+    assert history.series_from_rows([]) == []
+    t0, t1 = START, START + timedelta(hours=1)
+    series = history.series_from_rows([
+        (1, str(t0), 1, 2, 3, None),
+        (1, str(t1), 4, 5, 6, 7),
+        (2, str(t0), 8, 9, 10, 11),
+    ])
+    assert [s.tweet_id for s in series] == [1, 2]
+    np.testing.assert_array_equal(series[0].observed_at, hours(0, 1))
+    np.testing.assert_array_equal(series[0].favorite_count, [1, 4])
+    np.testing.assert_array_equal(
+        series[0].quote_count, [history.MISSING_COUNT, 7])
+    assert series[0].retweet_count.dtype == np.int64
+    np.testing.assert_array_equal(series[1].reply_count, [10])
+
+def test_load_series(tmp_path):
+    db = model.connect(str(tmp_path / 'test.db'))
+    add_stats(db, {1: [1, 2, 3], 2: [5], 3: [7, 8]})
+
+    series = history.load_series(db, [3, 1, 4])
+    assert sorted(series) == [1, 3]
+    np.testing.assert_array_equal(series[1].observed_at, hours(0, 1, 2))
+    np.testing.assert_array_equal(series[1].retweet_count, [2, 4, 6])
+    np.testing.assert_array_equal(
+        series[1].quote_count, [history.MISSING_COUNT, 1, 1])
+
+    series = history.load_series(
+        db, [1, 3],
+        since=START + timedelta(hours=1),
+        until=START + timedelta(hours=1),
+    )
+    np.testing.assert_array_equal(series[1].favorite_count, [2])
+    np.testing.assert_array_equal(series[3].favorite_count, [8])
+
+def test_iter_series(tmp_path):
+    db = model.connect(str(tmp_path / 'test.db'))
+    counts_by_id = {id: list(range(id % 5 + 1)) for id in range(1, 30)}
+    add_stats(db, counts_by_id)
+
+    # partitions smaller than the history of some tweets
+    series = list(history.iter_series(db, chunk_size=3))
+    assert [s.tweet_id for s in series] == list(range(1, 30))
+    for s in series:
+        np.testing.assert_array_equal(
+            s.favorite_count, counts_by_id[s.tweet_id])
+
+    series = list(history.iter_series(db, min_id=25, chunk_size=4))
+    assert [s.tweet_id for s in series] == list(range(25, 30))
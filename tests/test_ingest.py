@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+import json
+import sqlalchemy as sa
+import zstandard as zstd
+
+from tweeter import cli
+from tweeter import ingest
+from tweeter import model
+
+START = datetime(2019, 4, 1)
+
+def twitter_time(value):
+    return value.strftime('%a %b %d %H:%M:%S +0000 %Y')
+
+def make_status(id, created_at, **kw):
+    return dict(
+        id=id,
+        created_at=twitter_time(created_at),
+        text=f'tweet {id}',
+        source='test',
+        lang='en',
+        user=dict(
+            id=1,
+            screen_name='user',
+            description=None,
+            verified=False,
+            followers_count=0,
+            friends_count=0,
+            listed_count=0,
+            statuses_count=0,
+            favourites_count=0,
+            created_at=twitter_time(START),
+        ),
+        in_reply_to_status_id=None,
+        in_reply_to_user_id=None,
+        **kw,
+    )
+
+def write_archive(path, retweet_counts):
+    # tweet 1 as seen in a retweet every hour, hours without a count are
+    # skipped
+    original = make_status(1, START)
+    lines = []
+    for hour, count in retweet_counts:
+        rt = make_status(
+            100 + hour,
+            START + timedelta(hours=hour),
+            retweeted_status=dict(original, retweet_count=count),
+        )
+        lines.append(json.dumps(rt))
+    with open(path, 'wb') as fp:
+        fp.write(zstd.ZstdCompressor().compress(
+            ''.join(line + '\n' for line in lines).encode('utf8')))
+
+def load_history(db):
+    table = model.TweetStats.__table__
+    q = (
+        sa.select([table.c.observed_at, table.c.retweet_count])
+        .where(table.c.tweet_id == 1)
+        .order_by(table.c.observed_at)
+    )
+    return [
+        (row.observed_at - START, row.retweet_count)
+        for row in db.connection().execute(q)
+    ]
+
+def ingest_paths(tmp_path, paths):
+    app = cli.App(str(tmp_path / 'profile.yml'))
+    db = model.connect(str(tmp_path / f'{len(paths)}-{paths[0].name}.db'))
+    for path in paths:
+        ingest.ingest_files(app, db, [str(path)])
+    return load_history(db)
+
+def test_ingest_out_of_order(tmp_path):
+    first = tmp_path / 'first.zstd'
+    second = tmp_path / 'second.zstd'
+    write_archive(first, [(1, 5), (2, 5), (3, 7)])
+    write_archive(second, [(4, 7), (5, 9), (6, 9)])
+
+    expected = [
+        (timedelta(hours=1), 5),
+        (timedelta(hours=3), 7),
+        (timedelta(hours=5), 9),
+    ]
+    assert ingest_paths(tmp_path, [first, second]) == expected
+    assert ingest_paths(tmp_path, [second, first]) == expected
@@ -0,0 +1,60 @@
+import contextlib
+import hashlib
+import os
+import types
+
+from tweeter import media
+
+class FakeSession:
+    def __init__(self, bodies, headers=None):
+        self.bodies = bodies
+        self.headers = headers or {}
+
+    @contextlib.contextmanager
+    def get(self, url, stream=False, timeout=None):
+        body = self.bodies[url]
+        yield types.SimpleNamespace(
+            status_code=200,
+            headers=dict(
+                {'Content-Type': 'image/jpeg'}, **self.headers.get(url, {})),
+            raise_for_status=lambda: None,
+            iter_content=lambda size: [body],
+        )
+
+def test_local_errors_are_recorded(tmp_path):
+    root = str(tmp_path)
+    os.makedirs(os.path.join(root, '.tmp'))
+    bodies = {
+        'https://pbs.twimg.com/media/bad.jpg': b'bad',
+        'https://pbs.twimg.com/media/good.jpg': b'good',
+    }
+    # a file in place of the directory the bad url is stored in
+    bad_dir = hashlib.sha256(b'bad').hexdigest()[:2]
+    with open(os.path.join(root, bad_dir), 'wb'):
+        pass
+    downloader = media.Downloader(root=root, session=FakeSession(bodies))
+
+    row = downloader.download('https://pbs.twimg.com/media/bad.jpg', 1)
+    assert row['status'] == 'failed'
+    assert row['media_id'] == 1
+    assert row['error']
+    assert row['attempts'] == 1
+    assert os.listdir(os.path.join(root, '.tmp')) == []
+
+    row = downloader.download('https://pbs.twimg.com/media/good.jpg', 2)
+    assert row['status'] == 'ok'
+    assert os.path.exists(os.path.join(root, row['path']))
+
+def test_malformed_responses_are_recorded(tmp_path):
+    root = str(tmp_path)
+    os.makedirs(os.path.join(root, '.tmp'))
+    url = 'https://pbs.twimg.com/media/bad.jpg'
+    session = FakeSession(
+        {url: b'bad'}, headers={url: {'Content-Length': 'three'}})
+    downloader = media.Downloader(root=root, session=session)
+
+    row = downloader.download(url, 1)
+    assert row['status'] == 'failed'
+    assert 'ValueError' in row['error']
+    assert row['attempts'] == 1
+    assert os.listdir(os.path.join(root, '.tmp')) == []
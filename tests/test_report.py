@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+from tweeter import model
+from tweeter import report
+
+START = datetime(2019, 4, 1)
+
+def add_tweets(db, minutes):
+    for i, minute in enumerate(minutes):
+        created_at = START + timedelta(minutes=minute)
+        db.add(model.Tweet(
+            id=i + 1,
+            created_at=created_at,
+            text='the mueller report' if i % 3 else 'something else',
+            source='test',
+            user_id=1,
+            user_created_at=created_at,
+            updated_at=created_at,
+            rt_tweet_id=i if i % 2 else None,
+        ))
+    db.commit()
+
+def test_cached_counts_match_uncached(tmp_path):
+    db = model.connect(str(tmp_path / 'test.db'))
+    add_tweets(db, range(0, 6 * 60, 7))
+    term = model.normalize_term('mueller report')
+    report.add_plot_terms(db, [term])
+
+    def at(hours, minutes=0):
+        return START + timedelta(hours=hours, minutes=minutes)
+
+    ranges = [
+        (None, None),
+        (at(1), at(3)),
+        (at(0, 30), None),
+        (None, at(4, 20)),
+        (at(0, 30), at(4, 20)),
+        (at(2, 10), at(2, 50)),
+        (at(2, 10), at(3, 10)),
+        (at(2, 7), at(2, 7)),
+    ]
+    for since, until in ranges:
+        uncached = report.hourly_counts(db, term, since=since, until=until)
+        cached = report.cached_hourly_counts(
+            db, term, since=since, until=until)
+        for kw in (dict(include_retweets=True), dict()):
+            assert (
+                report.sum_buckets(cached, bucket_size='hour', **kw)
+                == report.sum_buckets(uncached, bucket_size='hour', **kw)
+            ), (since, until)
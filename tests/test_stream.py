@@ -0,0 +1,55 @@
+from datetime import datetime
+import os
+
+from tweeter import follow
+from tweeter import stream
+from tweeter import zstd
+
+def test_rotations_within_a_second_sort_in_order(tmp_path):
+    prefix = str(tmp_path / 'potus-stream')
+    now = datetime(2019, 4, 1, 0, 12, 0)
+    paths = []
+    for n in range(12):
+        s = stream.Stream.open(prefix, now=now)
+        s.write_line(
+            b'{"created_at":"Mon Apr 01 00:12:00 +0000 2019","id":%d}' % n)
+        s.close()
+        paths.append(s.path)
+
+    assert len(set(paths)) == 12
+    assert sorted(paths) == paths
+    assert follow.find_stream_files(prefix) == paths
+
+def test_rotations_across_seconds_sort_in_order(tmp_path):
+    prefix = str(tmp_path / 'potus-stream')
+    paths = []
+    for second in (59, 59, 0):
+        minute = 12 if second == 59 else 13
+        s = stream.Stream.open(
+            prefix, now=datetime(2019, 4, 1, 0, minute, second))
+        s.close()
+        paths.append(s.path)
+    assert follow.find_stream_files(prefix) == paths
+
+def test_recover_crash_between_renames(tmp_path):
+    prefix = str(tmp_path / 'potus-stream')
+    s = stream.Stream.open(prefix, frame_lines=10)
+    lines = [
+        b'{"created_at":"Mon Apr 01 00:12:00 +0000 2019","id":%d}' % n
+        for n in range(100)
+    ]
+    for line in lines:
+        s.write_line(line)
+    s.writer.close()
+    stream.sync_and_close(s.fp)
+    stream.sync_and_close(s.index_fp)
+    # the index was finalized but not the data
+    index_path = zstd.index_path_for(s.path)
+    os.rename(index_path + stream.TMP_SUFFIX, index_path)
+    size = os.path.getsize(s.path + stream.TMP_SUFFIX)
+
+    stream.recover_orphans(prefix)
+    assert os.path.getsize(s.path) == size
+    assert len(zstd.read_index(s.path)) == 10
+    with open(s.path, 'rb') as fp:
+        assert list(zstd.iter_lines(fp)) == lines
@@ -0,0 +1,126 @@
+import csv
+from datetime import datetime
+import json
+import pyarrow.parquet as pq
+import pytest
+import zstandard as zstd
+
+import tweets_to_csv
+
+def make_status(id, **kw):
+    return dict(
+        id=id,
+        created_at='Mon Apr 01 00:12:00 +0000 2019',
+        text=f'tweet {id}',
+        user=dict(id=1, name='User', screen_name='user'),
+        entities=dict(hashtags=[dict(text='saam')]),
+        **kw,
+    )
+
+def write_archive(path, statuses):
+    # one frame per ten lines, such that files are split into several units
+    cctx = zstd.ZstdCompressor()
+    with open(path, 'wb') as fp:
+        for start in range(0, len(statuses), 10):
+            data = ''.join(
+                json.dumps(status) + '\n'
+                for status in statuses[start:start + 10]
+            )
+            fp.write(cctx.compress(data.encode('utf8')))
+
+def test_parse_column():
+    column = tweets_to_csv.Column.parse('full_text')
+    assert column.type == 'str'
+    assert column.paths == ('extended_tweet.full_text', 'text')
+
+    column = tweets_to_csv.Column.parse('tag=entities.hashtags.0.text')
+    assert (column.name, column.type) == ('tag', 'str')
+    assert column.paths == ('entities.hashtags.0.text',)
+
+    column = tweets_to_csv.Column.parse('rt=retweeted_status.id:int')
+    assert (column.name, column.type) == ('rt', 'int')
+    assert column.paths == ('retweeted_status.id',)
+
+    with pytest.raises(ValueError):
+        tweets_to_csv.Column.parse('nope')
+    with pytest.raises(ValueError):
+        tweets_to_csv.Column.parse('rt=retweeted_status.id:long')
+
+def test_projection():
+    columns = [
+        tweets_to_csv.Column.parse(spec)
+        for spec in (
+            'id',
+            'full_text',
+            'user_screen_name',
+            'tag=entities.hashtags.0.text',
+            'missing=entities.urls.0.url',
+            'user=user:json',
+        )
+    ]
+    project = tweets_to_csv.make_projection(columns)
+    status = make_status(1)
+    assert project(status) == (
+        1, 'tweet 1', 'user', 'saam', None, status['user'])
+
+    # the first path with a value wins
+    status = make_status(2, extended_tweet=dict(full_text='the full text'))
+    assert project(status)[1] == 'the full text'
+
+def test_arrow_value():
+    assert tweets_to_csv.arrow_value('12', 'int') == 12
+    assert tweets_to_csv.arrow_value('x', 'int') is None
+    assert tweets_to_csv.arrow_value(None, 'str') is None
+    assert tweets_to_csv.arrow_value(1, 'bool') is True
+    assert tweets_to_csv.arrow_value('1.5', 'float') == 1.5
+    assert tweets_to_csv.arrow_value(
+        'Mon Apr 01 00:12:00 +0000 2019', 'datetime',
+    ) == datetime(2019, 4, 1, 0, 12)
+    assert tweets_to_csv.arrow_value({'a': 1}, 'str') == '{"a": 1}'
+    assert tweets_to_csv.arrow_value(5, 'json') == '5'
+    assert tweets_to_csv.csv_value({'a': 1}, 'str') == '{"a": 1}'
+    assert tweets_to_csv.csv_value(5, 'int') == 5
+
+@pytest.mark.parametrize('format', ['csv', 'parquet'])
+def test_convert_files_in_order(tmp_path, format):
+    paths = []
+    for n in range(3):
+        path = str(tmp_path / f'input-{n}.zstd')
+        write_archive(path, [
+            make_status(1000 * n + i) for i in range(45)
+        ])
+        paths.append(path)
+    # with a malformed line, which is skipped
+    with open(paths[1], 'ab') as fp:
+        fp.write(zstd.ZstdCompressor().compress(b'{"id": \n'))
+
+    columns = [
+        tweets_to_csv.Column.parse(spec)
+        for spec in ('id', 'tag=entities.hashtags.0.text')
+    ]
+    output_path = str(tmp_path / f'output.{format}')
+    num_rows = tweets_to_csv.convert_files(
+        paths,
+        output_path,
+        columns=columns,
+        format=format,
+        jobs=2,
+        chunk_size=7,
+        unit_lines=10,
+    )
+    expected = [1000 * n + i for n in range(3) for i in range(45)]
+    assert num_rows == len(expected)
+
+    if format == 'csv':
+        with open(output_path, 'r', encoding='utf8', newline='') as fp:
+            rows = list(csv.reader(fp))
+        assert rows[0] == ['id', 'tag']
+        assert [int(row[0]) for row in rows[1:]] == expected
+        assert {row[1] for row in rows[1:]} == {'saam'}
+    else:
+        table = pq.read_table(output_path)
+        assert table.column_names == ['id', 'tag']
+        assert table['id'].to_pylist() == expected
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'input-0.zstd', 'input-1.zstd', 'input-2.zstd', f'output.{format}',
+    ]
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+import types
+
+from tweeter import model
+from tweeter import updater
+
+def add_tweets(db, ids, *, now):
+    for id in ids:
+        created_at = now - timedelta(hours=id)
+        db.add(model.Tweet(
+            id=id,
+            created_at=created_at,
+            text=f'tweet {id}',
+            source='test',
+            user_id=1,
+            user_followers_count=10 * id,
+            user_created_at=created_at,
+            updated_at=created_at,
+            retweet_count=id,
+            favorite_count=id,
+        ))
+    db.commit()
+
+class EvenOnlyApi:
+    # every odd tweet was deleted
+    def __init__(self):
+        self.calls = 0
+
+    def lookup_statuses(self, ids, trim_user=False):
+        self.calls += 1
+        assert self.calls < 100, 'the update never ends'
+        return [
+            types.SimpleNamespace(_json=dict(
+                id=id, retweet_count=2 * id, favorite_count=2 * id))
+            for id in ids
+            if id % 2 == 0
+        ]
+
+def test_retry_unavailable_ends(tmp_path):
+    db = model.connect(str(tmp_path / 'test.db'))
+    now = datetime.utcnow()
+    add_tweets(db, range(1, 251), now=now)
+    api = EvenOnlyApi()
+
+    updated, unavailable = updater.update_stale_tweets(
+        db, api, min_age=timedelta(minutes=30), jobs=1)
+    assert (updated, unavailable) == (125, 125)
+
+    # the unavailable tweets are looked up again once, then backed off
+    updated, unavailable = updater.update_stale_tweets(
+        db, api, min_age=timedelta(minutes=30), jobs=1,
+        retry_unavailable=True)
+    assert (updated, unavailable) == (0, 0)
+
+    refresh = model.TweetRefresh.__table__
+    db.execute(refresh.update().values(next_refresh_at=now))
+    db.commit()
+    updated, unavailable = updater.update_stale_tweets(
+        db, api, min_age=timedelta(minutes=30), jobs=1,
+        retry_unavailable=True)
+    assert (updated, unavailable) == (125, 125)
+
+def test_priority_ranks_in_sql(tmp_path):
+    db = model.connect(str(tmp_path / 'test.db'))
+    now = datetime.utcnow()
+    add_tweets(db, range(1, 11), now=now)
+
+    rows = updater.select_due_tweets(
+        db, now=now, limit=3, max_ts=now - timedelta(minutes=30))
+    assert len(rows) == 3
+    priorities = [row.priority for row in rows]
+    assert priorities == sorted(priorities, reverse=True)
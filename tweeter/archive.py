@@ -0,0 +1,647 @@
+import attr
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+import glob
+import heapq
+import io
+import json
+from operator import itemgetter
+import os
+import re
+import shutil
+import tempfile
+import time
+import typing
+
+from . import model
+from . import stream
+from .util import imap_ordered
+from . import zstd
+
+log = __import__('logging').getLogger(__name__)
+
+# characters twitter escapes or encodes in the raw json of a status, a term
+# containing any of them may not appear verbatim in the line
+UNSAFE_NEEDLE_CHARS = frozenset('"\\/&<>')
+
+def needle_for(value):
+    """
+    Return the lowercased bytes that must appear in the raw line of a
+    status containing ``value``, or ``None`` if there are none.
+
+    """
+    if not value or not value.isascii():
+        return None
+    if UNSAFE_NEEDLE_CHARS.intersection(value):
+        return None
+    return value.lower().encode('ascii')
+
+def status_text(obj):
+    extended = obj.get('extended_tweet')
+    if extended is not None:
+        return extended.get('full_text') or obj.get('text') or ''
+    return obj.get('full_text') or obj.get('text') or ''
+
+@attr.s(frozen=True, auto_attribs=True)
+class Query:
+    """
+    Predicates on the statuses in an archive.
+
+    A status matches if it contains any of the ``terms``, like
+    :func:`tweeter.model.term_pattern`, was written by any of the ``users``,
+    by screen name or id, is in any of the ``langs`` and has an id within
+    ``min_id`` and ``max_id``. ``retweets`` and ``replies`` are each one
+    of ``include``, ``exclude`` or ``only``. Empty predicates match
+    everything.
+
+    """
+    terms: tuple = ()
+    users: tuple = ()
+    langs: tuple = ()
+    min_id: typing.Optional[int] = None
+    max_id: typing.Optional[int] = None
+    retweets: str = 'include'
+    replies: str = 'include'
+
+@attr.s(auto_attribs=True)
+class CompiledQuery:
+    # groups of needles, a line must contain one needle of every group
+    needle_groups: list
+    term_re: typing.Any
+    screen_names: frozenset
+    user_ids: frozenset
+    langs: frozenset
+    min_id: typing.Optional[int]
+    max_id: typing.Optional[int]
+    retweets: str
+    replies: str
+
+    @classmethod
+    def from_query(cls, query):
+        needle_groups = []
+        screen_names = frozenset(
+            u.lower().lstrip('@') for u in query.users if not u.isdigit())
+        user_ids = frozenset(int(u) for u in query.users if u.isdigit())
+        for values in (
+            query.terms,
+            [*screen_names, *(str(id) for id in user_ids)],
+        ):
+            needles = [needle_for(value) for value in values]
+            # a value without a needle could match any line
+            if needles and None not in needles:
+                needle_groups.append(tuple(needles))
+        if query.langs:
+            needle_groups.append(tuple(
+                b'"' + lang.lower().encode('ascii') + b'"'
+                for lang in query.langs
+            ))
+        if query.retweets == 'only':
+            needle_groups.append((b'"retweeted_status"',))
+
+        term_re = None
+        if query.terms:
+            term_re = re.compile(
+                '|'.join(model.term_pattern(t) for t in query.terms),
+                re.IGNORECASE,
+            )
+        return cls(
+            needle_groups=needle_groups,
+            term_re=term_re,
+            screen_names=screen_names,
+            user_ids=user_ids,
+            langs=frozenset(lang.lower() for lang in query.langs),
+            min_id=query.min_id,
+            max_id=query.max_id,
+            retweets=query.retweets,
+            replies=query.replies,
+        )
+
+    def prefilter(self, line):
+        """
+        Check the raw bytes of a line before parsing it, returning ``False``
+        only if it cannot match.
+
+        """
+        if self.min_id is not None or self.max_id is not None:
+            m = zstd.STATUS_ID_RE.match(line)
+            if m is not None:
+                id = int(m.group(1))
+                if self.min_id is not None and id < self.min_id:
+                    return False
+                if self.max_id is not None and id > self.max_id:
+                    return False
+        if self.needle_groups:
+            line = line.lower()
+            for needles in self.needle_groups:
+                if not any(needle in line for needle in needles):
+                    return False
+        return True
+
+    def matches(self, obj):
+        if not isinstance(obj, dict) or 'created_at' not in obj:
+            # delete and limit notices
+            return False
+        id = obj.get('id')
+        if self.min_id is not None and (id is None or id < self.min_id):
+            return False
+        if self.max_id is not None and (id is None or id > self.max_id):
+            return False
+        if self.retweets != 'include':
+            is_retweet = obj.get('retweeted_status') is not None
+            if is_retweet != (self.retweets == 'only'):
+                return False
+        if self.replies != 'include':
+            is_reply = obj.get('in_reply_to_status_id') is not None
+            if is_reply != (self.replies == 'only'):
+                return False
+        if self.langs and (obj.get('lang') or '').lower() not in self.langs:
+            return False
+        if self.screen_names or self.user_ids:
+            user = obj.get('user') or {}
+            if not (
+                (user.get('screen_name') or '').lower() in self.screen_names
+                or user.get('id') in self.user_ids
+            ):
+                return False
+        if self.term_re is not None:
+            if self.term_re.search(status_text(obj)) is None:
+                return False
+        return True
+
+@attr.s(slots=True, auto_attribs=True)
+class ScanResult:
+    lines: int = 0
+    prefiltered: int = 0
+    matched: int = 0
+    errors: int = 0
+    # the compressed matches and their frames, if they were kept
+    part_path: str = None
+    frames: list = None
+
+    def add(self, other):
+        self.lines += other.lines
+        self.prefiltered += other.prefiltered
+        self.matched += other.matched
+        self.errors += other.errors
+
+def scan_unit(unit, query, *, part_path=None, level=10):
+    """
+    Scan a :class:`tweeter.zstd.Unit` for the statuses matching ``query``,
+    writing them as an archive to ``part_path`` if given.
+
+    """
+    compiled = CompiledQuery.from_query(query)
+    prefilter, matches = compiled.prefilter, compiled.matches
+    result = ScanResult(part_path=part_path)
+    with ExitStack() as stack:
+        writer = None
+        if part_path is not None:
+            fp = stack.enter_context(open(part_path, 'wb'))
+            index_fp = io.StringIO()
+            writer = zstd.FrameWriter(fp, index_fp=index_fp, level=level)
+        for line in unit.iter_lines():
+            result.lines += 1
+            if not prefilter(line):
+                continue
+            result.prefiltered += 1
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                result.errors += 1
+                continue
+            if matches(obj):
+                result.matched += 1
+                if writer is not None:
+                    writer.write_line(line)
+        if writer is not None:
+            writer.close()
+            result.frames = [
+                zstd.Frame.from_json(json.loads(line))
+                for line in index_fp.getvalue().splitlines()
+            ]
+    return result
+
+def scan_part(item):
+    unit, query, tmp_dir, idx, level = item
+    part_path = None
+    if tmp_dir is not None:
+        part_path = os.path.join(tmp_dir, f'part-{idx:06d}.zstd')
+    return scan_unit(unit, query, part_path=part_path, level=level)
+
+def grep_files(
+    paths,
+    query,
+    *,
+    out_fp=None,
+    index_fp=None,
+    jobs=1,
+    level=10,
+    dict_paths=(),
+    tmp_dir=None,
+):
+    """
+    Scan the archives in ``paths`` for the statuses matching ``query``.
+
+    The archives are split into units, by frame if they are indexed, which
+    are scanned by ``jobs`` worker processes. Matches are compressed by the
+    workers into temporary parts and copied to ``out_fp``, in the order of
+    the input, along with their frames to ``index_fp``. Without an
+    ``out_fp`` they are only counted.
+
+    Returns a :class:`ScanResult` with the totals.
+
+    """
+    total = ScanResult()
+    with ExitStack() as stack:
+        part_dir = None
+        if out_fp is not None:
+            part_dir = stack.enter_context(
+                tempfile.TemporaryDirectory(prefix='.grep-', dir=tmp_dir))
+        items = (
+            (unit, query, part_dir, idx, level)
+            for idx, unit in enumerate(zstd.iter_units(
+                paths,
+                min_id=query.min_id,
+                max_id=query.max_id,
+                dict_paths=dict_paths,
+            ))
+        )
+        if jobs > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(max_workers=jobs))
+            results = imap_ordered(
+                executor, scan_part, items, max_pending=2 * jobs)
+        else:
+            results = map(scan_part, items)
+
+        offset = 0
+        for result in results:
+            total.add(result)
+            if result.part_path is None:
+                continue
+            # zstd frames can be concatenated as is
+            with open(result.part_path, 'rb') as part_fp:
+                shutil.copyfileobj(part_fp, out_fp, 1 << 20)
+            os.unlink(result.part_path)
+            # the frames of the part start at zero
+            for frame in result.frames:
+                if index_fp is not None:
+                    frame.offset += offset
+                    index_fp.write(json.dumps(frame.to_json()) + '\n')
+            offset += sum(frame.size for frame in result.frames)
+    return total
+
+def main_grep(cli, args):
+    min_id, max_id = None, None
+    if args.since is not None:
+        min_id = zstd.datetime_to_snowflake(args.since)
+    if args.until is not None:
+        max_id = zstd.datetime_to_snowflake(args.until) - 1
+    query = Query(
+        terms=tuple(args.term or ()),
+        users=tuple(args.user or ()),
+        langs=tuple(args.lang or ()),
+        min_id=min_id,
+        max_id=max_id,
+        retweets=args.retweets,
+        replies=args.replies,
+    )
+
+    start = time.perf_counter()
+    with ExitStack() as stack:
+        out_fp = index_fp = None
+        tmp_dir = None
+        if not args.count:
+            out_fp = stack.enter_context(
+                cli.output_file(args.output_file, text=False))
+            if args.output_file != '-':
+                tmp_dir = os.path.dirname(args.output_file) or '.'
+                index_fp = stack.enter_context(open(
+                    zstd.index_path_for(args.output_file),
+                    'w',
+                    encoding='utf8',
+                ))
+        total = grep_files(
+            args.input_files,
+            query,
+            out_fp=out_fp,
+            index_fp=index_fp,
+            jobs=args.jobs,
+            level=args.level,
+            dict_paths=tuple(args.dict or ()),
+            tmp_dir=tmp_dir,
+        )
+    elapsed = time.perf_counter() - start
+
+    log.info(
+        f'scanned {total.lines} lines in {elapsed:.2f}s, '
+        f'{total.prefiltered} passed the prefilter, {total.matched} matched'
+    )
+    if total.errors:
+        log.warning(f'skipped {total.errors} lines that could not be parsed')
+    if args.count:
+        cli.out(str(total.matched))
+
+# sorted runs are temporary and read back once, so they are compressed for
+# speed rather than size
+RUN_LEVEL = 1
+
+# the most runs merged at once, more are first merged in several passes
+MAX_FAN_IN = 64
+
+# the memory used by a buffered line beyond its bytes, roughly the tuple,
+# int and bytes objects holding it
+LINE_OVERHEAD = 128
+
+@attr.s(slots=True, auto_attribs=True)
+class CompactResult:
+    lines: int = 0
+    # delete and limit notices and lines that could not be parsed
+    skipped: int = 0
+    duplicates: int = 0
+    written: int = 0
+    run_paths: list = attr.Factory(list)
+
+    def add(self, other):
+        self.lines += other.lines
+        self.skipped += other.skipped
+        self.duplicates += other.duplicates
+        self.written += other.written
+
+def write_run(path, items):
+    """
+    Write ``(id, line)`` pairs, sorted by id, to a temporary run at
+    ``path``, keeping only the first of each id.
+
+    Returns the number of duplicates left out.
+
+    """
+    duplicates = 0
+    prev_id = None
+    with open(path, 'wb') as fp, zstd.writer(fp, level=RUN_LEVEL) as out:
+        buffer = []
+        for id, line in items:
+            if id == prev_id:
+                duplicates += 1
+                continue
+            prev_id = id
+            buffer.append(b'%d\t%s\n' % (id, line))
+            if len(buffer) >= 10000:
+                out.write(b''.join(buffer))
+                buffer = []
+        out.write(b''.join(buffer))
+    return duplicates
+
+def iter_run(path):
+    with open(path, 'rb') as fp:
+        for lines in zstd.iter_line_batches(fp):
+            for line in lines:
+                id, line = line.split(b'\t', 1)
+                yield int(id), line
+
+def merge_runs(run_paths):
+    """
+    Yield the ``(id, line)`` pairs of sorted runs in order of id.
+
+    Pairs with equal ids are yielded in the order of ``run_paths``.
+
+    """
+    return heapq.merge(
+        *(iter_run(path) for path in run_paths), key=itemgetter(0))
+
+def sort_file(item):
+    """
+    Split the statuses of an archive into sorted runs of about
+    ``buffer_size`` bytes in memory each.
+
+    """
+    path, dict_paths, run_dir, idx, buffer_size = item
+    result = CompactResult()
+    items, size = [], 0
+
+    def flush():
+        run_path = os.path.join(
+            run_dir, f'run-{idx:06d}-{len(result.run_paths):04d}.zstd')
+        # the sort is stable, the first version of a status stays first
+        items.sort(key=itemgetter(0))
+        result.duplicates += write_run(run_path, items)
+        result.run_paths.append(run_path)
+
+    dictionaries = zstd.load_dictionaries(dict_paths)
+    with open(path, 'rb') as fp:
+        for lines in zstd.iter_line_batches(fp, dictionaries=dictionaries):
+            for line in lines:
+                result.lines += 1
+                id = zstd.status_id_from_line(line)
+                if id is None:
+                    result.skipped += 1
+                    continue
+                items.append((id, line))
+                size += len(line) + LINE_OVERHEAD
+            if size >= buffer_size:
+                flush()
+                items, size = [], 0
+    if items:
+        flush()
+    return result
+
+def merge_part(item):
+    run_paths, run_path = item
+    duplicates = write_run(run_path, merge_runs(run_paths))
+    for path in run_paths:
+        os.unlink(path)
+    return run_path, duplicates
+
+@attr.s(slots=True, auto_attribs=True)
+class ArchiveWriter:
+    """
+    Write lines into a series of indexed archives named
+    ``<prefix>.<n>.zstd``, moving on to the next one after about
+    ``max_bytes`` compressed bytes or ``max_lines`` lines.
+
+    Like the listener, each archive is written under a temporary name and
+    only renamed once it is complete and synced to disk.
+
+    """
+    prefix: str
+    level: int = 10
+    dict_data: typing.Any = None
+    max_bytes: typing.Optional[int] = None
+    max_lines: typing.Optional[int] = None
+    paths: list = attr.Factory(list)
+    path: str = None
+    fp: typing.Any = None
+    index_fp: typing.Any = None
+    writer: typing.Any = None
+
+    def open(self):
+        self.path = f'{self.prefix}.{len(self.paths):05d}.zstd'
+        if os.path.exists(self.path):
+            raise FileExistsError(f'output path={self.path} already exists')
+        self.fp = open(self.path + stream.TMP_SUFFIX, 'xb')
+        self.index_fp = open(
+            zstd.index_path_for(self.path) + stream.TMP_SUFFIX,
+            'x',
+            encoding='utf8',
+        )
+        self.writer = zstd.FrameWriter(
+            self.fp,
+            index_fp=self.index_fp,
+            level=self.level,
+            dict_data=self.dict_data,
+        )
+
+    def write_line(self, line, *, id=None):
+        if self.writer is None:
+            self.open()
+        writer = self.writer
+        writer.write_line(line, id=id)
+        if (
+            self.max_bytes is not None and writer.offset >= self.max_bytes
+            or self.max_lines is not None
+            and writer.total.lines + writer.frame.lines >= self.max_lines
+        ):
+            self.close()
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        stream.sync_and_close(self.fp)
+        stream.sync_and_close(self.index_fp)
+        stream.finalize(self.path)
+        log.info(
+            f'wrote {self.writer.total.lines} statuses, '
+            f'{self.writer.offset} bytes, to path={self.path}'
+        )
+        self.paths.append(self.path)
+        self.writer = self.fp = self.index_fp = self.path = None
+
+    def abort(self):
+        if self.writer is None:
+            return
+        for fp in (self.fp, self.index_fp):
+            fp.close()
+            os.unlink(fp.name)
+        self.writer = self.fp = self.index_fp = self.path = None
+
+def compact_files(
+    paths,
+    writer,
+    *,
+    jobs=1,
+    buffer_size=256 * 2**20,
+    dict_paths=(),
+    tmp_dir=None,
+):
+    """
+    Merge the statuses in the archives at ``paths`` into ``writer`` in
+    order of id, keeping one line per status.
+
+    This is an external sort. Each file is split into sorted runs of about
+    ``buffer_size`` bytes by ``jobs`` worker processes, and the runs are
+    then merged, in passes of up to :data:`MAX_FAN_IN` runs if there are
+    more. Delete and limit notices are dropped.
+
+    The version of a status kept is chosen like :func:`ingest.add_tweet`,
+    which only replaces a tweet with a strictly newer one. Every copy of a
+    status has the same ``updated_at``, its ``created_at``, so the first
+    copy in the order of ``paths`` wins.
+
+    Returns a :class:`CompactResult` with the totals.
+
+    """
+    total = CompactResult()
+    with ExitStack() as stack:
+        run_dir = stack.enter_context(
+            tempfile.TemporaryDirectory(prefix='.compact-', dir=tmp_dir))
+        executor = None
+        if jobs > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(max_workers=jobs))
+
+        def imap(fn, items):
+            if executor is None:
+                return map(fn, items)
+            return imap_ordered(executor, fn, items, max_pending=2 * jobs)
+
+        run_paths = []
+        items = (
+            (path, dict_paths, run_dir, idx, buffer_size)
+            for idx, path in enumerate(paths)
+        )
+        for path, result in zip(paths, imap(sort_file, items)):
+            log.debug(
+                f'sorted {result.lines} lines from path={path} into '
+                f'{len(result.run_paths)} runs'
+            )
+            total.add(result)
+            run_paths.extend(result.run_paths)
+
+        merge_pass = 0
+        while len(run_paths) > MAX_FAN_IN:
+            log.info(f'merging {len(run_paths)} runs')
+            # consecutive runs are merged together to keep the first copy of
+            # each status ahead of the others
+            items = [
+                (
+                    run_paths[start:start + MAX_FAN_IN],
+                    os.path.join(
+                        run_dir, f'merge-{merge_pass:02d}-{start:06d}.zstd'),
+                )
+                for start in range(0, len(run_paths), MAX_FAN_IN)
+            ]
+            run_paths = []
+            for run_path, duplicates in imap(merge_part, items):
+                total.duplicates += duplicates
+                run_paths.append(run_path)
+            merge_pass += 1
+
+        prev_id = None
+        for id, line in merge_runs(run_paths):
+            if id == prev_id:
+                total.duplicates += 1
+                continue
+            prev_id = id
+            writer.write_line(line, id=id)
+            total.written += 1
+    return total
+
+def main_compact(cli, args):
+    prefix = args.output_prefix
+    existing = glob.glob(glob.escape(prefix) + '.' + '[0-9]' * 5 + '.zstd')
+    if existing:
+        cli.abort(f'output path={sorted(existing)[0]} already exists')
+
+    dict_data = None
+    if args.output_dict:
+        dict_data = zstd.load_dictionary(args.output_dict)
+    writer = ArchiveWriter(
+        prefix,
+        level=args.level,
+        dict_data=dict_data,
+        max_bytes=args.max_bytes,
+        max_lines=args.max_lines,
+    )
+
+    start = time.perf_counter()
+    try:
+        total = compact_files(
+            args.input_files,
+            writer,
+            jobs=args.jobs,
+            buffer_size=args.buffer_size,
+            dict_paths=tuple(args.dict or ()),
+            tmp_dir=args.tmp_dir or os.path.dirname(prefix) or '.',
+        )
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    elapsed = time.perf_counter() - start
+
+    log.info(
+        f'compacted {total.lines} lines in {elapsed:.2f}s into '
+        f'{total.written} statuses in {len(writer.paths)} files, dropped '
+        f'{total.duplicates} duplicates and {total.skipped} other lines'
+    )
@@ -0,0 +1,135 @@
+from datetime import datetime
+import io
+import os
+import tempfile
+import time
+
+from . import ingest
+from . import model
+from . import report
+from . import zstd
+
+log = __import__('logging').getLogger(__name__)
+
+def main_storage(cli, args):
+    storages = args.storage or list(model.STORAGE_PROFILES)
+    for storage in storages:
+        if storage not in model.STORAGE_PROFILES:
+            cli.abort(f'unknown storage profile={storage}')
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        for storage in storages:
+            path = os.path.join(tmp_dir, f'{storage}.db')
+            log.info(f'benchmarking storage={storage}')
+
+            db = model.connect(path, storage=storage)
+            start = time.perf_counter()
+            writer = ingest.ingest_files(
+                cli,
+                db,
+                args.input_files,
+                batch_size=args.batch_size,
+                commit_size=args.commit_size,
+            )
+            ingest_time = time.perf_counter() - start
+            model.close(db)
+            db.get_bind().dispose()
+
+            db = model.connect(path, storage=storage, readonly=True)
+            start = time.perf_counter()
+            q = report.tweets_query(db)
+            columns = [(c['name'], c['type']) for c in q.column_descriptions]
+            with open(os.devnull, 'w') as fp:
+                report.write_csv(
+                    fp, columns, report.iter_query_chunks(db, q, 10000))
+            report_time = time.perf_counter() - start
+            start = time.perf_counter()
+            report.hourly_counts(
+                db,
+                '#saam',
+                since=datetime(2019, 3, 20),
+                until=datetime(2019, 5, 10),
+            )
+            plot_time = time.perf_counter() - start
+            model.close(db)
+            db.get_bind().dispose()
+
+            size = sum(
+                os.path.getsize(p)
+                for p in (path, path + '-wal')
+                if os.path.exists(p)
+            )
+            results.append((
+                storage,
+                writer.new_tweet_count,
+                ingest_time,
+                report_time,
+                plot_time,
+                size,
+            ))
+
+    cli.out(
+        f'{"storage":<10} {"tweets":>8} {"ingest s":>9} {"tweets/s":>9} '
+        f'{"report s":>9} {"plot s":>7} {"MiB":>7}'
+    )
+    for (
+        storage, num_tweets, ingest_time, report_time, plot_time, size,
+    ) in results:
+        cli.out(
+            f'{storage:<10} {num_tweets:>8} {ingest_time:>9.2f} '
+            f'{num_tweets / ingest_time:>9.0f} {report_time:>9.2f} '
+            f'{plot_time:>7.2f} {size / 2**20:>7.1f}'
+        )
+
+def iter_text_lines(fp, *, dictionaries=None):
+    # the reader zstd.iter_lines replaced, decoding every line to str
+    dctx = zstd.decompressor_for(fp, dictionaries)
+    stream_reader = dctx.stream_reader(fp, read_across_frames=True)
+    for line in io.TextIOWrapper(stream_reader, encoding='utf8'):
+        line = line.strip()
+        if line:
+            yield line
+
+def count_text_lines(fp, dictionaries):
+    return sum(1 for _ in iter_text_lines(fp, dictionaries=dictionaries))
+
+def count_lines(fp, dictionaries):
+    return sum(1 for _ in zstd.iter_lines(fp, dictionaries=dictionaries))
+
+def count_line_batches(fp, dictionaries):
+    return sum(
+        len(lines)
+        for lines in zstd.iter_line_batches(fp, dictionaries=dictionaries)
+    )
+
+LINE_READERS = {
+    'textio': count_text_lines,
+    'lines': count_lines,
+    'batches': count_line_batches,
+}
+
+def main_lines(cli, args):
+    dictionaries = zstd.load_dictionaries(tuple(args.dict or ()))
+    results = []
+    for name, reader in LINE_READERS.items():
+        # the best of several runs, the files are cached after the first
+        best_time = None
+        for _ in range(args.repeat):
+            num_lines = 0
+            start = time.perf_counter()
+            for path in args.input_files:
+                with open(path, 'rb') as fp:
+                    num_lines += reader(fp, dictionaries)
+            elapsed = time.perf_counter() - start
+            if best_time is None or elapsed < best_time:
+                best_time = elapsed
+        results.append((name, num_lines, best_time))
+
+    cli.out(f'{"reader":<10} {"lines":>10} {"s":>7} {"lines/s":>10} {"speedup":>8}')
+    base_time = results[0][2]
+    for name, num_lines, elapsed in results:
+        cli.out(
+            f'{name:<10} {num_lines:>10} {elapsed:>7.2f} '
+            f'{num_lines / elapsed:>10.0f} {base_time / elapsed:>7.2f}x'
+        )
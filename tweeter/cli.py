@@ -1,6 +1,7 @@
 from cached_property import cached_property
 from contextlib import contextmanager
 import logging
+import os
 import subparse
 import sys
 import yaml
@@ -40,6 +41,14 @@ class App:
         with open(self.profile_file, 'r', encoding='utf8') as fp:
             return yaml.safe_load(fp)
 
+    @cached_property
+    def db_options(self):
+        # the db section is optional so that commands which only need the
+        # database also work without a profile
+        if not os.path.exists(self.profile_file):
+            return {}
+        return (self.profile or {}).get('db') or {}
+
     @contextmanager
     def input_file(self, path, *, text=True):
         if path == '-':
@@ -64,9 +73,18 @@ class App:
             with open(path, mode) as fp:
                 yield fp
 
-    def connect_db(self, path, commit_on_close=True):
+    def storage_options(self):
+        from . import model
+        options = dict(self.db_options)
+        return model.storage_options(options.pop('storage', None), **options)
+
+    def connect_db(
+        self, path, commit_on_close=True, readonly=False, storage=None,
+    ):
         from . import model
-        db = model.connect(path)
+        if storage is None:
+            storage = self.storage_options()
+        db = model.connect(path, readonly=readonly, storage=storage)
         self.dbs.append(dict(db=db, commit_on_close=commit_on_close))
         return db
 
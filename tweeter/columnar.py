@@ -0,0 +1,371 @@
+from collections import defaultdict
+from datetime import datetime
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import re
+import shutil
+import sqlalchemy as sa
+import uuid
+
+from . import model
+
+log = __import__('logging').getLogger(__name__)
+
+# only the columns that never change once a tweet is ingested are mirrored,
+# so new tweets are appended and existing files are never rewritten,
+# queries on the statistics must still go to the database
+SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('created_at', pa.timestamp('us')),
+    ('user_id', pa.int64()),
+    ('lang', pa.string()),
+    ('text', pa.string()),
+    ('in_reply_to_tweet_id', pa.int64()),
+    ('in_reply_to_user_id', pa.int64()),
+    ('quoted_tweet_id', pa.int64()),
+    ('rt_tweet_id', pa.int64()),
+    # lowercased and without the leading "#", like TweetHashtag
+    ('hashtags', pa.list_(pa.string())),
+])
+
+PARTITIONING = ds.partitioning(
+    pa.schema([('date', pa.date32())]),
+    flavor='hive',
+)
+
+# files written before the names carried a mark have none
+PART_RE = re.compile(r'part-(?:(\d+)-)?[0-9a-f]{32}\.parquet')
+
+def partition_path(path, date):
+    return os.path.join(path, f'date={date.isoformat()}')
+
+def part_name(mark):
+    # the highest rowid of the tweet table in the mirror once the file is in
+    # place, the rows themselves may be any subset of those below it
+    return f'part-{mark}-{uuid.uuid4().hex}.parquet'
+
+def iter_parts(path):
+    """
+    Yield a ``(dir_path, name, mark, pending)`` tuple for every data file in
+    the mirror at ``path``, where ``pending`` files are still hidden under a
+    temporary name and ``mark`` is None for files without one.
+
+    """
+    for entry in os.scandir(path):
+        if not entry.is_dir() or not entry.name.startswith('date='):
+            continue
+        for file_entry in os.scandir(entry.path):
+            name = file_entry.name
+            pending = name.startswith('.') and name.endswith('.tmp')
+            if pending:
+                name = name[1:-len('.tmp')]
+            m = PART_RE.fullmatch(name)
+            if m is None:
+                continue
+            mark = int(m.group(1)) if m.group(1) is not None else None
+            yield entry.path, name, mark, pending
+
+def select_tweets():
+    """
+    Return a query of the mirrored columns of the tweet table, to be
+    converted by :func:`row_from_result`.
+
+    """
+    tweet = model.Tweet.__table__
+    hashtags = model.TweetHashtag.__table__
+    # hashtags never contain spaces
+    tags = (
+        sa.select([sa.func.group_concat(hashtags.c.tag, ' ')])
+        .where(hashtags.c.tweet_id == tweet.c.id)
+        .scalar_subquery()
+    )
+    return sa.select([
+        *(tweet.c[name] for name in SCHEMA.names if name != 'hashtags'),
+        tags.label('hashtags'),
+    ])
+
+def row_from_result(row):
+    row = dict(row._mapping)
+    tags = row['hashtags']
+    row['hashtags'] = sorted(tags.split(' ')) if tags else []
+    return row
+
+def table_from_rows(rows):
+    return pa.Table.from_arrays(
+        [
+            pa.array([row[field.name] for row in rows], type=field.type)
+            for field in SCHEMA
+        ],
+        schema=SCHEMA,
+    )
+
+class MirrorWriter:
+    """
+    Append newly ingested tweets to the mirror at ``path``.
+
+    Rows are staged in memory and written to hidden files by
+    :meth:`prepare`, before the database commits, and only made visible
+    by :meth:`commit` afterward. The highest rowid of the tweet table is
+    recorded in the database and in the names of the files, such that
+    :meth:`catch_up` can tell whether the files left hidden by a crash
+    belong to a committed transaction.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rows_by_date = defaultdict(list)
+        self.pending_paths = []
+
+    def add(self, rows):
+        for row in rows:
+            self.rows_by_date[row['created_at'].date()].append(row)
+
+    def prepare(self, db, *, mark=None):
+        """
+        Write the staged rows to hidden files and record ``mark``, by
+        default the highest rowid of the tweet table, in the current
+        transaction of ``db``.
+
+        """
+        if mark is None:
+            mark = model.max_tweet_rowid(db)
+            if mark is None:
+                return
+        model.save_mirror_mark(db, mark, now=datetime.utcnow())
+        for date, rows in sorted(self.rows_by_date.items()):
+            dir_path = partition_path(self.path, date)
+            os.makedirs(dir_path, exist_ok=True)
+            name = part_name(mark)
+            # the dataset reader ignores files starting with a dot
+            tmp_path = os.path.join(dir_path, f'.{name}.tmp')
+            pq.write_table(
+                table_from_rows(rows), tmp_path, compression='zstd')
+            self.pending_paths.append(
+                (tmp_path, os.path.join(dir_path, name)))
+        self.rows_by_date.clear()
+
+    def commit(self):
+        for tmp_path, path in self.pending_paths:
+            os.rename(tmp_path, path)
+        self.pending_paths.clear()
+
+    def abort(self):
+        self.rows_by_date.clear()
+        for tmp_path, _ in self.pending_paths:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+        self.pending_paths.clear()
+
+    def catch_up(self, db, *, chunk_size=100000):
+        """
+        Bring the mirror up to date with ``db`` after a crash or after
+        tweets were added without it, and commit.
+
+        Hidden files are made visible if the transaction that wrote them
+        committed and deleted otherwise. Then any tweet with a rowid above
+        the highest mark in the mirror is appended to it.
+
+        Returns the number of tweets appended.
+
+        """
+        db_mark = model.load_mirror_mark(db)
+        marks = []
+        for dir_path, name, mark, pending in list(iter_parts(self.path)):
+            if pending:
+                tmp_path = os.path.join(dir_path, f'.{name}.tmp')
+                committed = (
+                    mark is not None and db_mark is not None
+                    and mark <= db_mark
+                )
+                if committed:
+                    log.info(f'recovering mirror file={name}')
+                    os.rename(tmp_path, os.path.join(dir_path, name))
+                else:
+                    log.debug(f'removing uncommitted mirror file={name}')
+                    os.unlink(tmp_path)
+                    continue
+            if mark is not None:
+                marks.append(mark)
+        mirror_mark = max(marks, default=db_mark)
+
+        max_rowid = model.max_tweet_rowid(db)
+        if max_rowid is None or max_rowid == mirror_mark:
+            return 0
+        if mirror_mark is None:
+            log.warning(
+                f'mirror at path={self.path} predates recording its progress, '
+                f'rebuild it with db:mirror to catch up with the database')
+            return 0
+
+        table = model.Tweet.__table__
+        rowid = sa.literal_column('rowid')
+        num_rows = 0
+        while mirror_mark < max_rowid:
+            q = (
+                select_tweets()
+                .add_columns(rowid)
+                .where(rowid > mirror_mark)
+                .where(rowid <= max_rowid)
+                .order_by(rowid)
+                .limit(chunk_size)
+            )
+            rows = db.connection().execute(q).all()
+            if not rows:
+                break
+            mirror_mark = rows[-1].rowid
+            self.add(row_from_result(row) for row in rows)
+            try:
+                self.prepare(db, mark=mirror_mark)
+                db.commit()
+            except Exception:
+                self.abort()
+                raise
+            self.commit()
+            num_rows += len(rows)
+        log.info(f'caught up the mirror with {num_rows} tweets')
+        return num_rows
+
+def build(db, path, *, chunk_size=100000):
+    """
+    Rebuild the mirror at ``path`` from every tweet in ``db``.
+
+    The new mirror is written next to the old one and swapped into place
+    once complete, leaving one file per day.
+
+    """
+    table = model.Tweet.__table__
+    # tweets added while building are left for catch_up
+    mark = model.max_tweet_rowid(db)
+    q = (
+        select_tweets()
+        .where(sa.literal_column('rowid') <= mark)
+        .order_by(table.c.created_at)
+    )
+    conn = db.connection().execution_options(
+        stream_results=True,
+        max_row_buffer=chunk_size,
+    )
+
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    num_rows = 0
+    date = writer = None
+    try:
+        for rows in conn.execute(q).partitions(chunk_size):
+            rows_by_date = defaultdict(list)
+            for row in rows:
+                rows_by_date[row.created_at.date()].append(
+                    row_from_result(row))
+            # rows arrive in order of creation so each day is only visited
+            # once and its writer can be closed when the next day begins
+            for row_date, date_rows in sorted(rows_by_date.items()):
+                if row_date != date:
+                    if writer is not None:
+                        writer.close()
+                    date = row_date
+                    dir_path = partition_path(tmp_path, date)
+                    os.makedirs(dir_path)
+                    writer = pq.ParquetWriter(
+                        os.path.join(dir_path, part_name(mark)),
+                        SCHEMA,
+                        compression='zstd',
+                    )
+                writer.write_table(table_from_rows(date_rows))
+                num_rows += len(date_rows)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    old_path = path + '.old'
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    return num_rows
+
+def open_dataset(path):
+    return ds.dataset(path, format='parquet', partitioning=PARTITIONING)
+
+def hourly_counts(path, term, *, since=None, until=None):
+    """
+    Count the tweets containing ``term`` by the hour they were created in
+    and whether they are retweets or replies, like
+    :func:`tweeter.model.hourly_counts_select`.
+
+    A hashtag is matched against the hashtags of the tweets, like
+    :func:`tweeter.model.tweet_text_filter`, and anything else by
+    :func:`tweeter.model.term_pattern`.
+
+    Returns a list of ``(bucket, is_retweet, is_reply, count)`` tuples.
+
+    """
+    dataset = open_dataset(path)
+    # the partition filter skips entire days without opening their files
+    expr = None
+    if since is not None:
+        expr = (
+            (ds.field('date') >= since.date())
+            & (ds.field('created_at') >= pa.scalar(since, pa.timestamp('us')))
+        )
+    if until is not None:
+        until_expr = (
+            (ds.field('date') <= until.date())
+            & (ds.field('created_at') <= pa.scalar(until, pa.timestamp('us')))
+        )
+        expr = until_expr if expr is None else expr & until_expr
+    is_hashtag = term.startswith('#')
+    table = dataset.to_table(
+        columns=[
+            'created_at',
+            'hashtags' if is_hashtag else 'text',
+            'rt_tweet_id',
+            'in_reply_to_tweet_id',
+        ],
+        filter=expr,
+    )
+
+    if is_hashtag:
+        tags = table['hashtags'].combine_chunks()
+        matched = pc.filter(
+            pc.list_parent_indices(tags),
+            pc.equal(pc.list_flatten(tags), term[1:].lower()),
+        )
+        mask = pc.is_in(
+            pa.array(range(len(table)), type=matched.type),
+            value_set=matched,
+        )
+    else:
+        mask = pc.match_substring_regex(
+            table['text'], model.term_pattern(term), ignore_case=True)
+    table = table.filter(mask)
+    table = pa.table({
+        'bucket': pc.floor_temporal(table['created_at'], unit='hour'),
+        'is_retweet': pc.is_valid(table['rt_tweet_id']),
+        'is_reply': pc.is_valid(table['in_reply_to_tweet_id']),
+    })
+    counts = table.group_by(['bucket', 'is_retweet', 'is_reply']).aggregate([
+        ('bucket', 'count'),
+    ])
+    return list(zip(
+        counts['bucket'].to_pylist(),
+        counts['is_retweet'].to_pylist(),
+        counts['is_reply'].to_pylist(),
+        counts['bucket_count'].to_pylist(),
+    ))
+
+def main_build(cli, args):
+    # not readonly such that older databases are migrated, the hashtags are
+    # looked up by an index added to them
+    db = cli.connect_db(args.db)
+    path = model.mirror_path_for(args.db)
+    num_rows = build(db, path, chunk_size=args.chunk_size)
+    log.info(f'mirrored {num_rows} tweets to path={path}')
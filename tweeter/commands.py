@@ -1,6 +1,6 @@
 from subparse import command
 
-from .settings import asduration
+from .settings import asduration, astimestamp
 
 def generic_options(parser):
     parser.add_argument('-v', '--verbose', action='store_true')
@@ -12,9 +12,14 @@ def stream(parser):
     Listen to the twitter firehouse.
 
     Tweets are streamed out to zstd-compressed files, one tweet per line.
+    Each file is written as a series of independent zstd frames alongside a
+    ``.index`` file recording the offset and status id range of each frame.
 
-    A new file is created when the stream is interrupted due to an issue or
-    when a SIGHUP is received locally. The resulting files can then be
+    A new file is created when the stream is interrupted due to an issue,
+    when a SIGHUP is received locally or when one of the ``max_bytes``,
+    ``max_records`` or ``max_age`` limits in the ``stream`` section of the
+    profile is reached. Files are written under a temporary name and only
+    renamed into place once complete. The resulting files can then be
     concatenated together and/or ingested into the database for querying.
 
     """
@@ -26,13 +31,33 @@ def updater(parser):
     """
     Refresh statistics on stale tweets.
 
-    Query the database for tweets that have not been refreshed lately.
-    The updated tweets are output to zstd-compressed files, one tweet per line.
+    Query the database for tweets due for a refresh and look them up again,
+    the ones expected to have gained the most retweets and favorites since
+    they were last seen first. That estimate favors young tweets, tweets
+    that were growing when last looked up and authors with many followers.
+
+    A tweet is first due once it was last updated more than ``--min-age``
+    ago. Each lookup schedules the next one, twice as late while the tweet
+    stays quiet, up to ``--max-interval``, and twice as early while it
+    grows. ``--max-lookups`` caps the requests made by a run, such that the
+    rate limit is spent on the most promising tweets.
+
+    Up to ``--prefetch`` lookups run ahead on ``--jobs`` threads, pausing
+    whenever the rate limit is reached, while the results are written to
+    the database.
+
+    Tweets that can no longer be found are recorded and skipped by later
+    runs unless ``--retry-unavailable`` is given.
 
     """
     parser.add_argument('--db', required=True)
     parser.add_argument('--min-age', type=asduration, default='7d')
+    parser.add_argument('--max-interval', type=asduration, default='30d')
     parser.add_argument('--min-id', type=int)
+    parser.add_argument('--max-lookups', type=int)
+    parser.add_argument('--jobs', type=int, default=2)
+    parser.add_argument('--prefetch', type=int, default=4)
+    parser.add_argument('--retry-unavailable', action='store_true')
 
 @command('.search', 'api:search')
 def search(parser):
@@ -48,29 +73,243 @@ def ingest(parser):
     """
     Pull in tweets from zstd-compressed files into a database.
 
+    Messages are written in batches of ``--batch-size`` and committed roughly
+    every ``--commit-size`` messages. Memory use is bounded by the batch size
+    and not by the size of the database.
+
+    With ``--jobs`` greater than one, parsing is spread across worker
+    processes while a single writer applies the batches in input order.
+
+    Archives written with a frame index by ``api:stream`` are split by frame
+    across the workers, and frames outside of the ``--min-id``/``--max-id``
+    or ``--since``/``--until`` range are skipped without being read.
+
+    The progress through each file is committed with the data, so files
+    that were already ingested are skipped and an interrupted ingest resumes
+    after the last commit. Use ``--force`` to read every file again.
+
+    """
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--commit-size', type=int, default=100000)
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--min-id', type=int)
+    parser.add_argument('--max-id', type=int)
+    parser.add_argument('--since', type=astimestamp)
+    parser.add_argument('--until', type=astimestamp)
+    parser.add_argument('--dict', action='append')
+    parser.add_argument('--force', action='store_true')
+    parser.add_argument('input_files', nargs='+')
+
+@command('.follow', 'db:follow')
+def follow(parser):
+    """
+    Continuously ingest the files written by ``api:stream``.
+
+    Each file matching ``<output_path_prefix>.*.zstd`` is ingested once it
+    has been finalized, and files that appear together are committed
+    together. The directory is watched with inotify where available and
+    rescanned every ``--poll-interval`` seconds otherwise.
+
+    The database is switched to WAL mode so reports may query it while it
+    is being written.
+
+    """
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--commit-size', type=int, default=100000)
+    parser.add_argument('--poll-interval', type=float, default=5)
+    parser.add_argument('--dict', action='append')
+    parser.add_argument('output_path_prefix')
+
+@command('.columnar:main_build', 'db:mirror')
+def mirror(parser):
+    """
+    Build, or rebuild, a columnar mirror of the tweets in a database.
+
+    The mirror is a directory of parquet files partitioned by day next to
+    the database, ``<db>.mirror``. Once it exists, ``db:ingest`` and
+    ``db:follow`` append new tweets to it and ``report:plot --no-cache``
+    queries it instead of the database. Requires ``pyarrow``.
+
+    Rebuilding also merges the small files written by each ingest into one
+    file per day. Don't ingest into the database while rebuilding.
+
     """
     parser.add_argument('--db', required=True)
+    parser.add_argument('--chunk-size', type=int, default=100000)
+
+@command('.benchmark:main_storage', 'db:benchmark')
+def benchmark(parser):
+    """
+    Time an ingest and the report queries under each storage profile.
+
+    Every profile listed with ``--storage``, or all of them by default,
+    ingests the input files into a new database in ``--tmp-dir``.
+
+    """
+    parser.add_argument('--storage', action='append')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--commit-size', type=int, default=100000)
+    parser.add_argument('--tmp-dir')
     parser.add_argument('input_files', nargs='+')
 
 @command('.report:main', 'report')
 def report(parser):
+    """
+    Export every tweet, joined with its author, to a csv, xlsx or parquet
+    file.
+
+    The rows are streamed from the database in chunks of ``--chunk-size``
+    so memory use does not depend on the size of the database. Excel
+    workbooks are split into multiple sheets when there are more rows than
+    fit in one sheet, and parquet files are written with one row group per
+    chunk.
+
+    """
     parser.add_argument('--db', required=True)
     parser.add_argument('--format')
+    parser.add_argument('--chunk-size', type=int, default=10000)
     parser.add_argument('-o', '--output-file', default='-')
 
 @command('.report:main_plot', 'report:plot')
 def plot(parser):
+    """
+    Plot the number of tweets containing each ``--term`` over time.
+
+    A term starting with "#" matches that hashtag, anything else matches a
+    phrase of whole words, ignoring case. Retweets are left out unless
+    ``--include-retweets`` is given.
+
+    The first time a term is plotted its tweets are counted by the hour and
+    the counts are stored in the database, ``db:ingest`` and ``db:follow``
+    then keep them up to date, so plotting it again over any range and
+    bucket size is instant. ``--no-cache`` counts the tweets directly
+    instead, from the columnar mirror if there is one, without writing to
+    the database.
+
+    """
     parser.add_argument('--db', required=True)
+    parser.add_argument('--term', action='append')
+    parser.add_argument('--since', type=astimestamp)
+    parser.add_argument('--until', type=astimestamp)
+    parser.add_argument(
+        '--bucket', choices=['hour', 'day', 'week'], default='day')
+    parser.add_argument('--include-retweets', action='store_true')
+    parser.add_argument('--exclude-replies', action='store_true')
+    parser.add_argument('--no-cache', action='store_true')
     parser.add_argument('-o', '--output-file', default='-')
 
+@command('.archive:main_grep', 'archive:grep')
+def archive_grep(parser):
+    """
+    Search zstd archives for tweets without ingesting them.
+
+    Tweets match if they contain any ``--term``, a "#hashtag" or a phrase
+    of whole words ignoring case, were written by any ``--user``, by screen
+    name or id, are in any ``--lang`` and were created between ``--since``
+    and ``--until``. ``--retweets`` and ``--replies`` include, exclude or
+    only keep retweets and replies.
+
+    Each raw line is checked for the bytes the predicates need before it
+    is parsed, so most lines of a selective search are never parsed. The
+    archives are scanned by ``--jobs`` processes, split by frame if they
+    have an index, and frames outside of the time range are skipped.
+
+    The matching lines are written to ``--output-file`` as an indexed zstd
+    archive, or only counted with ``--count``.
+
+    """
+    parser.add_argument('-o', '--output-file', default='-')
+    parser.add_argument('--count', action='store_true')
+    parser.add_argument('--term', action='append')
+    parser.add_argument('--user', action='append')
+    parser.add_argument('--lang', action='append')
+    parser.add_argument('--since', type=astimestamp)
+    parser.add_argument('--until', type=astimestamp)
+    parser.add_argument(
+        '--retweets', choices=['include', 'exclude', 'only'], default='include')
+    parser.add_argument(
+        '--replies', choices=['include', 'exclude', 'only'], default='include')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--level', type=int, default=10)
+    parser.add_argument('--dict', action='append')
+    parser.add_argument('input_files', nargs='+')
+
+@command('.archive:main_compact', 'archive:compact')
+def archive_compact(parser):
+    """
+    Merge zstd archives into indexed archives sorted by tweet id.
+
+    Every status is kept once, the first copy in the order of the input
+    files, like ``db:ingest`` which only replaces a tweet with a newer
+    version. Delete and limit notices are dropped.
+
+    The inputs are sorted externally: ``--jobs`` processes split them into
+    sorted runs of about ``--buffer-size`` bytes in memory each, written to
+    ``--tmp-dir``, which are then merged. The output is written to
+    ``<output-prefix>.00000.zstd`` and onward, starting a new file after
+    ``--max-bytes`` compressed bytes or ``--max-lines`` statuses.
+
+    """
+    parser.add_argument('-o', '--output-prefix', required=True)
+    parser.add_argument('--level', type=int, default=10)
+    parser.add_argument('--dict', action='append')
+    parser.add_argument('--output-dict')
+    parser.add_argument('--max-bytes', type=int)
+    parser.add_argument('--max-lines', type=int)
+    parser.add_argument('--buffer-size', type=int, default=256 * 2**20)
+    parser.add_argument('--tmp-dir')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('input_files', nargs='+')
+
+@command('.benchmark:main_lines', 'zstd:benchmark')
+def zstd_benchmark(parser):
+    """
+    Compare the speed of reading the lines of zstd archives.
+
+    Counts the lines of the input files with the previous text reader,
+    which decoded every line to a string, and with ``zstd.iter_lines`` and
+    ``zstd.iter_line_batches``, which split large chunks of bytes. Each
+    reader is timed by the best of ``--repeat`` runs.
+
+    """
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dict', action='append')
+    parser.add_argument('input_files', nargs='+')
+
+@command('.zstd:main_train_dict', 'zstd:train-dict')
+def zstd_train_dict(parser):
+    """
+    Train a zstd dictionary from sample tweet archives.
+
+    Each tweet is used as a sample. The dictionary id is recorded in every
+    frame compressed with it, and any command reading zstd files accepts
+    ``--dict`` (multiple times) to supply the dictionaries it may need.
+
+    """
+    parser.add_argument('-o', '--output-file', default='-')
+    parser.add_argument('--size', type=int, default=112640)
+    parser.add_argument('--max-samples', type=int, default=100000)
+    parser.add_argument('--dict', action='append')
+    parser.add_argument('input_files', nargs='+')
+
 @command('.zstd:main_concat', 'zstd:concat')
 def zstd_concat(parser):
     """
     Concatenate zstd files together into a single zstd file.
 
+    Up to ``--jobs`` input files are decompressed at once on background
+    threads while their data is recompressed in the order of the input,
+    using ``--threads`` compression threads, or one per cpu if negative.
+
     """
     parser.add_argument('-o', '--output-file', default='-')
     parser.add_argument('--level', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--dict', action='append')
+    parser.add_argument('--output-dict')
     parser.add_argument('input_files', nargs='+')
 
 @command('.zstd:main_compress', 'zstd:compress')
@@ -78,9 +317,14 @@ def zstd_compress(parser):
     """
     Compress a file using zstd.
 
+    The data is compressed on ``--threads`` threads, or one per cpu if
+    negative.
+
     """
     parser.add_argument('-o', '--output-file', default='-')
     parser.add_argument('--level', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--dict')
     parser.add_argument('input_file')
 
 @command('.zstd:main_decompress', 'zstd:decompress')
@@ -90,6 +334,7 @@ def zstd_decompress(parser):
 
     """
     parser.add_argument('-o', '--output-file', default='-')
+    parser.add_argument('--dict', action='append')
     parser.add_argument('input_file')
 
 @command('.zstd:main_from_gz', 'zstd:from-gz')
@@ -97,9 +342,14 @@ def zstd_from_gz(parser):
     """
     Convert a gzip file to zstd format.
 
+    The data is compressed on ``--threads`` threads, or one per cpu if
+    negative, while it is being decompressed.
+
     """
     parser.add_argument('-o', '--output-file', default='-')
     parser.add_argument('--level', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--dict')
     parser.add_argument('input_file')
 
 @command('.media:main_download', 'media:download')
@@ -107,5 +357,31 @@ def download_media(parser):
     """
     Download media for tweets.
 
+    Every photo, video and gif attached to the tweets is downloaded once,
+    however many tweets share it. Photos are fetched in ``--photo-size``
+    and videos in the mp4 variant with the highest bitrate up to
+    ``--max-bitrate``. Any other url on ``--domain``, or its subdomains, is
+    downloaded as is.
+
+    Downloads run on a pool of ``--jobs`` threads, with at most
+    ``--per-host`` requests to the same host at a time. Files are stored in
+    ``--output-dir`` by the sha256 of their content, ``ab/cd/abcd....jpg``.
+
+    The outcome for each url is recorded in the database, so a rerun only
+    downloads new urls, plus the ones that failed with ``--retry-failed``.
+
     """
     parser.add_argument('--db', required=True)
+    parser.add_argument('--output-dir', default='media')
+    parser.add_argument('--domain', default='twimg.com')
+    parser.add_argument(
+        '--photo-size',
+        choices=['orig', 'large', 'medium', 'small', 'thumb'],
+        default='orig',
+    )
+    parser.add_argument('--max-bitrate', type=int)
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--per-host', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--retry-failed', action='store_true')
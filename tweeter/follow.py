@@ -0,0 +1,173 @@
+import ctypes
+import ctypes.util
+import glob
+import os
+import select
+import signal
+import time
+
+from . import ingest
+
+log = __import__('logging').getLogger(__name__)
+
+# inotify event flags from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+class InotifyWatcher:
+    """
+    Wait for files to be renamed or written into a directory using inotify.
+
+    The events themselves are discarded, they only serve to wake up the
+    caller which then rescans the directory.
+
+    """
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        wd = libc.inotify_add_watch(
+            fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, os.strerror(errno), path)
+        self.fd = fd
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return True
+
+    def close(self):
+        pass
+
+def make_watcher(path):
+    try:
+        return InotifyWatcher(path)
+    except (AttributeError, OSError) as ex:
+        log.info(f'inotify is not available, falling back to polling: {ex}')
+        return PollingWatcher()
+
+def find_stream_files(path_prefix):
+    """
+    Return the finalized stream files for ``path_prefix`` in the order they
+    were written.
+
+    Files still being written by ``api:stream`` have a ``.tmp`` suffix and
+    only show up here once they are complete.
+
+    """
+    return sorted(glob.glob(f'{glob.escape(path_prefix)}.*.zstd'))
+
+def wal_storage(options):
+    """
+    Switch the storage ``options`` of a database to wal mode, in which
+    readers are not blocked by the writer and vice versa, unless they
+    already use it.
+
+    """
+    if (options.get('journal_mode') or '').upper() == 'WAL':
+        return options
+    log.info('switching the database to wal mode')
+    options = dict(options, journal_mode='WAL')
+    if options.get('synchronous') is None:
+        options['synchronous'] = 'NORMAL'
+    return options
+
+def ingest_together(cli, db, paths, args):
+    writer = ingest.ingest_files(
+        cli,
+        db,
+        paths,
+        batch_size=args.batch_size,
+        commit_size=args.commit_size,
+        dict_paths=tuple(args.dict or ()),
+        mirror_path=ingest.find_mirror(args.db),
+    )
+    if writer.new_tweet_count or writer.updated_tweet_count:
+        log.info(
+            f'added {writer.new_tweet_count} tweets, '
+            f'updated {writer.updated_tweet_count} tweets, '
+            f'added {writer.new_user_count} users'
+        )
+    return [path for path in paths if writer.files[path]['completed']]
+
+def ingest_new_files(cli, db, paths, args):
+    """
+    Ingest ``paths`` in a single pass, committed together, falling back to
+    one file at a time to find the culprit if that fails.
+
+    Returns the paths that were completed and the paths that failed.
+
+    """
+    try:
+        return ingest_together(cli, db, paths, args), []
+    except Exception:
+        db.rollback()
+        if len(paths) == 1:
+            log.exception(f'failed ingesting file={paths[0]}')
+            return [], paths
+        log.exception(
+            f'failed ingesting {len(paths)} files, retrying them one at a '
+            f'time'
+        )
+    completed, failed = [], []
+    for path in paths:
+        path_completed, path_failed = ingest_new_files(cli, db, [path], args)
+        completed.extend(path_completed)
+        failed.extend(path_failed)
+    return completed, failed
+
+def main(cli, args):
+    db = cli.connect_db(args.db, storage=wal_storage(cli.storage_options()))
+
+    directory = os.path.dirname(args.output_path_prefix) or '.'
+    watcher = make_watcher(directory)
+
+    stopping = False
+    def on_sigterm(*args):
+        nonlocal stopping
+        log.info('received SIGTERM, stopping')
+        stopping = True
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    # files found to be complete are remembered to avoid fingerprinting
+    # every file in the directory again on each scan, and files that failed
+    # are not retried until the next start
+    ingested_paths = set()
+    failed_paths = set()
+    try:
+        while not stopping:
+            paths = [
+                path
+                for path in find_stream_files(args.output_path_prefix)
+                if path not in ingested_paths and path not in failed_paths
+            ]
+            if paths:
+                completed, failed = ingest_new_files(cli, db, paths, args)
+                ingested_paths.update(completed)
+                failed_paths.update(failed)
+
+            watcher.wait(args.poll_interval)
+    except KeyboardInterrupt:
+        log.info('received SIGINT, stopping')
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        watcher.close()
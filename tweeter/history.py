@@ -0,0 +1,125 @@
+import attr
+import numpy as np
+import sqlalchemy as sa
+
+from . import model
+
+log = __import__('logging').getLogger(__name__)
+
+# stands in for statistics missing from a version of a tweet, such as the
+# quote_count of tweets collected before it was introduced
+MISSING_COUNT = -1
+
+@attr.s(frozen=True, auto_attribs=True)
+class TweetSeries:
+    """
+    The history of the statistics of a tweet, one element per version in
+    order of ``observed_at``.
+
+    Counts are int64 arrays using :data:`MISSING_COUNT` for unknown values.
+
+    """
+    tweet_id: int
+    observed_at: np.ndarray
+    favorite_count: np.ndarray
+    retweet_count: np.ndarray
+    reply_count: np.ndarray
+    quote_count: np.ndarray
+
+def tweet_stats_query(*, since=None, until=None):
+    table = model.TweetStats.__table__
+    q = (
+        sa.select([
+            table.c.tweet_id,
+            # the stored text is parsed by numpy in bulk, far quicker than
+            # building a datetime for every row
+            sa.type_coerce(table.c.observed_at, sa.String()),
+            *(table.c[name] for name in model.TWEET_STATS_COLUMNS),
+        ])
+        .order_by(table.c.tweet_id, table.c.observed_at)
+    )
+    if since is not None:
+        q = q.where(table.c.observed_at >= since)
+    if until is not None:
+        q = q.where(table.c.observed_at <= until)
+    return q
+
+def series_from_rows(rows):
+    """
+    Split rows of :func:`tweet_stats_query`, ordered by tweet, into a
+    :class:`TweetSeries` per tweet.
+
+    """
+    if not rows:
+        return []
+    columns = list(zip(*rows))
+    tweet_ids = np.array(columns[0], dtype=np.int64)
+    arrays = [np.array(columns[1], dtype='datetime64[us]')]
+    for values in columns[2:]:
+        arrays.append(np.fromiter(
+            (MISSING_COUNT if v is None else v for v in values),
+            dtype=np.int64,
+            count=len(values),
+        ))
+
+    starts = np.concatenate((
+        [0], np.flatnonzero(tweet_ids[1:] != tweet_ids[:-1]) + 1))
+    ends = np.append(starts[1:], len(tweet_ids))
+    return [
+        TweetSeries(
+            int(tweet_ids[start]),
+            *(array[start:end] for array in arrays),
+        )
+        for start, end in zip(starts, ends)
+    ]
+
+def load_series(db, tweet_ids, *, since=None, until=None):
+    """
+    Load the history of each of ``tweet_ids``, optionally limited to the
+    versions observed between ``since`` and ``until``.
+
+    Returns a dict of :class:`TweetSeries` by tweet id, leaving out tweets
+    without any history.
+
+    """
+    table = model.TweetStats.__table__
+    q = tweet_stats_query(since=since, until=until)
+    conn = db.connection()
+    tweet_ids = sorted(set(tweet_ids))
+    series_by_id = {}
+    # each tweet is a range scan of the primary key, in chunks that stay
+    # below the SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+    for start in range(0, len(tweet_ids), 900):
+        chunk = tweet_ids[start:start + 900]
+        rows = conn.execute(q.where(table.c.tweet_id.in_(chunk))).all()
+        for series in series_from_rows(rows):
+            series_by_id[series.tweet_id] = series
+    return series_by_id
+
+def iter_series(db, *, min_id=None, since=None, until=None, chunk_size=100000):
+    """
+    Yield the history of every tweet, in order of id, like
+    :func:`load_series` but streaming rather than holding all of them in
+    memory.
+
+    """
+    table = model.TweetStats.__table__
+    q = tweet_stats_query(since=since, until=until)
+    if min_id is not None:
+        q = q.where(table.c.tweet_id >= min_id)
+    conn = db.connection().execution_options(
+        stream_results=True,
+        max_row_buffer=chunk_size,
+    )
+
+    pending = []
+    for rows in conn.execute(q).partitions(chunk_size):
+        rows = pending + rows
+        # the last tweet may continue in the next partition
+        last_id = rows[-1][0]
+        split = len(rows)
+        while split > 0 and rows[split - 1][0] == last_id:
+            split -= 1
+        pending = rows[split:]
+        yield from series_from_rows(rows[:split])
+    yield from series_from_rows(pending)
@@ -1,168 +1,843 @@
 import attr
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
 from email.utils import parsedate
+import functools
+import hashlib
 import json
-from sqlalchemy import orm
+import operator
+import os
+import resource
+import sqlalchemy as sa
+from sqlalchemy.dialects import sqlite
+import sys
 import typing
 
 from . import model
+from .util import imap_ordered
 from . import zstd
 
 log = __import__('logging').getLogger(__name__)
 
+MONTHS = {
+    name: idx + 1
+    for idx, name in enumerate((
+        'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+        'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec',
+    ))
+}
+
+@functools.lru_cache(maxsize=65536)
 def parse_datetime(value):
-    return datetime(*(parsedate(value)[:6]))
+    # twitter always uses the same format, "Wed Oct 10 20:19:24 +0000 2018",
+    # so try to split it apart directly before falling back to the much
+    # slower rfc 2822 parser
+    try:
+        _, month, day, hms, _, year = value.split(' ')
+        hour, minute, second = hms.split(':')
+        return datetime(
+            int(year), MONTHS[month], int(day),
+            int(hour), int(minute), int(second),
+        )
+    except (KeyError, ValueError):
+        return datetime(*(parsedate(value)[:6]))
 
-def tweet_from_object(obj, *, updated_at=None):
+def tweet_row_from_object(obj, *, updated_at=None):
     created_at = parse_datetime(obj['created_at'])
     if updated_at is None:
         updated_at = created_at
-    tw = model.Tweet(
+    user = obj['user']
+    text = obj['text']
+    entities = obj.get('entities', {})
+    extended_entities = obj.get('extended_entities', {})
+    for url in entities.get('urls', []):
+        text = text.replace(url['url'], url['expanded_url'])
+    for media in entities.get('media', []):
+        text = text.replace(media['url'], media['media_url'])
+    for url in extended_entities.get('urls', []):
+        text = text.replace(url['url'], url['expanded_url'])
+    for media in extended_entities.get('media', []):
+        text = text.replace(media['url'], media['media_url'])
+    extended_tweet = obj.get('extended_tweet')
+    if extended_tweet:
+        text = extended_tweet.get('full_text') or text
+        entities = extended_tweet.get('entities', {})
+        extended_entities = extended_tweet.get('extended_entities', {})
+        for url in entities.get('urls', []):
+            text = text.replace(url['url'], url['expanded_url'])
+        for media in entities.get('media', []):
+            text = text.replace(media['url'], media['media_url'])
+        for url in extended_entities.get('urls', []):
+            text = text.replace(url['url'], url['expanded_url'])
+        for media in extended_entities.get('media', []):
+            text = text.replace(media['url'], media['media_url'])
+    quote_obj = obj.get('quoted_status')
+    rt_obj = obj.get('retweeted_status')
+    return dict(
         id=obj['id'],
         created_at=created_at,
         updated_at=updated_at,
-        text=obj['text'],
+        text=text,
         source=obj['source'],
         lang=obj['lang'],
-        user_id=obj['user']['id'],
-        user_description=obj['user']['description'],
-        user_verified=obj['user']['verified'],
-        user_followers_count=obj['user']['followers_count'],
-        user_friends_count=obj['user']['friends_count'],
-        user_listed_count=obj['user']['listed_count'],
-        user_statuses_count=obj['user']['statuses_count'],
-        user_favorites_count=obj['user']['favourites_count'],
-        user_created_at=parse_datetime(obj['user']['created_at']),
+        user_id=user['id'],
+        user_description=user['description'],
+        user_verified=user['verified'],
+        user_followers_count=user['followers_count'],
+        user_friends_count=user['friends_count'],
+        user_listed_count=user['listed_count'],
+        user_statuses_count=user['statuses_count'],
+        user_favorites_count=user['favourites_count'],
+        user_created_at=parse_datetime(user['created_at']),
 
         in_reply_to_tweet_id=obj['in_reply_to_status_id'],
         in_reply_to_user_id=obj['in_reply_to_user_id'],
 
+        quoted_tweet_id=quote_obj['id'] if quote_obj else None,
+        rt_tweet_id=rt_obj['id'] if rt_obj else None,
+
         favorite_count=obj.get('favorite_count'),
         quote_count=obj.get('quote_count'),
         reply_count=obj.get('reply_count'),
         retweet_count=obj.get('retweet_count'),
     )
-    for url in obj.get('entities', {}).get('urls', []):
-        tw.text = tw.text.replace(url['url'], url['expanded_url'])
-    for media in obj.get('entities', {}).get('media', []):
-        tw.text = tw.text.replace(media['url'], media['media_url'])
-    for url in obj.get('extended_entities', {}).get('urls', []):
-        tw.text = tw.text.replace(url['url'], url['expanded_url'])
-    for media in obj.get('extended_entities', {}).get('media', []):
-        tw.text = tw.text.replace(media['url'], media['media_url'])
+
+def entities_from_object(obj):
+    """
+    Return the set of lowercased hashtags and the set of expanded urls from
+    the entities of a status.
+
+    The urls are the same ones substituted into the text by
+    :func:`tweet_row_from_object`.
+
+    """
+    hashtags = set()
+    urls = set()
+    def collect(entities):
+        for hashtag in entities.get('hashtags', []):
+            hashtags.add(hashtag['text'].lower())
+        for url in entities.get('urls', []):
+            if url.get('expanded_url'):
+                urls.add(url['expanded_url'])
+        for media in entities.get('media', []):
+            urls.add(media['media_url'])
+
+    collect(obj.get('entities', {}))
+    collect(obj.get('extended_entities', {}))
     extended_tweet = obj.get('extended_tweet')
     if extended_tweet:
-        tw.text = extended_tweet.get('full_text') or tw.text
-        for url in extended_tweet.get('entities', {}).get('urls', []):
-            tw.text = tw.text.replace(url['url'], url['expanded_url'])
-        for media in extended_tweet.get('entities', {}).get('media', []):
-            tw.text = tw.text.replace(media['url'], media['media_url'])
-        for url in extended_tweet.get('extended_entities', {}).get('urls', []):
-            tw.text = tw.text.replace(url['url'], url['expanded_url'])
-        for media in extended_tweet.get('extended_entities', {}).get('media', []):
-            tw.text = tw.text.replace(media['url'], media['media_url'])
-    quote_obj = obj.get('quoted_status')
-    if quote_obj:
-        tw.quoted_tweet_id = quote_obj['id']
-    rt_obj = obj.get('retweeted_status')
-    if rt_obj:
-        tw.rt_tweet_id = rt_obj['id']
-    return tw
+        collect(extended_tweet.get('entities', {}))
+        collect(extended_tweet.get('extended_entities', {}))
+    return hashtags, urls
+
+def media_from_object(obj):
+    """
+    Return a row for each of the media attached to a status.
+
+    The extended entities are preferred since only they describe every
+    photo of a tweet and the video variants.
+
+    """
+    media_by_id = {}
+    def collect(entities):
+        for media in entities.get('media', []):
+            if media['id'] in media_by_id:
+                continue
+            variants = media.get('video_info', {}).get('variants')
+            media_by_id[media['id']] = dict(
+                id=media['id'],
+                type=media.get('type', 'photo'),
+                url=media.get('media_url') or media['media_url_https'],
+                variants=json.dumps(variants) if variants else None,
+            )
+
+    extended_tweet = obj.get('extended_tweet')
+    if extended_tweet:
+        collect(extended_tweet.get('extended_entities', {}))
+        collect(extended_tweet.get('entities', {}))
+    collect(obj.get('extended_entities', {}))
+    collect(obj.get('entities', {}))
+    return list(media_by_id.values())
+
+def user_row_from_object(obj):
+    return dict(
+        id=obj['id'],
+        nick=obj['screen_name'],
+    )
+
+TWEET_STAT_COLUMNS = (
+    'updated_at',
+    'favorite_count',
+    'quote_count',
+    'reply_count',
+    'retweet_count',
+)
+
+def upsert_tweets_stmt():
+    """
+    Insert new tweets and refresh the statistics on existing tweets.
+
+    The first version of a tweet determines its content and a later version
+    only replaces the statistics if it is strictly newer than what is
+    already stored. See :func:`add_tweet`.
+
+    """
+    table = model.Tweet.__table__
+    stmt = sqlite.insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.id],
+        set_={name: stmt.excluded[name] for name in TWEET_STAT_COLUMNS},
+        where=stmt.excluded.updated_at > table.c.updated_at,
+    )
+
+def insert_users_stmt():
+    return model.User.__table__.insert().prefix_with('OR IGNORE')
+
+def insert_hashtags_stmt():
+    return model.TweetHashtag.__table__.insert().prefix_with('OR IGNORE')
+
+def insert_urls_stmt():
+    return model.TweetUrl.__table__.insert().prefix_with('OR IGNORE')
 
-def user_from_object(obj):
-    u = model.User()
-    u.id = obj['id']
-    u.nick = obj['screen_name']
-    return u
+def insert_media_stmt():
+    return model.Media.__table__.insert().prefix_with('OR IGNORE')
+
+def insert_tweet_media_stmt():
+    return model.TweetMedia.__table__.insert().prefix_with('OR IGNORE')
+
+def upsert_ingest_files_stmt():
+    table = model.IngestFile.__table__
+    stmt = sqlite.insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.path],
+        set_={c.name: stmt.excluded[c.name] for c in table.c if c.name != 'path'},
+    )
 
 @attr.s(slots=True, auto_attribs=True)
-class Context:
-    db: typing.Any
-    tweets_by_id: set = attr.Factory(dict)
-    user_ids: set = attr.Factory(set)
-    new_tweet_count: int = 0
-    new_user_count: int = 0
+class CompiledInsert:
+    """
+    A statement compiled once up front such that batches of rows can
+    be handed directly to the driver as tuples, bypassing the per-row
+    parameter processing done by ``Connection.execute``.
 
-def prepare_ctx(ctx):
-    ctx.tweets_by_id = {
-        tw.id: tw
-        for tw in (
-            ctx.db.query(model.Tweet)
-            .options(orm.load_only(
-                'id',
-                'updated_at',
-                'favorite_count',
-                'quote_count',
-                'reply_count',
-                'retweet_count',
-            ))
+    """
+    sql: str
+    getter: typing.Callable
+    processors: list
+
+    @classmethod
+    def from_stmt(cls, stmt, dialect):
+        table = stmt.table
+        compiled = stmt.compile(
+            dialect=dialect,
+            column_keys=[c.name for c in table.c],
+        )
+        processors = []
+        for idx, key in enumerate(compiled.positiontup):
+            type_ = table.c[key].type.dialect_impl(dialect)
+            processor = type_.bind_processor(dialect)
+            if processor is not None:
+                processor = functools.lru_cache(maxsize=65536)(processor)
+                processors.append((idx, processor))
+        return cls(
+            sql=compiled.string,
+            getter=operator.itemgetter(*compiled.positiontup),
+            processors=processors,
         )
-    }
-    log.debug(f'loaded {len(ctx.tweets_by_id)} tweet ids')
-    ctx.user_ids = {id for id, in ctx.db.query(model.User.id)}
-    log.debug(f'loaded {len(ctx.user_ids)} user ids')
 
-def add_tweet(ctx, tw):
-    prev_tw = ctx.tweets_by_id.get(tw.id)
-    if prev_tw is None:
-        ctx.tweets_by_id[tw.id] = tw
-        ctx.db.add(tw)
-        ctx.new_tweet_count += 1
-
-    elif tw.updated_at > prev_tw.updated_at:
-        prev_tw.updated_at = tw.updated_at
-        prev_tw.favorite_count = tw.favorite_count
-        prev_tw.quote_count = tw.quote_count
-        prev_tw.reply_count = tw.reply_count
-        prev_tw.retweet_count = tw.retweet_count
-        tw = prev_tw
-    return tw
-
-def add_user(ctx, u):
-    if u.id in ctx.user_ids:
-        return
-    ctx.user_ids.add(u.id)
-    ctx.db.add(u)
-    ctx.new_user_count += 1
-
-def add_tweets_from_status(ctx, msg, updated_at=None):
-    tw = tweet_from_object(msg, updated_at=updated_at)
-    add_tweet(ctx, tw)
-
-    u = user_from_object(msg['user'])
-    add_user(ctx, u)
+    def params(self, rows):
+        getter = self.getter
+        processors = self.processors
+        for row in rows:
+            values = list(getter(row))
+            for idx, processor in processors:
+                values[idx] = processor(values[idx])
+            yield tuple(values)
+
+    def execute(self, conn, rows):
+        return conn.exec_driver_sql(self.sql, list(self.params(rows)))
+
+def rows_from_status(msg, tweets, users, updated_at=None, objs=None):
+    tw = tweet_row_from_object(msg, updated_at=updated_at)
+    tweets.append(tw)
+    users.append(user_row_from_object(msg['user']))
+    if objs is not None:
+        objs.append(msg)
 
     # forward the updated_at value from the original tweet into recursive
     # additions such that the quote/retweet objects attached to this tweet
     # are updated with the new tweet's time since the quote/retweet objects
     # should be an updated version (so statistics reflect now versus their
     # created_at time)
-    if tw.quoted_tweet_id:
-        add_tweets_from_status(ctx, msg['quoted_status'], tw.updated_at)
+    if tw['quoted_tweet_id']:
+        rows_from_status(
+            msg['quoted_status'], tweets, users, tw['updated_at'], objs)
 
-    if tw.rt_tweet_id:
-        add_tweets_from_status(ctx, msg['retweeted_status'], tw.updated_at)
+    if tw['rt_tweet_id']:
+        rows_from_status(
+            msg['retweeted_status'], tweets, users, tw['updated_at'], objs)
 
-def main(cli, args):
-    db = cli.connect_db(args.db)
+@attr.s(slots=True, auto_attribs=True)
+class Batch:
+    tweets_by_id: dict = attr.Factory(dict)
+    users_by_id: dict = attr.Factory(dict)
+    # (hashtags, urls) of each tweet, see entities_from_object
+    entities_by_id: dict = attr.Factory(dict)
+    media_by_id: dict = attr.Factory(dict)
+    # (tweet_id, media_id) pairs
+    tweet_media: set = attr.Factory(set)
+    # every version of the statistics seen, see model.collapse_tweet_stats
+    tweet_stats: list = attr.Factory(list)
+    num_statuses: int = 0
 
-    ctx = Context(db=db)
-    prepare_ctx(ctx)
+    # (path, end_line, last) of the chunk this batch was parsed from
+    checkpoint: tuple = None
+
+def tweet_stats_row(tw):
+    row = dict(tweet_id=tw['id'], observed_at=tw['updated_at'])
+    for name in model.TWEET_STATS_COLUMNS:
+        row[name] = tw[name]
+    return row
+
+def add_tweet(batch, tw):
+    batch.tweet_stats.append(tweet_stats_row(tw))
+    prev_tw = batch.tweets_by_id.get(tw['id'])
+    if prev_tw is None:
+        batch.tweets_by_id[tw['id']] = tw
+
+    elif tw['updated_at'] > prev_tw['updated_at']:
+        for name in TWEET_STAT_COLUMNS:
+            prev_tw[name] = tw[name]
+
+def add_user(batch, u):
+    batch.users_by_id.setdefault(u['id'], u)
+
+def iter_chunks(items, chunk_size):
+    items = list(items)
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+def find_existing_ids(conn, table, ids):
+    existing_ids = set()
+    # stay below the default SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+    for chunk in iter_chunks(ids, 900):
+        existing_ids.update(
+            id for id, in conn.execute(
+                sa.select([table.c.id]).where(table.c.id.in_(chunk))
+            )
+        )
+    return existing_ids
+
+def add_status(batch, msg):
+    tweets, users, objs = [], [], []
+    rows_from_status(msg, tweets, users, objs=objs)
+    for tw, obj in zip(tweets, objs):
+        # the entities are part of the content, so only the first version
+        # seen of a tweet matters
+        if tw['id'] not in batch.entities_by_id:
+            batch.entities_by_id[tw['id']] = entities_from_object(obj)
+        for media in media_from_object(obj):
+            batch.media_by_id.setdefault(media['id'], media)
+            batch.tweet_media.add((tw['id'], media['id']))
+        add_tweet(batch, tw)
+    for u in users:
+        add_user(batch, u)
+    batch.num_statuses += 1
+
+def parse_lines(lines, *, min_id=None, max_id=None):
+    batch = Batch()
+    for line in lines:
+        try:
+            msg = json.loads(line)
+            if min_id is not None and msg['id'] < min_id:
+                continue
+            if max_id is not None and msg['id'] > max_id:
+                continue
+            add_status(batch, msg)
+        except Exception as ex:
+            log.error(f'failed parsing line={line}, error={ex}')
+    batch.tweet_stats = model.collapse_tweet_stats(batch.tweet_stats)
+    return batch
+
+def parse_chunk(chunk, **kw):
+    """
+    Parse a :class:`LineChunk` or :class:`FrameChunk` into a collapsed
+    :class:`Batch`.
+
+    This is run in worker processes when ingesting with multiple jobs.
+
+    """
+    batch = parse_lines(chunk.iter_lines(), **kw)
+    batch.checkpoint = (chunk.path, chunk.end_line, chunk.last)
+    return batch
+
+@attr.s(slots=True, auto_attribs=True)
+class BulkWriter:
+    """
+    Write collapsed batches of statuses to the database.
+
+    Nothing is loaded from the database up front. Instead, each batch is
+    collapsed in memory using the same rules as the database upsert and
+    then resolved against the existing rows by id, so memory use is bounded
+    by the batch size rather than by the size of the database.
+
+    The progress through each file in ``files`` is tracked from the batch
+    checkpoints and saved along with the rows on every commit.
+
+    """
+    db: typing.Any
+    commit_size: int = 100000
+    files: dict = attr.Factory(dict)
+    dirty_files: set = attr.Factory(set)
+    mirror: typing.Any = None
+    num_uncommitted_statuses: int = 0
+    new_tweet_count: int = 0
+    updated_tweet_count: int = 0
+    new_user_count: int = 0
+
+    tweets_stmt: typing.Any = None
+    users_stmt: typing.Any = None
+    hashtags_stmt: typing.Any = None
+    urls_stmt: typing.Any = None
+    media_stmt: typing.Any = None
+    tweet_media_stmt: typing.Any = None
+    tweet_stats_stmt: typing.Any = None
+    merge_tweet_stats_stmt: typing.Any = None
+    tweet_stats_cleanup_stmt: typing.Any = None
+
+    def write(self, batch):
+        if batch.tweets_by_id:
+            conn = self.db.connection()
+            if self.tweets_stmt is None:
+                self.tweets_stmt = CompiledInsert.from_stmt(
+                    upsert_tweets_stmt(), conn.dialect)
+                self.users_stmt = CompiledInsert.from_stmt(
+                    insert_users_stmt(), conn.dialect)
+                self.hashtags_stmt = CompiledInsert.from_stmt(
+                    insert_hashtags_stmt(), conn.dialect)
+                self.urls_stmt = CompiledInsert.from_stmt(
+                    insert_urls_stmt(), conn.dialect)
+                self.media_stmt = CompiledInsert.from_stmt(
+                    insert_media_stmt(), conn.dialect)
+                self.tweet_media_stmt = CompiledInsert.from_stmt(
+                    insert_tweet_media_stmt(), conn.dialect)
+                self.tweet_stats_stmt = CompiledInsert.from_stmt(
+                    model.append_tweet_stats_stmt(), conn.dialect)
+                self.merge_tweet_stats_stmt = CompiledInsert.from_stmt(
+                    model.insert_tweet_stats_stmt(), conn.dialect)
+                self.tweet_stats_cleanup_stmt = CompiledInsert.from_stmt(
+                    model.delete_redundant_tweet_stats_stmt(), conn.dialect)
+
+            existing_ids = find_existing_ids(
+                conn, model.Tweet.__table__, batch.tweets_by_id.keys())
+            new_tweet_count = len(batch.tweets_by_id) - len(existing_ids)
+            if self.mirror is not None:
+                self.mirror.add(
+                    dict(tw, hashtags=sorted(batch.entities_by_id[id][0]))
+                    for id, tw in batch.tweets_by_id.items()
+                    if id not in existing_ids
+                )
+            result = self.tweets_stmt.execute(
+                conn, batch.tweets_by_id.values())
+            self.new_tweet_count += new_tweet_count
+            self.updated_tweet_count += result.rowcount - new_tweet_count
+            # the history keeps every version, even those older than the
+            # statistics already stored on the tweet, and files may be
+            # ingested in any order
+            appended, merged = model.split_tweet_stats(
+                conn, batch.tweet_stats)
+            if appended:
+                self.tweet_stats_stmt.execute(conn, appended)
+            if merged:
+                self.merge_tweet_stats_stmt.execute(conn, merged)
+                self.tweet_stats_cleanup_stmt.execute(conn, merged)
+
+            result = self.users_stmt.execute(conn, batch.users_by_id.values())
+            self.new_user_count += result.rowcount
+
+            hashtags, urls = [], []
+            for id, (tweet_hashtags, tweet_urls) in batch.entities_by_id.items():
+                if id in existing_ids:
+                    continue
+                hashtags.extend(
+                    dict(tag=tag, tweet_id=id)
+                    for tag in tweet_hashtags
+                )
+                urls.extend(
+                    dict(tweet_id=id, url=url, rev_host=model.reverse_host(url))
+                    for url in tweet_urls
+                )
+            if hashtags:
+                self.hashtags_stmt.execute(conn, hashtags)
+            if urls:
+                self.urls_stmt.execute(conn, urls)
+
+            # media are shared by every tweet quoting or retweeting them and
+            # only stored once, the inserts are idempotent so unlike the
+            # other entities they are written for existing tweets as well,
+            # letting a forced ingest fill them in for older databases
+            if batch.media_by_id:
+                self.media_stmt.execute(conn, batch.media_by_id.values())
+                self.tweet_media_stmt.execute(conn, [
+                    dict(tweet_id=tweet_id, media_id=media_id)
+                    for tweet_id, media_id in batch.tweet_media
+                ])
+
+            # the plot terms are loaded only after writing the tweets, when
+            # this transaction holds the write lock, so a term added by
+            # report:plot either counted these tweets already or is seen here
+            # sorted such that each chunk spans the narrowest range of ids
+            new_ids = sorted(
+                id for id in batch.tweets_by_id if id not in existing_ids)
+            if new_ids:
+                for term in model.load_plot_terms(self.db):
+                    for chunk in iter_chunks(new_ids, 900):
+                        model.add_plot_bucket_counts(self.db, term, ids=chunk)
+
+        if batch.checkpoint is not None:
+            path, end_line, last = batch.checkpoint
+            state = self.files.get(path)
+            if state is not None:
+                state['lines'] = end_line
+                state['completed'] = last
+                self.dirty_files.add(path)
+
+        self.num_uncommitted_statuses += batch.num_statuses
+        if self.num_uncommitted_statuses >= self.commit_size:
+            self.commit()
+
+    def commit(self):
+        log.debug(f'committing {self.num_uncommitted_statuses} messages')
+        if self.dirty_files:
+            # the progress is committed in the same transaction as the rows
+            # such that a crash never records lines that were not written
+            now = datetime.utcnow()
+            self.db.connection().execute(upsert_ingest_files_stmt(), [
+                dict(self.files[path], updated_at=now)
+                for path in self.dirty_files
+            ])
+            self.dirty_files.clear()
+        if self.mirror is None:
+            self.db.commit()
+        else:
+            try:
+                self.mirror.prepare(self.db)
+                self.db.commit()
+            except Exception:
+                self.mirror.abort()
+                raise
+            self.mirror.commit()
+        self.num_uncommitted_statuses = 0
+
+@attr.s(slots=True, auto_attribs=True)
+class LineChunk:
+    lines: list
+    path: str = None
+    end_line: int = 0
+    last: bool = False
+
+    @property
+    def num_lines(self):
+        return len(self.lines)
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+@attr.s(slots=True, auto_attribs=True)
+class FrameChunk:
+    path: str
+    frames: list
+    dict_paths: tuple = ()
+    end_line: int = 0
+    last: bool = False
+
+    @property
+    def num_lines(self):
+        return sum(frame.lines for frame in self.frames)
+
+    def iter_lines(self):
+        unit = zstd.Unit(
+            path=self.path, frames=self.frames, dict_paths=self.dict_paths)
+        return unit.iter_lines()
+
+def iter_input_chunks(
+    cli,
+    paths,
+    chunk_size,
+    *,
+    min_id=None,
+    max_id=None,
+    dict_paths=(),
+    start_lines=None,
+):
+    """
+    Split the input files into chunks of roughly ``chunk_size`` lines.
+
+    Each chunk records the number of lines from the start of its file that
+    have been consumed once it is written and the last chunk of every file,
+    possibly empty, is marked with ``last``. Reading begins after the number
+    of lines in ``start_lines`` for a path, if any.
+
+    """
+    if start_lines is None:
+        start_lines = {}
+    dictionaries = zstd.load_dictionaries(dict_paths)
+    for path in paths:
+        start_line = start_lines.get(path, 0)
+        if start_line:
+            log.info(f'resuming file={path} after line={start_line}')
+
+        frames = zstd.read_index(path) if path != '-' else None
+        if frames is not None:
+            # indexed archives are split by frame, skipping any frames that
+            # cannot contain the requested ids, and decompressed by the
+            # worker that parses them
+            log.debug(f'reading indexed file={path}')
+            # a frame straddling the start line is read again, which is
+            # harmless as rewriting the same tweets does not change them
+            for group, end_line, last in zstd.iter_frame_groups(
+                frames,
+                chunk_size,
+                min_id=min_id,
+                max_id=max_id,
+                start_line=start_line,
+            ):
+                yield FrameChunk(
+                    path=path,
+                    frames=group,
+                    dict_paths=dict_paths,
+                    end_line=end_line,
+                    last=last,
+                )
+            continue
 
-    total_messages = 0
-    for path in args.input_files:
         log.debug(f'reading file={path}')
         with cli.input_file(path, text=False) as fp:
-            for line in zstd.iter_lines(fp):
-                total_messages += 1
-                try:
-                    msg = json.loads(line)
-                    add_tweets_from_status(ctx, msg)
-                except Exception as ex:
-                    breakpoint()
-                    log.error(f'failed parsing line={line}, error={ex}')
-                    continue
+            line_no = start_line
+            skip = start_line
+            chunk = LineChunk(lines=[], path=path)
+            for lines in zstd.iter_line_batches(fp, dictionaries=dictionaries):
+                # skip the committed lines without parsing them
+                if skip:
+                    skipped = min(skip, len(lines))
+                    lines = lines[skipped:]
+                    skip -= skipped
+                # chunks are filled from whole batches of lines, only split
+                # where a chunk reaches its size
+                pos = 0
+                while pos < len(lines):
+                    end = pos + chunk_size - chunk.num_lines
+                    chunk.lines.extend(lines[pos:end])
+                    pos = end
+                    if chunk.num_lines >= chunk_size:
+                        line_no += chunk.num_lines
+                        chunk.end_line = line_no
+                        yield chunk
+                        chunk = LineChunk(lines=[], path=path)
+            line_no += chunk.num_lines
+            chunk.end_line = line_no
+            chunk.last = True
+            yield chunk
+
+FINGERPRINT_SAMPLE_SIZE = 1 << 20
+
+def file_fingerprint(path, size):
+    """
+    Hash the size along with the first and last megabyte of a file.
+
+    Archives are not modified once they are finalized so this is enough to
+    notice a file being replaced without reading the whole thing.
+
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode('ascii'))
+    with open(path, 'rb') as fp:
+        h.update(fp.read(FINGERPRINT_SAMPLE_SIZE))
+        if size > FINGERPRINT_SAMPLE_SIZE:
+            fp.seek(max(FINGERPRINT_SAMPLE_SIZE, size - FINGERPRINT_SAMPLE_SIZE))
+            h.update(fp.read())
+    return h.hexdigest()
+
+def id_range_covers(outer_min_id, outer_max_id, min_id, max_id):
+    if outer_min_id is not None and (min_id is None or min_id < outer_min_id):
+        return False
+    if outer_max_id is not None and (max_id is None or max_id > outer_max_id):
+        return False
+    return True
+
+def load_ingest_state(db, paths, *, min_id=None, max_id=None, resume=True):
+    """
+    Return the ``ingest_file`` state for each of the files in ``paths``.
+
+    Previously recorded progress is kept only if the file is unchanged and
+    was ingested with an id range covering ``min_id`` to ``max_id``,
+    otherwise the file is read again from the start.
+
+    """
+    table = model.IngestFile.__table__
+    keys = {path: os.path.abspath(path) for path in paths if path != '-'}
+    prev_states = {}
+    if resume:
+        conn = db.connection()
+        for chunk in iter_chunks(set(keys.values()), 900):
+            prev_states.update(
+                (row.path, row) for row in conn.execute(
+                    sa.select([table]).where(table.c.path.in_(chunk))
+                )
+            )
+
+    states = {}
+    for path, key in keys.items():
+        size = os.path.getsize(path)
+        state = dict(
+            path=key,
+            size=size,
+            fingerprint=file_fingerprint(path, size),
+            min_id=min_id,
+            max_id=max_id,
+            lines=0,
+            completed=False,
+        )
+        prev = prev_states.get(key)
+        if (
+            prev is not None
+            and prev.size == state['size']
+            and prev.fingerprint == state['fingerprint']
+            and id_range_covers(prev.min_id, prev.max_id, min_id, max_id)
+        ):
+            state['lines'] = prev.lines
+            state['completed'] = prev.completed
+        states[path] = state
+    return states
+
+def peak_memory_usage():
+    """
+    Return the peak resident set size of this process in bytes.
+
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes while macos reports bytes
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+    return maxrss
+
+def ingest_files(
+    cli,
+    db,
+    paths,
+    *,
+    batch_size=10000,
+    commit_size=100000,
+    jobs=1,
+    min_id=None,
+    max_id=None,
+    dict_paths=(),
+    force=False,
+    mirror_path=None,
+):
+    """
+    Ingest ``paths`` into ``db``, skipping or resuming files based on their
+    recorded state, and commit the result.
+
+    New tweets are also appended to the columnar mirror at ``mirror_path``,
+    if any.
+
+    Returns the :class:`BulkWriter` holding the counts of changed rows.
+
+    """
+    paths = list(dict.fromkeys(paths))
+    files = load_ingest_state(
+        db, paths, min_id=min_id, max_id=max_id, resume=not force)
+    start_lines = {}
+    pending_paths = []
+    for path in paths:
+        state = files.get(path)
+        if state is not None:
+            if state['completed']:
+                log.debug(f'skipping previously ingested file={path}')
+                continue
+            start_lines[path] = state['lines']
+        pending_paths.append(path)
+    if len(pending_paths) < len(paths):
+        log.info(
+            f'skipped {len(paths) - len(pending_paths)} previously '
+            f'ingested files')
+
+    mirror = None
+    if mirror_path is not None:
+        from . import columnar
+
+        mirror = columnar.MirrorWriter(mirror_path)
+        mirror.catch_up(db)
+    writer = BulkWriter(
+        db=db, commit_size=commit_size, files=files, mirror=mirror)
+
+    total_messages = 0
+    def chunks():
+        nonlocal total_messages
+        for chunk in iter_input_chunks(
+            cli,
+            pending_paths,
+            batch_size,
+            min_id=min_id,
+            max_id=max_id,
+            dict_paths=dict_paths,
+            start_lines=start_lines,
+        ):
+            total_messages += chunk.num_lines
+            yield chunk
+
+    parse = functools.partial(parse_chunk, min_id=min_id, max_id=max_id)
+    with ExitStack() as stack:
+        if jobs > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(max_workers=jobs))
+            batches = imap_ordered(
+                executor, parse, chunks(), max_pending=2 * jobs)
+        else:
+            batches = map(parse, chunks())
+
+        # batches are written in the order they were read such that the
+        # result is identical to a sequential ingest
+        for batch in batches:
+            writer.write(batch)
+    writer.commit()
 
     log.debug(f'processed {total_messages} messages')
-    log.info(f'added {ctx.new_tweet_count} tweets')
-    log.info(f'added {ctx.new_user_count} users')
+    return writer
+
+def find_mirror(db_path):
+    path = model.mirror_path_for(db_path)
+    if os.path.isdir(path):
+        return path
+
+def main(cli, args):
+    db = cli.connect_db(args.db)
+
+    min_id, max_id = args.min_id, args.max_id
+    if args.since is not None:
+        since_id = zstd.datetime_to_snowflake(args.since)
+        min_id = since_id if min_id is None else max(min_id, since_id)
+    if args.until is not None:
+        until_id = zstd.datetime_to_snowflake(args.until) - 1
+        max_id = until_id if max_id is None else min(max_id, until_id)
+
+    writer = ingest_files(
+        cli,
+        db,
+        args.input_files,
+        batch_size=args.batch_size,
+        commit_size=args.commit_size,
+        jobs=args.jobs,
+        min_id=min_id,
+        max_id=max_id,
+        dict_paths=tuple(args.dict or ()),
+        force=args.force,
+        mirror_path=find_mirror(args.db),
+    )
+
+    log.info(f'added {writer.new_tweet_count} tweets')
+    log.info(f'updated {writer.updated_tweet_count} tweets')
+    log.info(f'added {writer.new_user_count} users')
+    log.info(f'peak memory usage {peak_memory_usage() / 2**20:.1f} MiB')
@@ -1,47 +1,391 @@
-import csv
+import attr
+import collections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+import hashlib
+import json
 import logging
 import os
+import posixpath
 import re
 import requests
-from sqlalchemy import orm
+import sqlalchemy as sa
+from sqlalchemy.dialects import sqlite
+import threading
+import time
+import typing
+import urllib.parse
+import uuid
 
 from . import model
 
 log = logging.getLogger(__name__)
 
+# the sizes twimg serves photos in, see photo_url
+PHOTO_SIZES = ('orig', 'large', 'medium', 'small', 'thumb')
+
+# responses worth retrying after a backoff, any other error is final
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+CHUNK_SIZE = 65536
+
+EXTENSION_RE = re.compile(r'\.[a-z0-9]{1,5}')
+
+class IncompleteDownload(requests.RequestException):
+    pass
+
+def url_extension(url):
+    parts = urllib.parse.urlsplit(url)
+    # twimg photo urls give the format as a parameter, "?format=jpg", or
+    # carry a size suffix, "/media/abc.jpg:large"
+    format = urllib.parse.parse_qs(parts.query).get('format')
+    if format:
+        ext = '.' + format[0].lower()
+    else:
+        ext = posixpath.splitext(parts.path)[1].split(':', 1)[0].lower()
+    return ext if EXTENSION_RE.fullmatch(ext) else ''
+
+def media_path(sha256, ext=''):
+    # two levels of 256 directories keep each directory small
+    return posixpath.join(sha256[:2], sha256[2:4], sha256 + ext)
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def photo_url(url, size='orig'):
+    """
+    Return the url of a twimg photo, ``media_url`` from its entity, in one
+    of the :data:`PHOTO_SIZES`.
+
+    """
+    base, ext = posixpath.splitext(url)
+    return f'{base}?format={ext[1:]}&name={size}'
+
+def video_url(variants, max_bitrate=None):
+    """
+    Return the url of the mp4 variant of a video with the highest bitrate,
+    up to ``max_bitrate`` if possible.
+
+    """
+    variants = [
+        v for v in variants
+        if v.get('content_type') == 'video/mp4' and v.get('url')
+    ]
+    if not variants:
+        return None
+    variants.sort(key=lambda v: v.get('bitrate', 0))
+    if max_bitrate is not None:
+        allowed = [v for v in variants if v.get('bitrate', 0) <= max_bitrate]
+        # the smallest one is still better than nothing
+        variants = allowed or variants[:1]
+    return variants[-1]['url']
+
+def media_download_url(media, *, photo_size='orig', max_bitrate=None):
+    if media.variants:
+        url = video_url(json.loads(media.variants), max_bitrate=max_bitrate)
+        if url is not None:
+            return url
+        # fall back to the still image shown before playing
+        log.warning(f'no mp4 variant found for media={media.id}')
+    return photo_url(media.url, photo_size)
+
+def is_retryable(ex):
+    if isinstance(ex, requests.HTTPError):
+        return ex.response is not None and (
+            ex.response.status_code in RETRY_STATUSES)
+    return isinstance(ex, (
+        requests.ConnectionError,
+        requests.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+        IncompleteDownload,
+    ))
+
+def retry_after(ex):
+    if not isinstance(ex, requests.HTTPError) or ex.response is None:
+        return None
+    try:
+        return float(ex.response.headers.get('Retry-After', ''))
+    except ValueError:
+        return None
+
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+@attr.s(auto_attribs=True)
+class Downloader:
+    """
+    Download urls into a content addressed store under ``root``.
+
+    Safe to call from many threads at once, they share the connection pool
+    of ``session`` while at most ``per_host`` requests are made to the same
+    host at a time.
+
+    """
+    root: str
+    session: typing.Any
+    per_host: int = 4
+    timeout: float = 30
+    retries: int = 3
+    backoff: float = 1.0
+    host_limits: dict = attr.Factory(dict)
+    lock: typing.Any = attr.Factory(threading.Lock)
+
+    def host_limit(self, url):
+        host = urllib.parse.urlsplit(url).hostname or ''
+        with self.lock:
+            limit = self.host_limits.get(host)
+            if limit is None:
+                limit = self.host_limits[host] = threading.BoundedSemaphore(
+                    self.per_host)
+        return limit
+
+    def download(self, url, media_id=None):
+        """
+        Download ``url``, retrying transient errors with an exponential
+        backoff.
+
+        Returns a row for :class:`tweeter.model.MediaDownload`, errors are
+        recorded in the row rather than raised.
+
+        """
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                with self.host_limit(url):
+                    row = self.fetch(url)
+                row.update(
+                    url=url, media_id=media_id, status='ok', attempts=attempts)
+                return row
+
+            except requests.RequestException as ex:
+                if attempts <= self.retries and is_retryable(ex):
+                    delay = retry_after(ex)
+                    if delay is None:
+                        delay = self.backoff * 2 ** (attempts - 1)
+                    log.debug(
+                        f'retrying url={url} in {delay}s after error={ex}')
+                    time.sleep(delay)
+                    continue
+
+                log.warning(f'failed to download url={url}, error={ex}')
+                response = getattr(ex, 'response', None)
+                return dict(
+                    url=url,
+                    media_id=media_id,
+                    status='failed',
+                    http_status=(
+                        response.status_code if response is not None else None
+                    ),
+                    error=str(ex),
+                    attempts=attempts,
+                )
+
+            # anything else, such as failing to write or move the file or a
+            # malformed response, is recorded the same way but not retried
+            except Exception as ex:
+                log.warning(f'failed to download url={url}, error={ex!r}')
+                return dict(
+                    url=url,
+                    media_id=media_id,
+                    status='failed',
+                    error=repr(ex),
+                    attempts=attempts,
+                )
+
+    def fetch(self, url):
+        tmp_path = os.path.join(self.root, '.tmp', uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        size = 0
+        with self.session.get(url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            try:
+                # the body is hashed as it is written so it never has to be
+                # held in memory or read back
+                with open(tmp_path, 'wb') as fp:
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        digest.update(chunk)
+                        fp.write(chunk)
+                        size += len(chunk)
+                expected_size = r.headers.get('Content-Length')
+                if (
+                    expected_size is not None
+                    and 'Content-Encoding' not in r.headers
+                    and int(expected_size) != size
+                ):
+                    raise IncompleteDownload(
+                        f'received {size} of {expected_size} bytes')
+            except BaseException:
+                remove_file(tmp_path)
+                raise
+
+        sha256 = digest.hexdigest()
+        path = media_path(sha256, url_extension(url))
+        full_path = os.path.join(self.root, path)
+        try:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            # identical content from another url is simply replaced
+            os.replace(tmp_path, full_path)
+        except OSError:
+            remove_file(tmp_path)
+            raise
+        return dict(
+            http_status=r.status_code,
+            path=path,
+            sha256=sha256,
+            size=size,
+            content_type=r.headers.get('Content-Type'),
+        )
+
+def upsert_media_downloads_stmt():
+    table = model.MediaDownload.__table__
+    stmt = sqlite.insert(table)
+    set_ = {
+        c.name: stmt.excluded[c.name]
+        for c in table.c
+        if c.name not in ('url', 'attempts')
+    }
+    set_['attempts'] = table.c.attempts + stmt.excluded.attempts
+    return stmt.on_conflict_do_update(index_elements=[table.c.url], set_=set_)
+
+def iter_pending_media(db, *, retry_failed=False, page_size=1000):
+    """
+    Yield pages of the media that have not been downloaded yet.
+
+    """
+    media = model.Media.__table__
+    downloads = model.MediaDownload.__table__
+    downloaded = sa.exists().where(downloads.c.media_id == media.c.id)
+    if retry_failed:
+        downloaded = downloaded.where(downloads.c.status == 'ok')
+    q = (
+        sa.select([media])
+        .where(~downloaded)
+        .order_by(media.c.id)
+        .limit(page_size)
+    )
+
+    page = db.connection().execute(q).all()
+    while page:
+        yield page
+        page = db.connection().execute(
+            q.where(media.c.id > page[-1].id)).all()
+
+def iter_pending_urls(db, domain, *, retry_failed=False, page_size=1000):
+    """
+    Yield pages of the urls on ``domain``, or any of its subdomains, that
+    have not been downloaded yet and do not belong to any known media.
+
+    The urls are paged through in the order of the index on
+    :attr:`tweeter.model.TweetUrl.rev_host`, so the database may be written
+    between pages.
+
+    """
+    urls = model.TweetUrl.__table__
+    media = model.Media.__table__
+    downloads = model.MediaDownload.__table__
+    low, high = model.rev_host_range(domain)
+    key = sa.tuple_(urls.c.rev_host, urls.c.tweet_id, urls.c.url)
+    pending = downloads.c.status.is_(None)
+    if retry_failed:
+        pending = sa.or_(pending, downloads.c.status != 'ok')
+    q = (
+        sa.select([urls.c.rev_host, urls.c.tweet_id, urls.c.url])
+        .select_from(
+            urls.outerjoin(downloads, downloads.c.url == urls.c.url))
+        .where(urls.c.rev_host < high)
+        .where(pending)
+        .where(~sa.exists().where(media.c.url == urls.c.url))
+        .order_by(urls.c.rev_host, urls.c.tweet_id, urls.c.url)
+        .limit(page_size)
+    )
+
+    page = db.connection().execute(q.where(urls.c.rev_host >= low)).all()
+    while page:
+        yield [url for _, _, url in page]
+        page = db.connection().execute(
+            q.where(key > sa.tuple_(*page[-1]))).all()
 
 def main_download(cli, args):
-    profile = cli.profile
-    dbmaker = model.connect(args.db, pool=True)
-    db = dbmaker()
+    db = cli.connect_db(args.db)
+    os.makedirs(os.path.join(args.output_dir, '.tmp'), exist_ok=True)
+
+    downloader = Downloader(
+        root=args.output_dir,
+        session=make_session(args.per_host),
+        per_host=args.per_host,
+        timeout=args.timeout,
+        retries=args.retries,
+    )
+    stmt = upsert_media_downloads_stmt()
+    columns = model.MediaDownload.__table__.c.keys()
+    counts = collections.Counter()
 
-    img_re = re.compile(r'(?P<link>https?://(?:\S+\.)?twimg\.com/\S+)', re.IGNORECASE)
+    def record(futures):
+        now = datetime.utcnow()
+        # every row needs the same keys, succeeded and failed alike
+        rows = [
+            dict(dict.fromkeys(columns), **f.result(), updated_at=now)
+            for f in futures
+        ]
+        if rows:
+            db.connection().execute(stmt, rows)
+        counts.update(row['status'] for row in rows)
 
-    with open('media.csv', 'w') as fp:
-        writer = csv.writer(fp)
-        writer.writerow(['tweet id', 'name', 'url', 'error'])
+    def iter_pending():
+        # media are downloaded once no matter how many tweets share them,
+        # in the variant chosen by the options
+        for page in iter_pending_media(db, retry_failed=args.retry_failed):
+            yield [
+                (
+                    media_download_url(
+                        media,
+                        photo_size=args.photo_size,
+                        max_bitrate=args.max_bitrate,
+                    ),
+                    media.id,
+                )
+                for media in page
+            ]
 
-        for tweet in (
-            db.query(model.Tweet)
-            .execution_options(stream_results=True, max_row_buffer=1000)
-            .filter(model.Tweet.text.ilike('%http%.twimg.com/%'))
+        # followed by any other urls, such as those of tweets ingested
+        # before media were recorded
+        for urls in iter_pending_urls(
+            db, args.domain, retry_failed=args.retry_failed,
         ):
-            for url in img_re.findall(tweet.text):
-                _, name = url.rsplit('/', 1)
-                if os.path.exists(name):
-                    log.debug(f'already have file={name}, skipping')
+            yield [(url, None) for url in urls]
+
+    # a url shared by several tweets is only downloaded once per run
+    seen_urls = set()
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = set()
+        for page in iter_pending():
+            for url, media_id in page:
+                if url in seen_urls:
                     continue
-                error = try_download_media(tweet, url, name)
-                writer.writerow([tweet.id, name, url, error or ''])
+                seen_urls.add(url)
+                futures.add(
+                    executor.submit(downloader.download, url, media_id))
+                # keep the queue short so results are recorded as they
+                # complete rather than all at the end
+                if len(futures) >= args.jobs * 4:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    record(done)
+            db.commit()
+            log.info(
+                f'downloaded {counts["ok"]} files, '
+                f'{counts["failed"]} failed'
+            )
 
+        done, _ = wait(futures)
+        record(done)
+        db.commit()
 
-def try_download_media(tweet, url, path):
-    print(url)
-    try:
-        r = requests.get(url)
-        r.raise_for_status()
-    except Exception as ex:
-        log.exception(f'failed to download url={url} for tweet={tweet.id}')
-        return str(ex)
-    with open(path, 'wb') as fp:
-        fp.write(r.content)
+    log.info(f'downloaded {counts["ok"]} files, {counts["failed"]} failed')
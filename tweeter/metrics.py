@@ -0,0 +1,179 @@
+import bisect
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+
+log = __import__('logging').getLogger(__name__)
+
+# upper bounds, in seconds, for the per-record write latency histogram
+WRITE_LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0,
+)
+
+class Histogram:
+    """
+    A fixed-bucket histogram.
+
+    The buckets are allocated up front so observing a value only increments
+    existing counters.
+
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.sum}')
+        lines.append(f'{name}_count {self.count}')
+        return lines
+
+class StreamMetrics:
+    """
+    Counters and gauges describing the health of ``api:stream``.
+
+    Everything updated per record is a plain attribute or a preallocated
+    histogram bucket, the formatting cost is only paid when rendering.
+
+    """
+    def __init__(self):
+        self.started_at = time.time()
+        self.records_received = 0
+        self.bytes_received = 0
+        self.records_written = 0
+        self.bytes_written = 0
+        self.compressed_bytes_written = 0
+        self.records_blocked = 0
+        self.records_dropped = 0
+        self.write_errors = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.keep_alives = 0
+        self.last_message_at = None
+        self.last_keep_alive_at = None
+        self.last_keep_alive_gap = 0.0
+        self.max_queue_depth = 0
+        self.queue_depth = 0
+        self.current_file_bytes = 0
+        self.records_per_second = 0.0
+        self.write_latency = Histogram(WRITE_LATENCY_BUCKETS)
+
+    def render(self):
+        now = time.time()
+        ratio = 0.0
+        if self.compressed_bytes_written:
+            ratio = self.bytes_written / self.compressed_bytes_written
+        last_message_age = 0.0
+        if self.last_message_at is not None:
+            last_message_age = (
+                datetime.utcnow() - self.last_message_at
+            ).total_seconds()
+
+        lines = []
+        def metric(name, type, help, value):
+            name = f'tweeter_stream_{name}'
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {type}')
+            lines.append(f'{name} {value}')
+
+        metric('uptime_seconds', 'gauge', 'Seconds since the listener started.',
+               now - self.started_at)
+        metric('records_received_total', 'counter',
+               'Records received from twitter.', self.records_received)
+        metric('bytes_received_total', 'counter',
+               'Bytes received from twitter.', self.bytes_received)
+        metric('records_per_second', 'gauge',
+               'Records received per second over the last report interval.',
+               self.records_per_second)
+        metric('records_written_total', 'counter',
+               'Records written to disk.', self.records_written)
+        metric('bytes_written_total', 'counter',
+               'Uncompressed bytes written to disk.', self.bytes_written)
+        metric('compressed_bytes_written_total', 'counter',
+               'Compressed bytes written to disk.',
+               self.compressed_bytes_written)
+        metric('compression_ratio', 'gauge',
+               'Uncompressed bytes per compressed byte written.', ratio)
+        metric('records_blocked_total', 'counter',
+               'Records that waited for space in the writer queue.',
+               self.records_blocked)
+        metric('records_dropped_total', 'counter',
+               'Records dropped because the writer queue was full.',
+               self.records_dropped)
+        metric('write_errors_total', 'counter',
+               'Errors writing or closing output files.', self.write_errors)
+        metric('queue_depth', 'gauge',
+               'Records waiting in the writer queue.', self.queue_depth)
+        metric('max_queue_depth', 'gauge',
+               'Largest writer queue depth since the last report.',
+               self.max_queue_depth)
+        metric('current_file_bytes', 'gauge',
+               'Compressed size of the file being written.',
+               self.current_file_bytes)
+        metric('connects_total', 'counter',
+               'Connections established to twitter.', self.connects)
+        metric('disconnects_total', 'counter',
+               'Disconnects from twitter.', self.disconnects)
+        metric('keep_alives_total', 'counter',
+               'Keep-alive messages received.', self.keep_alives)
+        metric('last_keep_alive_gap_seconds', 'gauge',
+               'Seconds between the two most recent keep-alive messages.',
+               self.last_keep_alive_gap)
+        metric('last_message_age_seconds', 'gauge',
+               'Seconds since any record or keep-alive was received.',
+               last_message_age)
+
+        name = 'tweeter_stream_write_latency_seconds'
+        lines.append(f'# HELP {name} Seconds spent compressing and writing '
+                     f'each record.')
+        lines.append(f'# TYPE {name} histogram')
+        lines.extend(self.write_latency.render(name))
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as fp:
+            fp.write(self.render())
+        os.replace(tmp_path, path)
+
+def serve(metrics, *, port, host='127.0.0.1'):
+    """
+    Serve ``metrics`` in the prometheus text format from a daemon thread.
+
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(
+        target=server.serve_forever,
+        name='metrics',
+        daemon=True,
+    )
+    thread.start()
+    log.info(f'serving metrics on http://{host}:{port}/')
+    return server
@@ -1,4 +1,10 @@
+import functools
+import math
+import os
+import re
 import sqlalchemy as sa
+import sqlite3
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import orm
 from sqlalchemy.schema import (
@@ -8,6 +14,8 @@ from sqlalchemy.types import (
     DateTime,
     BigInteger,
     Boolean,
+    Float,
+    Integer,
     Text,
 )
 
@@ -47,25 +55,748 @@ class Tweet(Base):
     retweet_count = Column(BigInteger())
     favorite_count = Column(BigInteger())
 
+class TweetStats(Base):
+    __tablename__ = 'tweet_stats'
+    __table_args__ = dict(sqlite_with_rowid=False)
+
+    # every distinct set of statistics seen for a tweet, the tweet table
+    # only holds the latest
+    tweet_id = Column(BigInteger(), primary_key=True)
+    observed_at = Column(DateTime(), primary_key=True)
+    favorite_count = Column(BigInteger())
+    retweet_count = Column(BigInteger())
+    reply_count = Column(BigInteger())
+    quote_count = Column(BigInteger())
+
 class User(Base):
     __tablename__ = 'user'
 
     id = Column(BigInteger(), primary_key=True)
     nick = Column(Text(), nullable=False)
 
-def connect(path, *, migrate=True, pool=False):
-    log.debug('opening database at path=%s', path)
-    engine = sa.create_engine('sqlite:///' + path)
-    engine.execute('PRAGMA foreign_keys=ON')
-    if migrate:
+class UnavailableTweet(Base):
+    __tablename__ = 'unavailable_tweet'
+
+    # tweets that could not be looked up by api:update, because they were
+    # deleted or their author is protected or suspended
+    tweet_id = Column(BigInteger(), primary_key=True)
+    checked_at = Column(DateTime(), nullable=False)
+
+class TweetRefresh(Base):
+    __tablename__ = 'tweet_refresh'
+
+    # when api:update last looked up the tweet and the engagement, retweets
+    # plus favorites, it gained per hour since the lookup before
+    tweet_id = Column(BigInteger(), primary_key=True)
+    checked_at = Column(DateTime(), nullable=False)
+    engagement = Column(BigInteger(), nullable=False)
+    engagement_rate = Column(Float(), nullable=False)
+
+    # seconds until the next lookup, growing while the tweet stays quiet
+    interval = Column(BigInteger(), nullable=False)
+    next_refresh_at = Column(DateTime(), nullable=False, index=True)
+
+class IngestFile(Base):
+    __tablename__ = 'ingest_file'
+
+    path = Column(Text(), primary_key=True)
+    size = Column(BigInteger(), nullable=False)
+    fingerprint = Column(Text(), nullable=False)
+
+    # the id range requested when the file was ingested, null is unbounded
+    min_id = Column(BigInteger())
+    max_id = Column(BigInteger())
+
+    # number of lines from the start of the file that have been committed
+    lines = Column(BigInteger(), nullable=False)
+    completed = Column(Boolean, nullable=False)
+    updated_at = Column(DateTime(), nullable=False)
+
+class TweetHashtag(Base):
+    __tablename__ = 'tweet_hashtag'
+    __table_args__ = dict(sqlite_with_rowid=False)
+
+    # lowercased and without the leading "#"
+    tag = Column(Text(), primary_key=True)
+    tweet_id = Column(BigInteger(), primary_key=True, index=True)
+
+class TweetUrl(Base):
+    __tablename__ = 'tweet_url'
+    __table_args__ = dict(sqlite_with_rowid=False)
+
+    tweet_id = Column(BigInteger(), primary_key=True)
+    url = Column(Text(), primary_key=True)
+
+    # the host with its labels reversed, "com.twimg.pbs.", such that every
+    # subdomain of a domain can be found with a range scan
+    rev_host = Column(Text(), nullable=False, index=True)
+
+class Media(Base):
+    __tablename__ = 'media'
+
+    id = Column(BigInteger(), primary_key=True)
+    # photo, video or animated_gif
+    type = Column(Text(), nullable=False)
+    # the media_url of the entity, the same url is found in tweet_url
+    url = Column(Text(), nullable=False, index=True)
+    # json list of the video variants, null for photos
+    variants = Column(Text())
+
+class TweetMedia(Base):
+    __tablename__ = 'tweet_media'
+    __table_args__ = dict(sqlite_with_rowid=False)
+
+    tweet_id = Column(BigInteger(), primary_key=True)
+    media_id = Column(BigInteger(), primary_key=True, index=True)
+
+class MediaDownload(Base):
+    __tablename__ = 'media_download'
+
+    url = Column(Text(), primary_key=True)
+    # the media the url was chosen for, null for other urls
+    media_id = Column(BigInteger(), index=True)
+    # "ok" or "failed"
+    status = Column(Text(), nullable=False)
+    http_status = Column(Integer())
+    # relative to the media directory, named by the sha256 of the content
+    path = Column(Text())
+    sha256 = Column(Text())
+    size = Column(BigInteger())
+    content_type = Column(Text())
+    error = Column(Text())
+    attempts = Column(Integer(), nullable=False)
+    updated_at = Column(DateTime(), nullable=False)
+
+class PlotTerm(Base):
+    __tablename__ = 'plot_term'
+
+    # normalized by normalize_term
+    term = Column(Text(), primary_key=True)
+    created_at = Column(DateTime(), nullable=False)
+
+class PlotBucket(Base):
+    __tablename__ = 'plot_bucket'
+    __table_args__ = dict(sqlite_with_rowid=False)
+
+    # the number of tweets matching each plot term created in the hour
+    # starting at bucket, kept up to date by ingest
+    term = Column(Text(), primary_key=True)
+    bucket = Column(DateTime(), primary_key=True)
+    is_retweet = Column(Boolean, primary_key=True)
+    is_reply = Column(Boolean, primary_key=True)
+    count = Column(BigInteger(), nullable=False)
+
+class MirrorState(Base):
+    __tablename__ = 'mirror_state'
+
+    # the highest rowid of the tweet table staged for the columnar mirror,
+    # committed in the same transaction as the tweets themselves
+    name = Column(Text(), primary_key=True)
+    max_rowid = Column(BigInteger(), nullable=False)
+    updated_at = Column(DateTime(), nullable=False)
+
+URL_HOST_RE = re.compile(r'[A-Za-z][A-Za-z0-9+.-]*://(?:[^/?#@]*@)?([^/?#:]*)')
+
+@functools.lru_cache(maxsize=65536)
+def reverse_hostname(host):
+    return '.'.join(reversed(host.lower().split('.'))) + '.'
+
+def reverse_host(url):
+    m = URL_HOST_RE.match(url)
+    return reverse_hostname(m.group(1) if m else '')
+
+def rev_host_range(domain):
+    """
+    Return the ``(low, high)`` bounds of :attr:`TweetUrl.rev_host` for urls
+    on ``domain`` or any of its subdomains.
+
+    """
+    prefix = '.'.join(reversed(domain.lower().split('.')))
+    # "/" sorts immediately after "."
+    return prefix + '.', prefix + '/'
+
+# the full text index on tweet.text is an external content table, it holds
+# only the index and is kept in sync with the tweet table by triggers
+FTS_DDL = (
+    """
+    CREATE VIRTUAL TABLE tweet_fts USING fts5(
+        text, content='tweet', content_rowid='id'
+    )
+    """,
+    """
+    CREATE TRIGGER tweet_fts_insert AFTER INSERT ON tweet BEGIN
+        INSERT INTO tweet_fts(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER tweet_fts_delete AFTER DELETE ON tweet BEGIN
+        INSERT INTO tweet_fts(tweet_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER tweet_fts_update AFTER UPDATE OF text ON tweet BEGIN
+        INSERT INTO tweet_fts(tweet_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+        INSERT INTO tweet_fts(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+)
+
+# used to backfill the entity tables from the text of existing tweets, new
+# tweets use the entities attached to the status instead
+HASHTAG_RE = re.compile(r'#(\w+)')
+URL_RE = re.compile(r'https?://\S+')
+
+def has_table(conn, name):
+    return conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+        (name,),
+    ).first() is not None
+
+def has_fts(conn):
+    return has_table(conn, 'tweet_fts')
+
+def add_column(conn, column):
+    table = column.table
+    type = column.type.compile(conn.dialect)
+    conn.exec_driver_sql(
+        f'ALTER TABLE {table.name} ADD COLUMN {column.name} {type}')
+    for index in table.indexes:
+        if column in index.columns.values():
+            index.create(conn)
+
+def normalize_term(term):
+    return term.strip().lower()
+
+def term_pattern(term):
+    """
+    Return a regex matching text containing ``term`` like
+    :func:`tweet_text_filter`, as a hashtag if it starts with "#" and
+    otherwise as a phrase of whole words. Match it ignoring case.
+
+    """
+    if term.startswith('#'):
+        return '#' + re.escape(term[1:]) + r'(?:\W|$)'
+    return r'(?:^|\W)' + re.escape(term) + r'(?:\W|$)'
+
+def tweet_text_filter(db, term, *, id_range=None):
+    """
+    Return a clause matching the tweets that contain ``term``.
+
+    A term starting with "#" matches that hashtag, ignoring case, using the
+    hashtag table. Anything else is matched as a phrase of whole words by
+    the full text index. Both fall back to a substring match, which has to
+    scan every tweet, on databases without the index.
+
+    An ``id_range`` of ``(low, high)`` limits the index search to the ids in
+    that range, which is much faster when only a few tweets are wanted.
+
+    """
+    conn = db.connection()
+    if term.startswith('#') and has_table(conn, 'tweet_hashtag'):
+        hashtags = TweetHashtag.__table__
+        q = (
+            sa.select([hashtags.c.tweet_id])
+            .where(hashtags.c.tag == term[1:].lower())
+        )
+        if id_range is not None:
+            q = q.where(hashtags.c.tweet_id.between(*id_range))
+        return Tweet.id.in_(q)
+
+    if not term.startswith('#') and has_fts(conn):
+        fts = sa.table('tweet_fts', sa.column('rowid'), sa.column('tweet_fts'))
+        phrase = '"' + term.replace('"', '""') + '"'
+        q = (
+            sa.select([fts.c.rowid])
+            .where(fts.c.tweet_fts.op('MATCH')(phrase))
+        )
+        if id_range is not None:
+            q = q.where(fts.c.rowid.between(*id_range))
+        return Tweet.id.in_(q)
+
+    return sa.func.lower(Tweet.text).like(f'%{term.lower()}%')
+
+# the same format the DateTime type stores, truncated to the hour
+HOUR_FORMAT = '%Y-%m-%d %H:00:00.000000'
+
+def hourly_counts_select(
+    db,
+    term,
+    *,
+    since=None,
+    until=None,
+    ids=None,
+):
+    """
+    Return a query counting the tweets containing ``term`` by the hour they
+    were created in and whether they are retweets or replies.
+
+    The rows are ``(term, bucket, is_retweet, is_reply, count)``, matching
+    the columns of :class:`PlotBucket`. Only tweets in ``ids`` are counted,
+    if given.
+
+    """
+    tweet = Tweet.__table__
+    # coerced such that the results are parsed like those of PlotBucket
+    bucket = sa.type_coerce(
+        sa.func.strftime(HOUR_FORMAT, tweet.c.created_at), DateTime())
+    is_retweet = sa.type_coerce(tweet.c.rt_tweet_id.isnot(None), Boolean())
+    is_reply = sa.type_coerce(
+        tweet.c.in_reply_to_tweet_id.isnot(None), Boolean())
+    q = (
+        sa.select([
+            sa.literal(term).label('term'),
+            bucket.label('bucket'),
+            is_retweet.label('is_retweet'),
+            is_reply.label('is_reply'),
+            sa.func.count().label('count'),
+        ])
+        .group_by(bucket, is_retweet, is_reply)
+    )
+    if since is not None:
+        q = q.where(tweet.c.created_at >= since)
+    if until is not None:
+        q = q.where(tweet.c.created_at <= until)
+    if ids is not None:
+        q = q.where(tweet.c.id.in_(ids))
+        id_range = (min(ids), max(ids))
+    else:
+        id_range = None
+    return q.where(tweet_text_filter(db, term, id_range=id_range))
+
+def add_plot_bucket_counts(db, term, *, ids=None):
+    """
+    Add the hourly counts of the tweets containing ``term``, or only those
+    in ``ids``, to the counts already in :class:`PlotBucket`.
+
+    """
+    table = PlotBucket.__table__
+    q = hourly_counts_select(db, term, ids=ids)
+    stmt = sqlite.insert(table).from_select(
+        ['term', 'bucket', 'is_retweet', 'is_reply', 'count'], q)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['term', 'bucket', 'is_retweet', 'is_reply'],
+        set_=dict(count=table.c.count + stmt.excluded['count']),
+    )
+    db.connection().execute(stmt)
+
+def load_plot_terms(db):
+    conn = db.connection()
+    if not has_table(conn, 'plot_term'):
+        return []
+    return [
+        term
+        for term, in conn.execute(sa.select([PlotTerm.term]))
+    ]
+
+def max_tweet_rowid(db):
+    tweet = Tweet.__table__
+    q = sa.select([sa.func.max(sa.literal_column('rowid'))]).select_from(tweet)
+    return db.connection().execute(q).scalar()
+
+def load_mirror_mark(db):
+    conn = db.connection()
+    if not has_table(conn, 'mirror_state'):
+        return None
+    table = MirrorState.__table__
+    q = sa.select([table.c.max_rowid]).where(table.c.name == 'tweet')
+    return conn.execute(q).scalar()
+
+def save_mirror_mark(db, max_rowid, *, now):
+    """
+    Record that the tweets up to ``max_rowid`` are in the columnar mirror
+    once the current transaction commits.
+
+    """
+    table = MirrorState.__table__
+    stmt = sqlite.insert(table).values(
+        name='tweet', max_rowid=max_rowid, updated_at=now)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['name'],
+        set_=dict(
+            max_rowid=stmt.excluded['max_rowid'],
+            updated_at=stmt.excluded['updated_at'],
+        ),
+    )
+    db.connection().execute(stmt)
+
+def create_fts(conn):
+    try:
+        for ddl in FTS_DDL:
+            conn.exec_driver_sql(ddl)
+    except sa.exc.OperationalError as ex:
+        log.warning(f'full text search is unavailable: {ex.orig}')
+        return
+    conn.exec_driver_sql("INSERT INTO tweet_fts(tweet_fts) VALUES ('rebuild')")
+
+def backfill_entities(conn, chunk_size=10000):
+    tweet = Tweet.__table__
+    hashtag_stmt = TweetHashtag.__table__.insert().prefix_with('OR IGNORE')
+    url_stmt = TweetUrl.__table__.insert().prefix_with('OR IGNORE')
+    result = conn.execute(sa.select([tweet.c.id, tweet.c.text]))
+    for rows in result.partitions(chunk_size):
+        hashtags, urls = [], []
+        for id, text in rows:
+            hashtags.extend(
+                dict(tag=tag.lower(), tweet_id=id)
+                for tag in set(HASHTAG_RE.findall(text))
+            )
+            urls.extend(
+                dict(tweet_id=id, url=url, rev_host=reverse_host(url))
+                for url in set(URL_RE.findall(text))
+            )
+        if hashtags:
+            conn.execute(hashtag_stmt, hashtags)
+        if urls:
+            conn.execute(url_stmt, urls)
+
+TWEET_STATS_COLUMNS = (
+    'favorite_count',
+    'retweet_count',
+    'reply_count',
+    'quote_count',
+)
+
+def collapse_tweet_stats(rows):
+    """
+    Sort the :class:`TweetStats` rows by tweet and time, dropping the ones
+    with the same statistics as the row before them.
+
+    """
+    collapsed = []
+    prev = None
+    for row in sorted(rows, key=lambda r: (r['tweet_id'], r['observed_at'])):
+        if (
+            prev is not None
+            and prev['tweet_id'] == row['tweet_id']
+            and (
+                prev['observed_at'] == row['observed_at']
+                or all(prev[c] == row[c] for c in TWEET_STATS_COLUMNS)
+            )
+        ):
+            continue
+        collapsed.append(row)
+        prev = row
+    return collapsed
+
+def split_tweet_stats(conn, rows):
+    """
+    Split :class:`TweetStats` rows, collapsed by :func:`collapse_tweet_stats`,
+    by comparing them to the latest snapshot stored for each tweet.
+
+    Returns the rows observed after the latest snapshot, leaving out any
+    with the same statistics as the one before them, to be inserted by
+    :func:`append_tweet_stats_stmt`, and the rows observed at or before the
+    latest snapshot, to be merged into the table by
+    :func:`insert_tweet_stats_stmt` followed by
+    :func:`delete_redundant_tweet_stats_stmt`.
+
+    """
+    table = TweetStats.__table__
+    latest = table.alias('latest')
+    latest_observed_at = (
+        sa.select([sa.func.max(latest.c.observed_at)])
+        .where(latest.c.tweet_id == table.c.tweet_id)
+        .scalar_subquery()
+    )
+    q = (
+        sa.select([
+            table.c.tweet_id,
+            table.c.observed_at,
+            *(table.c[name] for name in TWEET_STATS_COLUMNS),
+        ])
+        .where(table.c.observed_at == latest_observed_at)
+    )
+    tweet_ids = sorted({row['tweet_id'] for row in rows})
+    latest_by_id = {}
+    # stay below the SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+    for start in range(0, len(tweet_ids), 900):
+        chunk = tweet_ids[start:start + 900]
+        for row in conn.execute(q.where(table.c.tweet_id.in_(chunk))):
+            latest_by_id[row.tweet_id] = row._mapping
+
+    appended, merged = [], []
+    prev_by_id = dict(latest_by_id)
+    for row in rows:
+        tweet_id = row['tweet_id']
+        latest = latest_by_id.get(tweet_id)
+        if latest is not None and row['observed_at'] <= latest['observed_at']:
+            merged.append(row)
+            continue
+        prev = prev_by_id.get(tweet_id)
+        if prev is not None and all(
+            prev[name] == row[name] for name in TWEET_STATS_COLUMNS
+        ):
+            continue
+        appended.append(row)
+        prev_by_id[tweet_id] = row
+    return appended, merged
+
+def append_tweet_stats_stmt():
+    return TweetStats.__table__.insert().prefix_with('OR IGNORE')
+
+def insert_tweet_stats_stmt():
+    """
+    Return an insert of :class:`TweetStats` rows which skips those with the
+    same statistics as the snapshot preceding them in the table.
+
+    Rows are compared against the table one at a time, so it is only used
+    for the few rows :func:`split_tweet_stats` can't append, and followed
+    by :func:`delete_redundant_tweet_stats_stmt` with the same rows.
+
+    """
+    table = TweetStats.__table__
+    params = dict(
+        tweet_id=sa.bindparam('tweet_id', type_=BigInteger()),
+        observed_at=sa.bindparam('observed_at', type_=DateTime()),
+    )
+    for name in TWEET_STATS_COLUMNS:
+        params[name] = sa.bindparam(name, type_=BigInteger())
+    prev_observed_at = (
+        sa.select([sa.func.max(table.c.observed_at)])
+        .where(table.c.tweet_id == params['tweet_id'])
+        .where(table.c.observed_at <= params['observed_at'])
+        .scalar_subquery()
+    )
+    unchanged = sa.exists().where(sa.and_(
+        table.c.tweet_id == params['tweet_id'],
+        table.c.observed_at == prev_observed_at,
+        *(table.c[name].is_(params[name]) for name in TWEET_STATS_COLUMNS),
+    ))
+    return (
+        table.insert()
+        .prefix_with('OR IGNORE')
+        .from_select(
+            list(params),
+            sa.select(list(params.values())).where(~unchanged),
+        )
+    )
+
+def delete_redundant_tweet_stats_stmt():
+    """
+    Return a delete of the :class:`TweetStats` snapshot following each row,
+    if it has the same statistics as the snapshot at or before the row.
+
+    A row ingested out of order, before snapshots that are already in the
+    table, keeps the earliest time the statistics were seen.
+
+    """
+    table = TweetStats.__table__
+    earlier = table.alias('earlier')
+    later = table.alias('later')
+    prev = table.alias('prev')
+    tweet_id = sa.bindparam('tweet_id', type_=BigInteger())
+    observed_at = sa.bindparam('observed_at', type_=DateTime())
+    prev_observed_at = (
+        sa.select([sa.func.max(earlier.c.observed_at)])
+        .where(earlier.c.tweet_id == tweet_id)
+        .where(earlier.c.observed_at <= observed_at)
+        .scalar_subquery()
+    )
+    next_observed_at = (
+        sa.select([sa.func.min(later.c.observed_at)])
+        .where(later.c.tweet_id == tweet_id)
+        .where(later.c.observed_at > observed_at)
+        .scalar_subquery()
+    )
+    unchanged = sa.exists().where(sa.and_(
+        prev.c.tweet_id == tweet_id,
+        prev.c.observed_at == prev_observed_at,
+        *(prev.c[name].is_(table.c[name]) for name in TWEET_STATS_COLUMNS),
+    ))
+    return (
+        table.delete()
+        .where(table.c.tweet_id == tweet_id)
+        .where(table.c.observed_at == next_observed_at)
+        .where(unchanged)
+    )
+
+def backfill_tweet_stats(conn):
+    tweet = Tweet.__table__
+    conn.execute(TweetStats.__table__.insert().from_select(
+        ['tweet_id', 'observed_at', *TWEET_STATS_COLUMNS],
+        sa.select([
+            tweet.c.id,
+            tweet.c.updated_at,
+            *(tweet.c[name] for name in TWEET_STATS_COLUMNS),
+        ]),
+    ))
+
+# bump this when adding tables or indices such that existing databases are
+# migrated the next time they are opened
+SCHEMA_VERSION = 10
+
+# pragmas applied to every connection, a value of None leaves the sqlite
+# default in place
+STORAGE_PROFILES = {
+    'default': dict(
+        journal_mode=None,
+        synchronous=None,
+        cache_size=None,
+        mmap_size=None,
+        temp_store=None,
+        page_size=None,
+    ),
+    # readers never block the writer, and commits only fsync at checkpoints
+    'wal': dict(
+        journal_mode='WAL',
+        synchronous='NORMAL',
+        cache_size=None,
+        mmap_size=None,
+        temp_store=None,
+        page_size=None,
+    ),
+    # wal plus a 256MiB page cache, 1GiB of memory mapped io, in-memory
+    # temporary tables and larger pages for new databases
+    'fast': dict(
+        journal_mode='WAL',
+        synchronous='NORMAL',
+        cache_size=-262144,
+        mmap_size=1 << 30,
+        temp_store='MEMORY',
+        page_size=8192,
+    ),
+}
+
+def storage_options(storage=None, **overrides):
+    """
+    Resolve a named storage profile, with individual pragmas optionally
+    overridden, into a dict of pragma values.
+
+    """
+    if storage is None:
+        storage = 'default'
+    if isinstance(storage, str):
+        try:
+            options = dict(STORAGE_PROFILES[storage])
+        except KeyError:
+            raise ValueError(f'unknown storage profile={storage}')
+    else:
+        options = dict(storage)
+    for key, value in overrides.items():
+        if key not in STORAGE_PROFILES['default']:
+            raise ValueError(f'unknown storage option={key}')
+        if value is not None:
+            options[key] = value
+    return options
+
+def apply_pragmas(dbapi_conn, options, *, is_new=False, readonly=False):
+    cursor = dbapi_conn.cursor()
+    try:
+        # the page size must be chosen before anything is written to the
+        # file and before switching to wal
+        if is_new and options.get('page_size'):
+            cursor.execute(f'PRAGMA page_size={int(options["page_size"])}')
+        if not readonly and options.get('journal_mode'):
+            cursor.execute(f'PRAGMA journal_mode={options["journal_mode"]}')
+        if options.get('synchronous'):
+            cursor.execute(f'PRAGMA synchronous={options["synchronous"]}')
+        if options.get('cache_size'):
+            cursor.execute(f'PRAGMA cache_size={int(options["cache_size"])}')
+        if options.get('mmap_size'):
+            cursor.execute(f'PRAGMA mmap_size={int(options["mmap_size"])}')
+        if options.get('temp_store'):
+            cursor.execute(f'PRAGMA temp_store={options["temp_store"]}')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        if readonly:
+            cursor.execute('PRAGMA query_only=ON')
+    finally:
+        cursor.close()
+
+def sqlite_ln(value):
+    if value is None or value <= 0:
+        return None
+    return math.log(value)
+
+def register_functions(dbapi_conn):
+    """
+    Define the sql functions used by queries but missing from older sqlite
+    builds, which were compiled without the math functions.
+
+    """
+    try:
+        dbapi_conn.execute('SELECT ln(1)')
+    except sqlite3.OperationalError:
+        dbapi_conn.create_function('ln', 1, sqlite_ln)
+
+def run_migrations(engine):
+    """
+    Create any missing tables unless the schema is already up to date.
+
+    """
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+        if version >= SCHEMA_VERSION:
+            return
         log.debug('running database migrations')
-        metadata.create_all(bind=engine)
+        metadata.create_all(bind=conn)
+        if version < 2:
+            create_fts(conn)
+            backfill_entities(conn)
+        if version == 4:
+            add_column(conn, MediaDownload.__table__.c.media_id)
+        if version < 8:
+            backfill_tweet_stats(conn)
+        if version < 10:
+            for index in TweetHashtag.__table__.indexes:
+                index.create(conn, checkfirst=True)
+        conn.exec_driver_sql(f'PRAGMA user_version={SCHEMA_VERSION}')
         log.debug('done running migrations')
+
+def connect(
+    path,
+    *,
+    migrate=True,
+    pool=False,
+    readonly=False,
+    storage=None,
+):
+    """
+    Open the database at ``path``.
+
+    ``storage`` is the name of one of the :data:`STORAGE_PROFILES` or a dict
+    of pragma values. A ``readonly`` database is opened without running
+    migrations and will refuse to write, and never holds a write lock that
+    would block another process ingesting into the same file.
+
+    """
+    log.debug('opening database at path=%s', path)
+    options = storage_options(storage)
+    if readonly:
+        url = f'sqlite:///file:{path}?mode=ro&uri=true'
+    else:
+        url = 'sqlite:///' + path
+    is_new = not readonly and (
+        not os.path.exists(path) or os.path.getsize(path) == 0)
+    # keep connections open between sessions so the page cache and memory
+    # map survive, instead of reconnecting for every transaction
+    engine = sa.create_engine(url, poolclass=sa.pool.QueuePool)
+
+    @sa.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_conn, connection_record):
+        apply_pragmas(dbapi_conn, options, is_new=is_new, readonly=readonly)
+        register_functions(dbapi_conn)
+
+    if migrate and not readonly:
+        run_migrations(engine)
     dbmaker = orm.sessionmaker(bind=engine)
     if pool:
         return dbmaker
     return dbmaker()
 
+def mirror_path_for(path):
+    """
+    The directory of the optional columnar mirror of the database at
+    ``path``.
+
+    It contains parquet files partitioned by the day the tweets were
+    created, ``date=YYYY-MM-DD/part-<uuid>.parquet``, and is kept up to date
+    by ingest once it has been built with ``db:mirror``.
+
+    """
+    return path + '.mirror'
+
 def close(db, *, rollback=False):
     if rollback:
         log.warn('rolling back database changes')
@@ -1,14 +1,22 @@
-from datetime import datetime
+from collections import defaultdict
+import csv
+from datetime import datetime, timedelta
+import functools
 import matplotlib.pyplot as plt
 import numpy as np
 import os.path
-import pandas as pd
 import sqlalchemy as sa
+import xlsxwriter
 
 from . import model
 
+log = __import__('logging').getLogger(__name__)
+
+# the largest number of rows in a sheet, including the header
+EXCEL_MAX_ROWS = 1048576
+
 def main(cli, args):
-    db = cli.connect_db(args.db)
+    db = cli.connect_db(args.db, readonly=True)
 
     format = args.format
     if not format:
@@ -17,16 +25,126 @@ def main(cli, args):
             format = 'csv'
         elif ext == '.xlsx':
             format = 'excel'
+        elif ext == '.parquet':
+            format = 'parquet'
         else:
             cli.abort('could not guess file format from extension')
 
     if format == 'csv':
         format_is_text = True
-    elif format == 'excel':
+    elif format in ('excel', 'parquet'):
         format_is_text = False
     else:
         cli.abort('unrecognized file format')
 
+    if format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            cli.abort('writing parquet files requires pyarrow to be installed')
+
+    q = tweets_query(db)
+    columns = [(c['name'], c['type']) for c in q.column_descriptions]
+    chunks = iter_query_chunks(db, q, args.chunk_size)
+    with cli.output_file(args.output_file, text=format_is_text) as fp:
+        if format == 'csv':
+            write_csv(fp, columns, chunks)
+        elif format == 'excel':
+            write_excel(fp, columns, chunks)
+        elif format == 'parquet':
+            write_parquet(fp, columns, chunks)
+
+def iter_query_chunks(db, q, chunk_size):
+    """
+    Yield the rows of ``q`` in lists of up to ``chunk_size`` rows.
+
+    Only one chunk at a time is held in memory.
+
+    """
+    # executed on the connection rather than the session, which would
+    # buffer the entire result while loading it through the orm
+    conn = db.connection().execution_options(
+        stream_results=True,
+        max_row_buffer=chunk_size,
+    )
+    result = conn.execute(q.statement)
+    try:
+        yield from result.partitions(chunk_size)
+    finally:
+        result.close()
+
+def write_csv(fp, columns, chunks):
+    writer = csv.writer(fp, lineterminator='\n')
+    writer.writerow([name for name, _ in columns])
+    for rows in chunks:
+        writer.writerows(rows)
+
+def write_excel(fp, columns, chunks):
+    """
+    Write rows to an xlsx workbook, rolling over to a new sheet whenever
+    one is full.
+
+    In constant memory mode each row is flushed to a temporary file as soon
+    as the next one is started.
+
+    """
+    workbook = xlsxwriter.Workbook(fp, dict(
+        constant_memory=True,
+        strings_to_numbers=False,
+        strings_to_urls=False,
+        default_date_format='yyyy-mm-dd hh:mm:ss',
+    ))
+    header = [name for name, _ in columns]
+    header_format = workbook.add_format(dict(bold=True))
+
+    def add_worksheet():
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, header, header_format)
+        return worksheet
+
+    worksheet = add_worksheet()
+    row_idx = 1
+    for rows in chunks:
+        for row in rows:
+            if row_idx >= EXCEL_MAX_ROWS:
+                worksheet = add_worksheet()
+                row_idx = 1
+            worksheet.write_row(row_idx, 0, row)
+            row_idx += 1
+    workbook.close()
+
+def arrow_type_for(type_):
+    import pyarrow as pa
+
+    if isinstance(type_, sa.Boolean):
+        return pa.bool_()
+    if isinstance(type_, sa.DateTime):
+        return pa.timestamp('us')
+    if isinstance(type_, sa.Integer):
+        return pa.int64()
+    return pa.string()
+
+def write_parquet(fp, columns, chunks):
+    """
+    Write rows to a parquet file with one row group per chunk.
+
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        (name, arrow_type_for(type_))
+        for name, type_ in columns
+    ])
+    with pq.ParquetWriter(fp, schema, compression='zstd') as writer:
+        for rows in chunks:
+            arrays = [
+                pa.array(values, type=field.type)
+                for values, field in zip(zip(*rows), schema)
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+def tweets_query(db):
     Tweet = model.Tweet
     User = model.User
 
@@ -63,48 +181,186 @@ def main(cli, args):
         )
         .order_by(model.Tweet.created_at.asc())
     )
+    return q
 
-    df = model.query_to_pandas(q)
+# the size of each bucket, counts are stored by the hour and summed into
+# larger buckets when plotting
+BUCKET_STEPS = dict(
+    hour=timedelta(hours=1),
+    day=timedelta(days=1),
+    week=timedelta(weeks=1),
+)
 
-    with cli.output_file(args.output_file, text=format_is_text) as fp:
-        if format == 'csv':
-            df.to_csv(fp, index=False)
-        elif format == 'excel':
-            with pd.ExcelWriter(
-                fp,
-                engine='xlsxwriter',
-                options=dict(
-                    strings_to_numbers=False,
-                ),
-            ) as writer:
-                df.to_excel(writer, index=False)
+def bucket_start(dt, bucket_size):
+    if bucket_size == 'hour':
+        return dt.replace(minute=0, second=0, microsecond=0)
+    day = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    if bucket_size == 'week':
+        # weeks start on monday
+        day -= timedelta(days=day.weekday())
+    return day
+
+def sum_buckets(
+    rows,
+    *,
+    bucket_size,
+    include_retweets=False,
+    include_replies=True,
+):
+    """
+    Sum hourly ``(bucket, is_retweet, is_reply, count)`` rows into buckets
+    of ``bucket_size``, one of :data:`BUCKET_STEPS`.
+
+    Returns a dict of counts by the start of each bucket.
+
+    """
+    counts = defaultdict(int)
+    for bucket, is_retweet, is_reply, count in rows:
+        if is_retweet and not include_retweets:
+            continue
+        if is_reply and not include_replies:
+            continue
+        counts[bucket_start(bucket, bucket_size)] += count
+    return counts
+
+def hourly_counts(db, term, *, since=None, until=None):
+    """
+    Count the tweets containing ``term`` by the hour straight from the
+    tweet table, see :func:`tweeter.model.hourly_counts_select`.
+
+    """
+    q = model.hourly_counts_select(db, term, since=since, until=until)
+    return [tuple(row)[1:] for row in db.connection().execute(q)]
+
+def cached_hourly_counts(db, term, *, since=None, until=None):
+    """
+    Read the hourly counts for a term added by :func:`add_plot_terms`.
+
+    Only the hours entirely between ``since`` and ``until`` are read from
+    the cache, the tweets in the partial hours at either end are counted
+    straight from the tweet table such that the result matches
+    :func:`hourly_counts`.
+
+    """
+    step = BUCKET_STEPS['hour']
+    first = last = None
+    if since is not None:
+        first = bucket_start(since, 'hour')
+        if first < since:
+            first += step
+    if until is not None:
+        last = bucket_start(until, 'hour')
+    if first is not None and last is not None and first >= last:
+        return hourly_counts(db, term, since=since, until=until)
+
+    table = model.PlotBucket.__table__
+    q = (
+        sa.select([
+            table.c.bucket,
+            table.c.is_retweet,
+            table.c.is_reply,
+            table.c.count,
+        ])
+        .where(table.c.term == term)
+    )
+    if first is not None:
+        q = q.where(table.c.bucket >= first)
+    if last is not None:
+        q = q.where(table.c.bucket < last)
+    rows = [tuple(row) for row in db.connection().execute(q)]
+    if since is not None and since < first:
+        rows.extend(hourly_counts(
+            db, term, since=since, until=first - timedelta(microseconds=1)))
+    if until is not None:
+        rows.extend(hourly_counts(db, term, since=last, until=until))
+    return rows
+
+def add_plot_terms(db, terms):
+    """
+    Count the tweets containing each of ``terms`` by the hour and store the
+    counts, which ingest then keeps up to date.
+
+    """
+    conn = db.connection()
+    # take the write lock before counting such that no tweets can be
+    # ingested between counting them and adding the term
+    conn.exec_driver_sql('BEGIN IMMEDIATE')
+    existing_terms = set(model.load_plot_terms(db))
+    now = datetime.utcnow()
+    for term in terms:
+        if term in existing_terms:
+            continue
+        log.info(f'counting tweets containing term={term}')
+        model.add_plot_bucket_counts(db, term)
+        db.add(model.PlotTerm(term=term, created_at=now))
+    db.commit()
 
 def main_plot(cli, args):
-    db = cli.connect_db(args.db)
+    terms = [model.normalize_term(term) for term in args.term or ['#saam']]
+    since, until = args.since, args.until
 
-    date_col = sa.func.date(model.Tweet.created_at).label('date')
-    tweets = (
-        db.query(
-            date_col,
-            sa.func.count().label('count'),
+    if args.no_cache:
+        mirror_path = model.mirror_path_for(args.db)
+        if os.path.isdir(mirror_path):
+            from . import columnar
+
+            log.debug(f'querying mirror at path={mirror_path}')
+            counts_for = functools.partial(columnar.hourly_counts, mirror_path)
+        else:
+            db = cli.connect_db(args.db, readonly=True)
+            counts_for = functools.partial(hourly_counts, db)
+
+    else:
+        db = cli.connect_db(args.db, readonly=True)
+        if not set(terms).issubset(model.load_plot_terms(db)):
+            # only open the database for writing when a term is new
+            db = cli.connect_db(args.db)
+            add_plot_terms(db, terms)
+        counts_for = functools.partial(cached_hourly_counts, db)
+
+    series = [
+        sum_buckets(
+            counts_for(term, since=since, until=until),
+            bucket_size=args.bucket,
+            include_retweets=args.include_retweets,
+            include_replies=not args.exclude_replies,
         )
-        .filter(model.Tweet.created_at.between(
-            datetime(2019, 3, 20),
-            datetime(2019, 5, 10),
-        ))
-        # .filter(model.Tweet.in_reply_to_tweet_id.is_(None))
-        .filter(model.Tweet.rt_tweet_id.is_(None))
-        .filter(sa.func.lower(model.Tweet.text).like('%#saam%'))
-        .group_by(date_col)
-        .order_by(date_col.asc())
-        .all()
-    )
-    dates = [t.date for t in tweets]
-    counts = [t.count for t in tweets]
+        for term in terms
+    ]
 
+    # every bucket in the range is plotted, including the empty ones
+    starts = [k for counts in series for k in counts]
+    if since is not None:
+        starts.append(bucket_start(since, args.bucket))
+    if until is not None:
+        starts.append(bucket_start(until, args.bucket))
+    buckets = []
+    if starts:
+        bucket, last = min(starts), max(starts)
+        while bucket <= last:
+            buckets.append(bucket)
+            bucket += BUCKET_STEPS[args.bucket]
+
+    label_format = '%Y-%m-%d %H:00' if args.bucket == 'hour' else '%Y-%m-%d'
     fig, ax = plt.subplots()
-    x = np.arange(len(dates))
-    plt.bar(x, counts)
-    plt.xticks(x, dates)
+    x = np.arange(len(buckets))
+    width = 0.8 / len(terms)
+    for i, (term, counts) in enumerate(zip(terms, series)):
+        plt.bar(
+            x + (i - (len(terms) - 1) / 2) * width,
+            [counts.get(bucket, 0) for bucket in buckets],
+            width,
+            label=term,
+        )
+    # thin out the labels to keep them legible on long ranges
+    step = max(1, len(buckets) // 30)
+    plt.xticks(
+        x[::step],
+        [bucket.strftime(label_format) for bucket in buckets[::step]],
+        rotation=90,
+    )
+    if len(terms) > 1:
+        plt.legend()
+    fig.tight_layout()
     with cli.output_file(args.output_file, text=False) as fp:
         plt.savefig(fp, format='png')
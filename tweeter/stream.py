@@ -1,38 +1,343 @@
 import attr
 from datetime import datetime, timedelta
+import glob
+import json
 import logging
+import os
+import queue
 import signal
+import threading
+import time
 import tweepy
 from twilio.rest import Client as TwilioClient
 import typing
 import yaml
 
+from . import metrics as metrics_
+from .settings import asduration
 from . import zstd
 
 log = logging.getLogger(__name__)
 
-@attr.s(frozen=True, slots=True, auto_attribs=True)
+TMP_SUFFIX = '.tmp'
+
+def fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_and_close(fp):
+    fp.flush()
+    os.fsync(fp.fileno())
+    fp.close()
+
+def manifest_path_for(path):
+    return path + '.manifest'
+
+def write_manifest(path, obj):
+    manifest_path = manifest_path_for(path)
+    with open(manifest_path + TMP_SUFFIX, 'w', encoding='utf8') as fp:
+        json.dump(obj, fp)
+        fp.write('\n')
+        sync_and_close(fp)
+    os.rename(manifest_path + TMP_SUFFIX, manifest_path)
+
+def open_exclusive(prefix, now):
+    """
+    Create a new temporary output file that doesn't collide with any other
+    file, finalized or not, even when reconnecting within the same second.
+
+    Names always end in a zero-padded sequence number, such that files
+    opened within the same second still sort in the order they were
+    written.
+
+    """
+    base = f'{prefix}.{now:%Y%m%d.%H%M%S}'
+    for n in range(1000):
+        path = f'{base}.{n:03d}.zstd'
+        if os.path.exists(path):
+            continue
+        try:
+            fp = open(path + TMP_SUFFIX, mode='xb')
+        except FileExistsError:
+            continue
+        return path, fp
+    raise RuntimeError(f'could not find an unused path for prefix={prefix}')
+
+@attr.s(slots=True, auto_attribs=True)
 class Stream:
+    """
+    An output file being written under a temporary name.
+
+    The file only appears at ``path`` once it is closed, after its data
+    and index are synced to disk, such that anything matching
+    ``*.zstd`` is complete.
+
+    """
     path: str
     fp: typing.BinaryIO
-    writer: typing.Any
+    index_fp: typing.TextIO
+    writer: zstd.FrameWriter
+    opened_at: datetime
+
+    @classmethod
+    def open(cls, path_prefix, *, now=None, **writer_options):
+        if now is None:
+            now = datetime.utcnow()
+        path, fp = open_exclusive(path_prefix, now)
+        log.info(f'opening path={path}')
+        index_fp = open(
+            zstd.index_path_for(path) + TMP_SUFFIX, mode='w', encoding='utf8')
+        writer = zstd.FrameWriter(fp, index_fp=index_fp, **writer_options)
+        return cls(
+            path=path,
+            fp=fp,
+            index_fp=index_fp,
+            writer=writer,
+            opened_at=now,
+        )
 
-    def write(self, bytes):
-        return self.writer.write(bytes)
+    @property
+    def num_records(self):
+        return self.writer.total.lines + self.writer.frame.lines
 
-    def close(self):
+    @property
+    def num_bytes(self):
+        return self.writer.offset
+
+    def write_line(self, line):
+        return self.writer.write_line(line)
+
+    def close(self, *, manifest=False):
         self.writer.close()
-        self.fp.close()
+        sync_and_close(self.fp)
+        sync_and_close(self.index_fp)
+        finalize(self.path)
+        if manifest:
+            closed_at = datetime.utcnow()
+            obj = self.writer.total.to_json()
+            obj.update(
+                path=os.path.basename(self.path),
+                opened_at=f'{self.opened_at:%Y-%m-%dT%H:%M:%S.%f}',
+                closed_at=f'{closed_at:%Y-%m-%dT%H:%M:%S.%f}',
+            )
+            write_manifest(self.path, obj)
+
+def finalize(path):
+    # the index is moved into place first such that it's available as
+    # soon as the data file appears
+    index_path = zstd.index_path_for(path)
+    os.rename(index_path + TMP_SUFFIX, index_path)
+    os.rename(path + TMP_SUFFIX, path)
+    fsync_dir(path)
+
+def recover_orphans(path_prefix):
+    """
+    Finalize temporary files left behind by a listener that crashed.
+
+    Frames are only added to the index after being fully written, so the
+    data is truncated to the end of the last indexed frame, discarding any
+    partially written frame.
+
+    """
+    for tmp_path in sorted(glob.glob(f'{glob.escape(path_prefix)}.*.zstd.tmp')):
+        path = tmp_path[:-len(TMP_SUFFIX)]
+        index_path = zstd.index_path_for(path)
+        index_tmp_path = index_path + TMP_SUFFIX
+        if not os.path.exists(index_tmp_path):
+            if os.path.exists(index_path):
+                # crashed between the renames in finalize, after both files
+                # were synced, so the data is complete
+                os.rename(tmp_path, path)
+                fsync_dir(path)
+                log.warning(f'recovered path={path} with its final index')
+                continue
+            if os.path.getsize(tmp_path) > 0:
+                log.warning(f'not recovering path={tmp_path} without an index')
+                continue
+        lines = []
+        if os.path.exists(index_tmp_path):
+            with open(index_tmp_path, 'r', encoding='utf8') as fp:
+                lines = fp.readlines()
+        # keep index lines up to the first partially written one
+        size = 0
+        for idx, line in enumerate(lines):
+            try:
+                frame = zstd.Frame.from_json(json.loads(line))
+            except (KeyError, ValueError):
+                lines = lines[:idx]
+                break
+            size = frame.offset + frame.size
+        with open(index_tmp_path, 'w', encoding='utf8') as fp:
+            fp.writelines(lines)
+            sync_and_close(fp)
+        with open(tmp_path, 'r+b') as fp:
+            fp.truncate(size)
+            sync_and_close(fp)
+        log.warning(f'recovered path={path} bytes={size}')
+        finalize(path)
+
+# sentinel queued to stop the writer thread after draining the queue
+STOP = object()
+
+class StreamWriter(threading.Thread):
+    """
+    Compress and write records to disk in a background thread.
+
+    Records are handed off through a bounded queue such that the thread
+    reading from twitter never waits on compression or disk i/o unless the
+    queue is full. At that point ``on_full`` decides whether to ``block``
+    the reader (applying backpressure) or ``drop`` the record.
+
+    """
+    def __init__(
+        self,
+        *,
+        path_prefix,
+        queue_size=10000,
+        on_full='block',
+        max_bytes=None,
+        max_records=None,
+        max_age=None,
+        manifest=False,
+        metrics=None,
+        **writer_options
+    ):
+        super().__init__(name='stream-writer', daemon=True)
+        if on_full not in ('block', 'drop'):
+            raise ValueError(f'invalid on_full={on_full}')
+        self.path_prefix = path_prefix
+        self.writer_options = writer_options
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.max_age = asduration(max_age, default=None)
+        self.manifest = manifest
+        self.on_full = on_full
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.rotate_requested = threading.Event()
+        self.stream = None
+
+        if metrics is None:
+            metrics = metrics_.StreamMetrics()
+        self.metrics = metrics
+
+    def put(self, data):
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            if self.on_full == 'drop':
+                self.metrics.records_dropped += 1
+                return
+            self.metrics.records_blocked += 1
+            self.queue.put(data)
+        depth = self.queue.qsize()
+        if depth > self.metrics.max_queue_depth:
+            self.metrics.max_queue_depth = depth
+
+    def rotate(self):
+        """
+        Ask the writer thread to close the current file.
+
+        This only sets a flag and is safe to call from a signal handler.
+
+        """
+        self.rotate_requested.set()
+
+    def close(self):
+        self.queue.put(STOP)
+        self.join()
+
+    def run(self):
+        while True:
+            try:
+                data = self.queue.get(timeout=1)
+            except queue.Empty:
+                data = None
+
+            if self.rotate_requested.is_set():
+                self.rotate_requested.clear()
+                self.close_stream()
+            elif self.should_rotate():
+                self.close_stream()
+
+            if data is STOP:
+                self.close_stream()
+                break
+
+            if data is not None:
+                try:
+                    self.write(data)
+                except Exception:
+                    log.exception('failed writing record, rotating')
+                    self.metrics.write_errors += 1
+                    self.close_stream()
+
+    def should_rotate(self):
+        stream = self.stream
+        if stream is None:
+            return False
+        if self.max_bytes is not None and stream.num_bytes >= self.max_bytes:
+            return True
+        if (
+            self.max_records is not None
+            and stream.num_records >= self.max_records
+        ):
+            return True
+        if (
+            self.max_age is not None
+            and datetime.utcnow() - stream.opened_at >= self.max_age
+        ):
+            return True
+        return False
+
+    def write(self, data):
+        start = time.perf_counter()
+        if self.stream is None:
+            self.stream = Stream.open(self.path_prefix, **self.writer_options)
+        stream = self.stream
+        metrics = self.metrics
+        prev_num_bytes = stream.num_bytes
+        stream.write_line(data)
+        metrics.compressed_bytes_written += stream.num_bytes - prev_num_bytes
+        metrics.current_file_bytes = stream.num_bytes
+        metrics.bytes_written += len(data) + 1
+        metrics.records_written += 1
+        metrics.write_latency.observe(time.perf_counter() - start)
+
+    def close_stream(self):
+        stream = self.stream
+        if stream is not None:
+            log.info(f'closing path={stream.path}')
+            prev_num_bytes = stream.num_bytes
+            try:
+                stream.close(manifest=self.manifest)
+            except Exception:
+                log.exception(f'failed closing path={stream.path}')
+                self.metrics.write_errors += 1
+            self.metrics.compressed_bytes_written += (
+                stream.num_bytes - prev_num_bytes)
+            self.metrics.current_file_bytes = 0
+            self.stream = None
 
 class TweetStream(tweepy.Stream):
-    stream = None
     last_report_at = None
     num_records_since_report = 0
     report_interval = timedelta(seconds=5)
 
-    def __init__(self, *args, path_prefix, report_interval=None, **kw):
+    def __init__(
+        self,
+        *args,
+        writer,
+        report_interval=None,
+        metrics_file=None,
+        **kw
+    ):
         super().__init__(*args, **kw)
-        self.path_prefix = path_prefix
+        self.writer = writer
+        self.metrics = writer.metrics
+        self.metrics_file = metrics_file
         if report_interval is not None:
             self.report_interval = report_interval
 
@@ -42,6 +347,7 @@ class TweetStream(tweepy.Stream):
 
         """
         log.info('connected')
+        self.metrics.connects += 1
         signal.signal(signal.SIGHUP, self.on_sighup)
         self.last_report_at = datetime.utcnow()
         self.num_records_since_report = 0
@@ -75,24 +381,24 @@ class TweetStream(tweepy.Stream):
 
         """
         log.info('received keep-alive')
+        now = datetime.utcnow()
+        metrics = self.metrics
+        if metrics.last_keep_alive_at is not None:
+            metrics.last_keep_alive_gap = (
+                now - metrics.last_keep_alive_at).total_seconds()
+        metrics.last_keep_alive_at = now
+        metrics.last_message_at = now
+        metrics.keep_alives += 1
 
     def on_data(self, data):
         now = datetime.utcnow()
         self.num_records_since_report += 1
+        metrics = self.metrics
+        metrics.records_received += 1
+        metrics.bytes_received += len(data)
+        metrics.last_message_at = now
 
-        if self.stream is None:
-            now = datetime.utcnow()
-            path = f'{self.path_prefix}.{now:%Y%m%d.%H%M%S}.zstd'
-            log.info(f'opening path={path}')
-            fp = open(path, mode='ab')
-            writer = zstd.writer(fp)
-            self.stream = Stream(
-                path=path,
-                fp=fp,
-                writer=writer,
-            )
-        self.stream.write(data)
-        self.stream.write(b'\n')
+        self.writer.put(data)
 
         if now - self.last_report_at >= self.report_interval:
             self.report(now=now)
@@ -103,6 +409,7 @@ class TweetStream(tweepy.Stream):
 
         """
         signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        self.metrics.disconnects += 1
         self.rotate()
         self.report()
 
@@ -115,18 +422,32 @@ class TweetStream(tweepy.Stream):
             now = datetime.utcnow()
         dt = now - self.last_report_at
 
+        metrics = self.metrics
+        metrics.queue_depth = self.writer.queue.qsize()
+        if dt.total_seconds() > 0:
+            metrics.records_per_second = (
+                self.num_records_since_report / dt.total_seconds())
         log.info(
             f'received {self.num_records_since_report} records since '
-            f'{dt.total_seconds():.2f} seconds ago'
+            f'{dt.total_seconds():.2f} seconds ago, '
+            f'queue_depth={metrics.queue_depth} '
+            f'max_queue_depth={metrics.max_queue_depth} '
+            f'written={metrics.records_written} '
+            f'blocked={metrics.records_blocked} '
+            f'dropped={metrics.records_dropped} '
+            f'errors={metrics.write_errors}'
         )
+        if self.metrics_file:
+            try:
+                metrics.write_file(self.metrics_file)
+            except OSError:
+                log.exception(f'failed writing metrics to {self.metrics_file}')
         self.last_report_at = now
         self.num_records_since_report = 0
+        metrics.max_queue_depth = 0
 
     def rotate(self):
-        if self.stream is not None:
-            log.info(f'closing path={self.stream.path}')
-            self.stream.close()
-            self.stream = None
+        self.writer.rotate()
 
 def main(cli, args):
     profile = cli.profile
@@ -138,51 +459,91 @@ def main(cli, args):
     report_interval = stream_profile.get('report_interval')
     if report_interval is not None:
         report_interval = timedelta(seconds=report_interval)
+    writer_options = {}
+    for key in (
+        'level',
+        'frame_lines',
+        'frame_bytes',
+        'queue_size',
+        'on_full',
+        'max_bytes',
+        'max_records',
+        'max_age',
+        'manifest',
+    ):
+        if stream_profile.get(key) is not None:
+            writer_options[key] = stream_profile[key]
+    dict_path = stream_profile.get('dictionary')
+    if dict_path is not None:
+        writer_options['dict_data'] = zstd.load_dictionary(dict_path)
+
+    metrics = metrics_.StreamMetrics()
+    metrics_file = stream_profile.get('metrics_file')
+    metrics_port = stream_profile.get('metrics_port')
+    if metrics_port is not None:
+        metrics_.serve(
+            metrics,
+            port=metrics_port,
+            host=stream_profile.get('metrics_host', '127.0.0.1'),
+        )
+
+    recover_orphans(args.output_path_prefix)
+    writer = StreamWriter(
+        path_prefix=args.output_path_prefix,
+        metrics=metrics,
+        **writer_options
+    )
 
     twilio = TwilioClient(
         profile['twilio']['account_sid'],
         profile['twilio']['auth_token'],
     )
 
-    while True:
-        stream = TweetStream(
-            profile['twitter']['consumer_key'],
-            profile['twitter']['consumer_secret'],
-            profile['twitter']['access_token'],
-            profile['twitter']['access_token_secret'],
-            path_prefix=args.output_path_prefix,
-            report_interval=report_interval,
-        )
+    writer.start()
+    try:
+        while True:
+            stream = TweetStream(
+                profile['twitter']['consumer_key'],
+                profile['twitter']['consumer_secret'],
+                profile['twitter']['access_token'],
+                profile['twitter']['access_token_secret'],
+                writer=writer,
+                report_interval=report_interval,
+                metrics_file=metrics_file,
+            )
 
-        stopping = False
-        def on_sigterm(*args):
-            nonlocal stopping
-            log.info('received SIGTERM, stopping')
-            stopping = True
-            stream.disconnect()
-        try:
-            signal.signal(signal.SIGTERM, on_sigterm)
-            stream.filter(**filters, stall_warnings=True)
-        except Exception as ex:
-            log.info('restarting after receiving exception')
+            stopping = False
+            def on_sigterm(*args):
+                nonlocal stopping
+                log.info('received SIGTERM, stopping')
+                stopping = True
+                stream.disconnect()
             try:
-                twilio.messages.create(
-                    body=(
-                        f'Received twitter-listen exception '
-                        f'type={type(ex).__qualname__} args={ex}'
-                    ),
-                    from_=profile['twilio']['source_phone_number'],
-                    to=profile['twilio']['target_phone_number'],
-                )
-            except Exception:
-                log.exception('squashing error sending sms')
-        except KeyboardInterrupt:
-            log.info('received SIGINT, stopping')
-            break
-        else:
-            if stopping:
+                signal.signal(signal.SIGTERM, on_sigterm)
+                stream.filter(**filters, stall_warnings=True)
+            except Exception as ex:
+                log.info('restarting after receiving exception')
+                try:
+                    twilio.messages.create(
+                        body=(
+                            f'Received twitter-listen exception '
+                            f'type={type(ex).__qualname__} args={ex}'
+                        ),
+                        from_=profile['twilio']['source_phone_number'],
+                        to=profile['twilio']['target_phone_number'],
+                    )
+                except Exception:
+                    log.exception('squashing error sending sms')
+            except KeyboardInterrupt:
+                log.info('received SIGINT, stopping')
                 break
-            log.info('restarting')
-        finally:
-            signal.signal(signal.SIGTERM, signal.SIG_DFL)
-            stream.disconnect()
+            else:
+                if stopping:
+                    break
+                log.info('restarting')
+            finally:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                stream.disconnect()
+    finally:
+        log.info('waiting for writer to finish')
+        writer.close()
@@ -1,25 +1,406 @@
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import heapq
 import logging
-from sqlalchemy import orm
+import sqlalchemy as sa
+from sqlalchemy.dialects import sqlite
 import tweepy
 
 from . import model
 
 log = logging.getLogger(__name__)
 
-def grouper(items, chunk_size):
-    start = 0
-    while True:
-        end = start + chunk_size
-        chunk = items[start:end]
-        if not chunk:
-            break
-        yield chunk
-        start = end
+# the most ids accepted by a single statuses/lookup request
+LOOKUP_SIZE = 100
+
+# the most tweets ranked at once, about the number of lookups allowed in a
+# rate limit window, the rest are ranked again in the next round
+ROUND_SIZE = 900 * LOOKUP_SIZE
+
+# engagement per hour credited for each e-fold of the author's followers,
+# such that tweets without any engagement yet still rank by their reach
+FOLLOWER_PRIOR = 0.01
+
+# a tweet gaining less than this fraction of its engagement between two
+# lookups is considered quiet and looked up half as often, otherwise twice
+# as often
+QUIET_GROWTH = 0.1
+
+def hours(delta):
+    return delta.total_seconds() / 3600
+
+def hours_between(end, start):
+    return (sa.func.julianday(end) - sa.func.julianday(start)) * 24
+
+def refresh_priority(tweet, refresh, now):
+    """
+    Estimate the engagement a tweet gained since it was last seen, as an
+    expression ranking the rows of :func:`due_tweets_queries`.
+
+    Engagement is assumed to arrive at a rate decaying with the age of the
+    tweet, ``rate(t) = r0 * t0 / t``, from the rate ``r0`` last observed at
+    age ``t0``, such that the gain at the age ``t1`` of the tweet ``now`` is
+    ``r0 * t0 * log(t1 / t0)``.
+
+    Tweets never looked up use the average rate since they were created.
+
+    """
+    seen_at = sa.func.coalesce(refresh.c.checked_at, tweet.c.updated_at)
+    t0 = sa.func.max(1.0, hours_between(seen_at, tweet.c.created_at))
+    t1 = sa.func.max(
+        t0, hours_between(sa.literal(now, sa.DateTime()), tweet.c.created_at))
+    rate = sa.case(
+        (refresh.c.checked_at.isnot(None), refresh.c.engagement_rate),
+        else_=(
+            sa.func.coalesce(tweet.c.retweet_count, 0)
+            + sa.func.coalesce(tweet.c.favorite_count, 0)
+        ) / t0,
+    )
+    rate += FOLLOWER_PRIOR * sa.func.ln(
+        1.0 + sa.func.coalesce(tweet.c.user_followers_count, 0))
+    return rate * t0 * sa.func.ln(t1 / t0)
+
+def due_tweets_queries(
+    *,
+    now,
+    max_ts,
+    limit,
+    min_id=None,
+    retry_unavailable=False,
+):
+    """
+    Return queries for the ``limit`` most promising tweets due for a
+    refresh: those scheduled by an earlier run, and those never looked up
+    and last updated before ``max_ts``.
+
+    The rows are ranked by sqlite, which only keeps the best ``limit`` of
+    them while scanning, see :func:`refresh_priority`.
+
+    """
+    tweet = model.Tweet.__table__
+    refresh = model.TweetRefresh.__table__
+    unavailable = model.UnavailableTweet.__table__
+    priority = refresh_priority(tweet, refresh, now).label('priority')
+    columns = [
+        tweet.c.id,
+        tweet.c.created_at,
+        tweet.c.updated_at,
+        tweet.c.retweet_count,
+        tweet.c.favorite_count,
+        tweet.c.user_followers_count,
+        refresh.c.checked_at,
+        refresh.c.engagement,
+        refresh.c.engagement_rate,
+        refresh.c.interval,
+        priority,
+    ]
+    scheduled_q = (
+        sa.select(columns)
+        .select_from(refresh.join(tweet, tweet.c.id == refresh.c.tweet_id))
+        .where(refresh.c.next_refresh_at <= now)
+    )
+    unscheduled_q = (
+        sa.select(columns)
+        .select_from(
+            tweet.outerjoin(refresh, refresh.c.tweet_id == tweet.c.id))
+        .where(tweet.c.updated_at < max_ts)
+        .where(refresh.c.tweet_id.is_(None))
+    )
+    queries = [scheduled_q, unscheduled_q]
+    if min_id is not None:
+        queries = [q.where(tweet.c.id >= min_id) for q in queries]
+    if not retry_unavailable:
+        queries = [
+            q.where(~sa.exists().where(unavailable.c.tweet_id == tweet.c.id))
+            for q in queries
+        ]
+    return [
+        q.order_by(priority.desc(), tweet.c.id).limit(limit)
+        for q in queries
+    ]
+
+def select_due_tweets(db, *, now, limit, **kw):
+    """
+    Return up to ``limit`` of the tweets due for a refresh, the most
+    promising first, see :func:`refresh_priority`.
+
+    """
+    conn = db.connection()
+    rows = (
+        row
+        for q in due_tweets_queries(now=now, limit=limit, **kw)
+        for row in conn.execute(q)
+    )
+    return heapq.nlargest(limit, rows, key=lambda row: row.priority or 0)
+
+def next_interval(row, engagement, *, min_interval, max_interval):
+    if row.interval is None:
+        interval = min_interval
+    elif engagement - row.engagement < QUIET_GROWTH * max(1, row.engagement):
+        interval = row.interval * 2
+    else:
+        interval = row.interval // 2
+    return max(min_interval, min(max_interval, interval))
+
+def lookup(api, rows):
+    """
+    Look up the tweets in ``rows``.
+
+    Returns ``(rows, checked_at, statuses)`` with the raw json of every
+    tweet that could be found, the others are deleted or can no longer be
+    seen.
+
+    """
+    checked_at = datetime.utcnow()
+    statuses = api.lookup_statuses([row.id for row in rows], trim_user=True)
+    return rows, checked_at, [s._json for s in statuses]
+
+def update_tweets_stmt():
+    table = model.Tweet.__table__
+    return (
+        table.update()
+        .where(table.c.id == sa.bindparam('tweet_id'))
+        # never overwrite newer statistics, such as those ingested from the
+        # stream in the meantime
+        .where(table.c.updated_at < sa.bindparam('checked_at'))
+        .values(
+            updated_at=sa.bindparam('checked_at'),
+            favorite_count=sa.bindparam('new_favorite_count'),
+            quote_count=sa.bindparam('new_quote_count'),
+            reply_count=sa.bindparam('new_reply_count'),
+            retweet_count=sa.bindparam('new_retweet_count'),
+        )
+    )
+
+def upsert_tweet_refreshes_stmt():
+    table = model.TweetRefresh.__table__
+    stmt = sqlite.insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.tweet_id],
+        set_={
+            c.name: stmt.excluded[c.name]
+            for c in table.c
+            if c.name != 'tweet_id'
+        },
+    )
+
+def upsert_unavailable_tweets_stmt():
+    table = model.UnavailableTweet.__table__
+    stmt = sqlite.insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.tweet_id],
+        set_=dict(checked_at=stmt.excluded.checked_at),
+    )
+
+def delete_unavailable_tweets_stmt():
+    table = model.UnavailableTweet.__table__
+    return table.delete().where(table.c.tweet_id == sa.bindparam('tweet_id'))
+
+def write_results(
+    db,
+    rows,
+    checked_at,
+    statuses,
+    *,
+    min_interval,
+    max_interval,
+):
+    """
+    Apply the statistics of the looked up ``statuses``, appending them to
+    their history, record the tweets that were not found and schedule the
+    next refresh of all of them.
+
+    Returns the number of tweets updated and found to be unavailable.
+
+    """
+    conn = db.connection()
+    rows_by_id = {row.id: row for row in rows}
+    found_ids = {raw['id'] for raw in statuses if raw['id'] in rows_by_id}
+    if found_ids:
+        updates, refreshes, stats = [], [], []
+        for raw in statuses:
+            row = rows_by_id.get(raw['id'])
+            if row is None:
+                continue
+            updates.append(dict(
+                tweet_id=row.id,
+                checked_at=checked_at,
+                new_favorite_count=raw.get('favorite_count'),
+                new_quote_count=raw.get('quote_count'),
+                new_reply_count=raw.get('reply_count'),
+                new_retweet_count=raw.get('retweet_count'),
+            ))
+            stats.append(dict(
+                tweet_id=row.id,
+                observed_at=checked_at,
+                **{name: raw.get(name) for name in model.TWEET_STATS_COLUMNS},
+            ))
+
+            engagement = (
+                (raw.get('retweet_count') or 0)
+                + (raw.get('favorite_count') or 0)
+            )
+            if row.checked_at is not None:
+                seen_at, seen_engagement = row.checked_at, row.engagement
+            else:
+                seen_at = row.updated_at
+                seen_engagement = (
+                    (row.retweet_count or 0) + (row.favorite_count or 0))
+            rate = max(0, engagement - seen_engagement) / max(
+                1 / 60, hours(checked_at - seen_at))
+            interval = next_interval(
+                row,
+                engagement,
+                min_interval=min_interval,
+                max_interval=max_interval,
+            )
+            refreshes.append(dict(
+                tweet_id=row.id,
+                checked_at=checked_at,
+                engagement=engagement,
+                engagement_rate=rate,
+                interval=interval,
+                next_refresh_at=checked_at + timedelta(seconds=interval),
+            ))
+
+        conn.execute(update_tweets_stmt(), updates)
+        conn.execute(upsert_tweet_refreshes_stmt(), refreshes)
+        appended, merged = model.split_tweet_stats(
+            conn, model.collapse_tweet_stats(stats))
+        if appended:
+            conn.execute(model.append_tweet_stats_stmt(), appended)
+        if merged:
+            conn.execute(model.insert_tweet_stats_stmt(), merged)
+            conn.execute(model.delete_redundant_tweet_stats_stmt(), merged)
+        # tweets that were unavailable before may be visible again
+        conn.execute(delete_unavailable_tweets_stmt(), [
+            dict(tweet_id=id) for id in found_ids
+        ])
+
+    unavailable_ids = [id for id in rows_by_id if id not in found_ids]
+    if unavailable_ids:
+        conn.execute(upsert_unavailable_tweets_stmt(), [
+            dict(tweet_id=id, checked_at=checked_at)
+            for id in unavailable_ids
+        ])
+        # scheduled like a quiet tweet, such that retrying unavailable
+        # tweets looks each of them up once per run and then backs off
+        refreshes = []
+        for id in unavailable_ids:
+            row = rows_by_id[id]
+            if row.checked_at is not None:
+                engagement = row.engagement
+            else:
+                engagement = (
+                    (row.retweet_count or 0) + (row.favorite_count or 0))
+            interval = next_interval(
+                row,
+                engagement,
+                min_interval=min_interval,
+                max_interval=max_interval,
+            )
+            refreshes.append(dict(
+                tweet_id=id,
+                checked_at=checked_at,
+                engagement=engagement,
+                engagement_rate=0.0,
+                interval=interval,
+                next_refresh_at=checked_at + timedelta(seconds=interval),
+            ))
+        conn.execute(upsert_tweet_refreshes_stmt(), refreshes)
+    return len(found_ids), len(unavailable_ids)
+
+def update_stale_tweets(
+    db,
+    api,
+    *,
+    min_age,
+    max_interval=timedelta(days=30),
+    min_id=None,
+    max_lookups=None,
+    jobs=2,
+    prefetch=4,
+    retry_unavailable=False,
+):
+    """
+    Refresh the statistics of the tweets due for it, the most promising
+    first.
+
+    A tweet is first due once it was last updated more than ``min_age``
+    ago. After each lookup it is scheduled again, starting ``min_age``
+    later and backing off up to ``max_interval`` while it stays quiet.
+    At most ``max_lookups`` requests are made, if given.
+
+    Lookups run on ``jobs`` threads, up to ``prefetch`` requests ahead of
+    the database, while the results are written in order of priority and
+    committed one request at a time such that an interrupted run keeps its
+    progress. The rate limit is left to ``api``, which is expected to wait
+    for the limit to reset rather than fail.
+
+    Returns the number of tweets updated and found to be unavailable.
+
+    """
+    min_interval = int(min_age.total_seconds())
+    max_interval = max(min_interval, int(max_interval.total_seconds()))
+    num_updated = num_unavailable = num_lookups = 0
+
+    def write(future):
+        nonlocal num_updated, num_unavailable
+        rows, checked_at, statuses = future.result()
+        updated, unavailable = write_results(
+            db,
+            rows,
+            checked_at,
+            statuses,
+            min_interval=min_interval,
+            max_interval=max_interval,
+        )
+        db.commit()
+        num_updated += updated
+        num_unavailable += unavailable
+        log.debug(f'updated {updated} tweets, {unavailable} unavailable')
+
+    # tweets refreshed in a round are scheduled after the start of the run,
+    # so each round ranks only the ones still due and the run ends
+    now = datetime.utcnow()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        try:
+            while max_lookups is None or num_lookups < max_lookups:
+                limit = ROUND_SIZE
+                if max_lookups is not None:
+                    limit = min(
+                        limit, (max_lookups - num_lookups) * LOOKUP_SIZE)
+                rows = select_due_tweets(
+                    db,
+                    now=now,
+                    limit=limit,
+                    max_ts=now - min_age,
+                    min_id=min_id,
+                    retry_unavailable=retry_unavailable,
+                )
+                if not rows:
+                    break
+                log.info(f'refreshing {len(rows)} tweets')
+
+                for start in range(0, len(rows), LOOKUP_SIZE):
+                    chunk = rows[start:start + LOOKUP_SIZE]
+                    pending.append(executor.submit(lookup, api, chunk))
+                    num_lookups += 1
+                    if len(pending) >= prefetch:
+                        write(pending.popleft())
+                while pending:
+                    write(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+
+    return num_updated, num_unavailable
 
 def main(cli, args):
     profile = cli.profile
-    dbmaker = model.connect(args.db, pool=True)
+    db = cli.connect_db(args.db)
 
     auth = tweepy.OAuthHandler(
         profile['twitter']['consumer_key'],
@@ -29,54 +410,20 @@ def main(cli, args):
         profile['twitter']['access_token'],
         profile['twitter']['access_token_secret'],
     )
+    api = tweepy.API(auth, wait_on_rate_limit=True)
 
-    max_ts = datetime.utcnow() - args.min_age
-
-    db = dbmaker()
-    stale_id_q = (
-        db.query(model.Tweet.id)
-        .filter(model.Tweet.updated_at < max_ts)
-        .order_by(model.Tweet.id.asc())
+    num_updated, num_unavailable = update_stale_tweets(
+        db,
+        api,
+        min_age=args.min_age,
+        max_interval=args.max_interval,
+        min_id=args.min_id,
+        max_lookups=args.max_lookups,
+        jobs=args.jobs,
+        prefetch=args.prefetch,
+        retry_unavailable=args.retry_unavailable,
+    )
+    log.info(
+        f'updated {num_updated} tweets, '
+        f'{num_unavailable} are no longer available'
     )
-
-    if args.min_id is not None:
-        stale_id_q = stale_id_q.filter(model.Tweet.id >= args.min_id)
-
-    stale_ids = [id for id, in stale_id_q]
-    db.close()
-    log.info(f'found {len(stale_ids)} stale tweets')
-
-    api = tweepy.API(auth, wait_on_rate_limit=True)
-    for chunk in grouper(stale_ids, 100):
-        log.info(f'starting from id={chunk[0]}')
-        now = datetime.utcnow()
-        statuses = api.statuses_lookup(chunk)
-        db = dbmaker()
-        try:
-            tweets_by_id = {
-                tw.id: tw
-                for tw in (
-                    db.query(model.Tweet)
-                    .filter(model.Tweet.id.in_(s.id for s in statuses))
-                    .options(orm.load_only(
-                        'id',
-                        'updated_at',
-                        'favorite_count',
-                        'quote_count',
-                        'reply_count',
-                        'retweet_count',
-                    ))
-                )
-            }
-            for s in statuses:
-                raw = s._json
-                tw = tweets_by_id[s.id]
-                tw.updated_at = now
-                tw.favorite_count = raw.get('favorite_count')
-                tw.quote_count = raw.get('quote_count')
-                tw.reply_count = raw.get('reply_count')
-                tw.retweet_count = raw.get('retweet_count')
-            log.debug(f'updated {len(statuses)} tweets')
-            db.commit()
-        finally:
-            db.close()
@@ -0,0 +1,16 @@
+from collections import deque
+
+def imap_ordered(executor, fn, items, *, max_pending):
+    """
+    Like ``executor.map`` but only keeps ``max_pending`` items in flight.
+
+    Results are yielded in the same order as ``items``.
+
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
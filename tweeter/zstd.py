@@ -1,87 +1,692 @@
+import attr
+from collections import deque
 from contextlib import ExitStack
+from datetime import datetime, timedelta
+import functools
 import gzip
 import io
+import json
+import os.path
+import queue
+import re
+import threading
+import typing
 import zstandard as zstd
 
 log = __import__('logging').getLogger(__name__)
 
-def iter_lines(fp, *, filter_empty_lines=True):
-    dctx = zstd.ZstdDecompressor()
-    stream_reader = dctx.stream_reader(fp)
-    stream = io.TextIOWrapper(stream_reader, encoding='utf8')
-    for line in stream:
+# twitter snowflake ids embed the creation time in milliseconds since
+# this epoch in their upper bits
+SNOWFLAKE_EPOCH = datetime(2010, 11, 4, 1, 42, 54, 657000)
+
+# the largest possible zstd frame header, ZSTD_FRAMEHEADERSIZE_MAX
+FRAME_HEADER_SIZE_MAX = 18
+
+# decompressed data is buffered and split into lines in chunks of this size
+READ_SIZE = 1 << 20
+
+# copy_stream moves data in chunks of the ~128KiB zstd block size by
+# default, larger chunks cut the calls into zstd and keep the workers of
+# multithreaded compression busy
+COPY_READ_SIZE = 4 * 2**20
+COPY_WRITE_SIZE = 4 * 2**20
+
+STATUS_ID_RE = re.compile(rb'\{"created_at":"[^"]*","id":(\d+)')
+
+def snowflake_to_datetime(id):
+    return SNOWFLAKE_EPOCH + timedelta(milliseconds=id >> 22)
+
+def datetime_to_snowflake(value):
+    ms = (value - SNOWFLAKE_EPOCH) // timedelta(milliseconds=1)
+    return max(ms, 0) << 22
+
+def status_id_from_line(line):
+    """
+    Return the id of the top-level status in a raw json line.
+
+    Twitter serializes ``created_at`` and ``id`` first so this is usually a
+    cheap regex match. Anything else, such as delete or limit notices, falls
+    back to parsing the json and returns ``None`` if it isn't a status.
+
+    """
+    m = STATUS_ID_RE.match(line)
+    if m is not None:
+        return int(m.group(1))
+    try:
+        obj = json.loads(line)
+    except ValueError:
+        return None
+    if isinstance(obj, dict) and 'created_at' in obj:
+        return obj.get('id')
+
+def load_dictionary(path):
+    with open(path, 'rb') as fp:
+        return zstd.ZstdCompressionDict(fp.read())
+
+@functools.lru_cache(maxsize=None)
+def load_dictionaries(paths):
+    """
+    Load trained dictionaries keyed by their dictionary id.
+
+    ``paths`` must be hashable (a tuple) as the result is cached such that
+    worker processes only load each dictionary once.
+
+    """
+    dictionaries = {}
+    for path in paths or ():
+        dict_data = load_dictionary(path)
+        dictionaries[dict_data.dict_id()] = dict_data
+    return dictionaries
+
+def peek_dict_id(fp):
+    """
+    Return the dictionary id from the zstd frame header at the current
+    position of ``fp`` without consuming any data.
+
+    Only buffered readers support peeking, anything else returns ``None``.
+
+    """
+    peek = getattr(fp, 'peek', None)
+    if peek is None:
+        return None
+    return dict_id_from_header(peek(FRAME_HEADER_SIZE_MAX))
+
+def dict_id_from_header(header):
+    try:
+        return zstd.get_frame_parameters(header).dict_id
+    except zstd.ZstdError:
+        return None
+
+def find_dictionary(dict_id, dictionaries):
+    if not dict_id:
+        return None
+    dict_data = (dictionaries or {}).get(dict_id)
+    if dict_data is None:
+        raise ValueError(
+            f'data was compressed with dictionary id={dict_id}, use --dict '
+            f'to supply it'
+        )
+    return dict_data
+
+def decompressor_for(fp, dictionaries=None):
+    """
+    Create a decompressor for ``fp``, choosing the dictionary from
+    ``dictionaries`` that matches the id recorded in its first frame.
+
+    """
+    dict_data = find_dictionary(peek_dict_id(fp), dictionaries)
+    return zstd.ZstdDecompressor(dict_data=dict_data)
+
+def strip_lines(lines):
+    # strip returns the same object when there is nothing to remove, so only
+    # lines ending in "\r" or padded with whitespace are copied again
+    return [line for line in map(bytes.strip, lines) if line]
+
+def iter_line_batches(
+    fp,
+    *,
+    filter_empty_lines=True,
+    dictionaries=None,
+    read_size=READ_SIZE,
+):
+    """
+    Yield the lines of a zstd stream as lists of ``bytes``, about
+    ``read_size`` bytes of lines per list.
+
+    The decompressed stream is read through a buffered reader whose
+    ``readlines`` returns a new ``bytes`` object per line, in batches rather
+    than one call per line. Lines are not decoded, :func:`json.loads`
+    accepts bytes as is.
+
+    """
+    dctx = decompressor_for(fp, dictionaries)
+    reader = io.BufferedReader(
+        dctx.stream_reader(fp, read_across_frames=True), read_size)
+    while True:
+        lines = reader.readlines(read_size)
+        if not lines:
+            break
         if filter_empty_lines:
-            line = line.strip()
-            if line:
-                yield line
-        else:
-            yield line
-
-def writer(fp, *, level=10):
-    cctx = zstd.ZstdCompressor(level=level)
+            lines = strip_lines(lines)
+        if lines:
+            yield lines
+
+def iter_lines(fp, *, filter_empty_lines=True, dictionaries=None):
+    """
+    Yield the lines of a zstd stream as ``bytes``, see
+    :func:`iter_line_batches`.
+
+    """
+    for lines in iter_line_batches(
+        fp,
+        filter_empty_lines=filter_empty_lines,
+        dictionaries=dictionaries,
+    ):
+        yield from lines
+
+@attr.s(slots=True, auto_attribs=True)
+class Frame:
+    offset: int
+    size: int
+    lines: int
+    min_id: typing.Optional[int] = None
+    max_id: typing.Optional[int] = None
+
+    @property
+    def min_created_at(self):
+        if self.min_id is not None:
+            return snowflake_to_datetime(self.min_id)
+
+    @property
+    def max_created_at(self):
+        if self.max_id is not None:
+            return snowflake_to_datetime(self.max_id)
+
+    def merge(self, other):
+        self.size += other.size
+        self.lines += other.lines
+        if other.min_id is not None:
+            if self.min_id is None or other.min_id < self.min_id:
+                self.min_id = other.min_id
+            if self.max_id is None or other.max_id > self.max_id:
+                self.max_id = other.max_id
+
+    def overlaps(self, min_id=None, max_id=None):
+        if self.min_id is None:
+            return self.lines > 0 and min_id is None and max_id is None
+        if min_id is not None and self.max_id < min_id:
+            return False
+        if max_id is not None and self.min_id > max_id:
+            return False
+        return True
+
+    def to_json(self):
+        return dict(
+            offset=self.offset,
+            size=self.size,
+            lines=self.lines,
+            min_id=self.min_id,
+            max_id=self.max_id,
+            min_created_at=(
+                f'{self.min_created_at:%Y-%m-%dT%H:%M:%S.%f}'
+                if self.min_id is not None else None
+            ),
+            max_created_at=(
+                f'{self.max_created_at:%Y-%m-%dT%H:%M:%S.%f}'
+                if self.max_id is not None else None
+            ),
+        )
+
+    @classmethod
+    def from_json(cls, obj):
+        return cls(
+            offset=obj['offset'],
+            size=obj['size'],
+            lines=obj['lines'],
+            min_id=obj.get('min_id'),
+            max_id=obj.get('max_id'),
+        )
+
+def index_path_for(path):
+    return path + '.index'
+
+def read_index(path):
+    """
+    Load the frame index for an archive written by :class:`FrameWriter`.
+
+    Returns ``None`` if the archive has no index or if the index does not
+    exactly cover the archive, for example if the writer crashed between
+    writing a frame and recording it.
+
+    """
+    index_path = index_path_for(path)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r', encoding='utf8') as fp:
+        frames = [
+            Frame.from_json(json.loads(line))
+            for line in fp
+            if line.strip()
+        ]
+    offset = 0
+    for frame in frames:
+        if frame.offset != offset:
+            break
+        offset += frame.size
+    else:
+        if offset == os.path.getsize(path):
+            return frames
+    log.warning(f'ignoring incomplete index for path={path}')
+    return None
+
+def iter_frame_line_batches(fp, frames, *, dictionaries=None):
+    """
+    Yield the lines from only the selected frames of an indexed archive,
+    as a list of ``bytes`` per frame.
+
+    """
+    dctxs = {}
+    for frame in frames:
+        fp.seek(frame.offset)
+        data = fp.read(frame.size)
+        dict_id = dict_id_from_header(data)
+        dctx = dctxs.get(dict_id)
+        if dctx is None:
+            dict_data = find_dictionary(dict_id, dictionaries)
+            dctx = dctxs[dict_id] = zstd.ZstdDecompressor(dict_data=dict_data)
+        yield strip_lines(dctx.decompress(data).split(b'\n'))
+
+def iter_frame_lines(fp, frames, *, dictionaries=None):
+    """
+    Yield the lines from only the selected frames of an indexed archive, as
+    ``bytes``.
+
+    """
+    for lines in iter_frame_line_batches(
+        fp, frames, dictionaries=dictionaries,
+    ):
+        yield from lines
+
+def iter_frame_groups(
+    frames,
+    group_lines,
+    *,
+    min_id=None,
+    max_id=None,
+    start_line=0,
+):
+    """
+    Group the frames of an indexed archive into runs of at least
+    ``group_lines`` lines, leaving out the frames ending before
+    ``start_line`` and those that cannot contain ids between ``min_id`` and
+    ``max_id``.
+
+    Yields ``(frames, end_line, last)`` where ``end_line`` is the number of
+    lines from the start of the file up to the end of the group. The
+    ``last`` group, possibly empty, ends with the file.
+
+    """
+    group, group_size, line_no = [], 0, 0
+    for frame in frames:
+        line_no += frame.lines
+        if line_no <= start_line:
+            continue
+        if not frame.overlaps(min_id, max_id):
+            continue
+        group.append(frame)
+        group_size += frame.lines
+        if group_size >= group_lines:
+            yield group, line_no, False
+            group, group_size = [], 0
+    yield group, line_no, True
+
+@attr.s(frozen=True, auto_attribs=True)
+class Unit:
+    """
+    A piece of an archive read by one worker, either the selected
+    ``frames`` of an indexed archive or the entire file.
+
+    """
+    path: str
+    frames: list = None
+    dict_paths: tuple = ()
+
+    def iter_lines(self):
+        dictionaries = load_dictionaries(self.dict_paths)
+        with open(self.path, 'rb') as fp:
+            if self.frames is not None:
+                yield from iter_frame_lines(
+                    fp, self.frames, dictionaries=dictionaries)
+            else:
+                yield from iter_lines(fp, dictionaries=dictionaries)
+
+def iter_units(
+    paths,
+    *,
+    unit_lines=16000,
+    min_id=None,
+    max_id=None,
+    dict_paths=(),
+):
+    """
+    Split archives into :class:`Unit` of about ``unit_lines`` lines, by
+    frame if they are indexed, skipping the frames that cannot contain ids
+    between ``min_id`` and ``max_id``.
+
+    """
+    for path in paths:
+        frames = read_index(path)
+        if frames is None:
+            # without an index the file can only be read from the start
+            yield Unit(path=path, dict_paths=dict_paths)
+            continue
+        for group, _, _ in iter_frame_groups(
+            frames, unit_lines, min_id=min_id, max_id=max_id,
+        ):
+            if group:
+                yield Unit(path=path, frames=group, dict_paths=dict_paths)
+
+class FrameWriter:
+    """
+    Write lines as a sequence of independent zstd frames.
+
+    A new frame is started every ``frame_lines`` lines or ``frame_bytes``
+    uncompressed bytes. The result is still a regular zstd file, but with
+    an ``index_fp`` each completed frame is also recorded as a json line
+    containing its offset, size, line count and status id range so that
+    readers can seek directly to the frames they need. Callers that already
+    know the status id of a line may pass it to :meth:`write_line`.
+
+    """
+    def __init__(
+        self,
+        fp,
+        *,
+        index_fp=None,
+        level=10,
+        dict_data=None,
+        frame_lines=1000,
+        frame_bytes=4 * 2**20,
+    ):
+        self.fp = fp
+        self.index_fp = index_fp
+        self.cctx = zstd.ZstdCompressor(level=level, dict_data=dict_data)
+        self.frame_lines = frame_lines
+        self.frame_bytes = frame_bytes
+        self.offset = fp.tell()
+        self.buffer = bytearray()
+        self.frame = Frame(offset=self.offset, size=0, lines=0)
+        # a summary of every frame written so far
+        self.total = Frame(offset=self.offset, size=0, lines=0)
+
+    def write_line(self, line, *, id=None):
+        self.buffer += line
+        self.buffer += b'\n'
+
+        frame = self.frame
+        frame.lines += 1
+        if id is None:
+            id = status_id_from_line(line)
+        if id is not None:
+            if frame.min_id is None or id < frame.min_id:
+                frame.min_id = id
+            if frame.max_id is None or id > frame.max_id:
+                frame.max_id = id
+
+        if (
+            frame.lines >= self.frame_lines
+            or len(self.buffer) >= self.frame_bytes
+        ):
+            self.flush()
+
+    def flush(self):
+        frame = self.frame
+        if not frame.lines:
+            return
+        data = self.cctx.compress(bytes(self.buffer))
+        self.fp.write(data)
+        self.fp.flush()
+        frame.size = len(data)
+        self.offset += frame.size
+        self.total.merge(frame)
+        if self.index_fp is not None:
+            self.index_fp.write(json.dumps(frame.to_json()) + '\n')
+            self.index_fp.flush()
+        self.buffer = bytearray()
+        self.frame = Frame(offset=self.offset, size=0, lines=0)
+
+    def close(self):
+        self.flush()
+
+def writer(fp, *, level=10, dict_data=None):
+    cctx = zstd.ZstdCompressor(level=level, dict_data=dict_data)
     compressor = cctx.stream_writer(fp)
     return compressor
 
-def concat_streams(out_fp, streams, *, level=10):
-    cctx = zstd.ZstdCompressor(level=level)
-    dctx = zstd.ZstdDecompressor()
-    bytes_out = 0
-    for stream in streams:
-        with dctx.stream_reader(stream) as reader:
-            _, write_bytes = cctx.copy_stream(reader, out_fp)
-            bytes_out += write_bytes
-    return bytes_out
+def iter_chunks(fp, *, dictionaries=None, read_size=COPY_READ_SIZE):
+    """
+    Yield the decompressed contents of a zstd stream in chunks of
+    ``read_size`` bytes.
+
+    """
+    dctx = decompressor_for(fp, dictionaries)
+    with dctx.stream_reader(
+        fp, read_size=read_size, read_across_frames=True,
+    ) as reader:
+        while True:
+            chunk = reader.read(read_size)
+            if not chunk:
+                break
+            yield chunk
+
+# marks the end of the chunks of a source in its queue
+END_OF_SOURCE = object()
+
+def fill_queue(source, chunk_queue, stopped):
+    def put(item):
+        while not stopped.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for chunk in source:
+            if not put((chunk, None)):
+                return
+    except Exception as ex:
+        put((None, ex))
+        return
+    put((END_OF_SOURCE, None))
+
+def iter_sources(sources, *, jobs=1, max_chunks=4):
+    """
+    Yield the chunks of each of ``sources`` in order, while up to ``jobs``
+    of them are consumed ahead on background threads.
 
-def compress_streams(out_fp, streams, *, level=10):
-    cctx = zstd.ZstdCompressor(level=level)
+    Each source is an iterable of chunks, such as a generator opening and
+    decompressing a file, which is run entirely on one thread. At most
+    ``max_chunks`` chunks of each are buffered.
+
+    """
+    stopped = threading.Event()
+    sources = iter(sources)
+    pending = deque()
+
+    def start_next():
+        for source in sources:
+            chunk_queue = queue.Queue(max_chunks)
+            thread = threading.Thread(
+                target=fill_queue,
+                args=(source, chunk_queue, stopped),
+                daemon=True,
+            )
+            thread.start()
+            pending.append((thread, chunk_queue))
+            return
+
+    try:
+        for _ in range(max(1, jobs)):
+            start_next()
+        while pending:
+            thread, chunk_queue = pending.popleft()
+            while True:
+                chunk, ex = chunk_queue.get()
+                if ex is not None:
+                    raise ex
+                if chunk is END_OF_SOURCE:
+                    break
+                yield chunk
+            thread.join()
+            start_next()
+    finally:
+        stopped.set()
+        for thread, _ in pending:
+            thread.join()
+
+def concat_streams(
+    out_fp,
+    sources,
+    *,
+    level=10,
+    dict_data=None,
+    threads=0,
+    jobs=1,
+):
+    """
+    Compress the chunks of ``sources`` into a single zstd stream, see
+    :func:`iter_sources`.
+
+    ``threads`` is passed on to zstd, which compresses on that many worker
+    threads, or one per cpu if negative, while ``jobs`` sources are read
+    ahead.
+
+    Returns the number of bytes read and written.
+
+    """
+    cctx = zstd.ZstdCompressor(
+        level=level, dict_data=dict_data, threads=threads)
+    bytes_in = 0
+    with cctx.stream_writer(
+        out_fp, write_size=COPY_WRITE_SIZE, closefd=False,
+    ) as compressor:
+        for chunk in iter_sources(sources, jobs=jobs):
+            compressor.write(chunk)
+            bytes_in += len(chunk)
+    return bytes_in, compressor.tell()
+
+def compress_streams(out_fp, streams, *, level=10, dict_data=None, threads=0):
+    cctx = zstd.ZstdCompressor(
+        level=level, dict_data=dict_data, threads=threads)
     bytes_in, bytes_out = 0, 0
     for stream in streams:
-        read_bytes, write_bytes = cctx.copy_stream(stream, out_fp)
+        read_bytes, write_bytes = cctx.copy_stream(
+            stream,
+            out_fp,
+            read_size=COPY_READ_SIZE,
+            write_size=COPY_WRITE_SIZE,
+        )
         bytes_in += read_bytes
         bytes_out += write_bytes
     return bytes_in, bytes_out
 
+def train_dictionary(streams, *, dict_size, max_samples, dictionaries=None):
+    """
+    Train a dictionary using individual lines (tweets) as samples.
+
+    """
+    samples = []
+    for stream in streams:
+        for line in iter_lines(stream, dictionaries=dictionaries):
+            samples.append(line)
+            if len(samples) >= max_samples:
+                break
+        if len(samples) >= max_samples:
+            break
+    log.info(f'training dictionary from {len(samples)} samples')
+    return zstd.train_dictionary(dict_size, samples)
+
+def main_train_dict(cli, args):
+    dictionaries = load_dictionaries(tuple(args.dict or ()))
+    def streams():
+        for path in args.input_files:
+            log.debug(f'sampling stream="{path}"')
+            with cli.input_file(path, text=False) as in_fp:
+                yield in_fp
+    dict_data = train_dictionary(
+        streams(),
+        dict_size=args.size,
+        max_samples=args.max_samples,
+        dictionaries=dictionaries,
+    )
+    with cli.output_file(args.output_file, text=False) as out_fp:
+        out_fp.write(dict_data.as_bytes())
+    log.info(
+        f'wrote dictionary id={dict_data.dict_id()} '
+        f'size={len(dict_data)} bytes'
+    )
+
 def main_concat(cli, args):
+    dictionaries = load_dictionaries(tuple(args.dict or ()))
+    dict_data = None
+    if args.output_dict:
+        dict_data = load_dictionary(args.output_dict)
+
+    def read_input(path):
+        log.debug(f'concatenating stream="{path}"')
+        with cli.input_file(path, text=False) as in_fp:
+            yield from iter_chunks(in_fp, dictionaries=dictionaries)
+
     with cli.output_file(args.output_file, text=False) as out_fp:
-        def streams():
-            for path in args.input_files:
-                log.debug('concatenating stream="{path}"')
-                with cli.input_file(path, text=False) as in_fp:
-                    yield in_fp
-        stream_iter = streams()
-        bytes_out = concat_streams(out_fp, stream_iter, level=args.level)
-    log.info(f'wrote {bytes_out} bytes')
+        bytes_in, bytes_out = concat_streams(
+            out_fp,
+            (read_input(path) for path in args.input_files),
+            level=args.level,
+            dict_data=dict_data,
+            threads=args.threads,
+            jobs=args.jobs,
+        )
+    log.info(
+        f'read {bytes_in} bytes, wrote {bytes_out} bytes, '
+        f'ratio={bytes_out / max(1, bytes_in)}'
+    )
 
 def main_compress(cli, args):
+    dict_data = None
+    if args.dict:
+        dict_data = load_dictionary(args.dict)
     with ExitStack() as stack:
         out_fp = stack.enter_context(cli.output_file(args.output_file, text=False))
         in_fp = stack.enter_context(cli.input_file(args.input_file, text=False))
 
-        bytes_in, bytes_out = compress_streams(out_fp, [in_fp], level=args.level)
+        bytes_in, bytes_out = compress_streams(
+            out_fp,
+            [in_fp],
+            level=args.level,
+            dict_data=dict_data,
+            threads=args.threads,
+        )
     log.info(
         f'read {bytes_in} bytes, wrote {bytes_out} bytes, '
         f'ratio={bytes_out / bytes_in}'
     )
 
 def main_decompress(cli, args):
+    dictionaries = load_dictionaries(tuple(args.dict or ()))
     with ExitStack() as stack:
         out_fp = stack.enter_context(cli.output_file(args.output_file, text=False))
         in_fp = stack.enter_context(cli.input_file(args.input_file, text=False))
 
-        dctx = zstd.ZstdDecompressor()
-        bytes_in, bytes_out = dctx.copy_stream(in_fp, out_fp)
+        dctx = decompressor_for(in_fp, dictionaries)
+        bytes_in, bytes_out = dctx.copy_stream(
+            in_fp,
+            out_fp,
+            read_size=COPY_READ_SIZE,
+            write_size=COPY_WRITE_SIZE,
+        )
     log.info(
         f'read {bytes_in} bytes, wrote {bytes_out} bytes, '
         f'ratio={bytes_out / bytes_in}'
     )
 
 def main_from_gz(cli, args):
+    dict_data = None
+    if args.dict:
+        dict_data = load_dictionary(args.dict)
     with ExitStack() as stack:
         out_fp = stack.enter_context(cli.output_file(args.output_file, text=False))
         in_fp = stack.enter_context(cli.input_file(args.input_file, text=False))
         gz_in_fp = stack.enter_context(gzip.open(in_fp, mode='rb'))
 
-        bytes_in, bytes_out = compress_streams(out_fp, [gz_in_fp])
+        bytes_in, bytes_out = compress_streams(
+            out_fp,
+            [gz_in_fp],
+            level=args.level,
+            dict_data=dict_data,
+            threads=args.threads,
+        )
     log.info(
         f'read {bytes_in} bytes, wrote {bytes_out} bytes, '
         f'ratio={bytes_out / bytes_in}'
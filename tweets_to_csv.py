@@ -1,65 +1,382 @@
 import argparse
+import attr
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 import csv
-import io
+from datetime import datetime, timezone
 import json
 import logging
+import orjson
+import os
+import shutil
 import sys
-import zstandard as zstd
+import tempfile
+
+from tweeter import zstd
+from tweeter.util import imap_ordered
 
 log = logging.getLogger(__name__)
 
-def parse_tweet_stream(path):
-    with open(path, 'rb') as fp:
-        dctx = zstd.ZstdDecompressor()
-        stream_reader = dctx.stream_reader(fp)
-        stream = io.TextIOWrapper(stream_reader, encoding='utf8')
-        for line in stream:
-            line = line.strip()
-            if line:
-                try:
-                    yield json.loads(line)
-                except Exception as ex:
-                    log.exception(ex)
-
-def save_tweet_csv(tweets, path):
-    with open(path, 'w') as fp:
-        writer = csv.writer(fp)
-        writer.writerow([
-            'id',
-            'created_at',
-            'text',
-            'user_name',
-            'user_screen_name',
-            'friends_count',
-            'followers_count',
-        ])
-        for tweet in tweets:
-            writer.writerow([
-                tweet.get('id'),
-                tweet.get('created_at'),
-                tweet.get('text'),
-                tweet.get('user', {}).get('name'),
-                tweet.get('user', {}).get('screen_name'),
-                tweet.get('user', {}).get('friends_count'),
-                tweet.get('user', {}).get('followers_count'),
-            ])
+# column name -> (type, candidate paths), the first path with a value wins
+FIELDS = {
+    'id': ('int', ['id']),
+    'created_at': ('str', ['created_at']),
+    'text': ('str', ['text']),
+    'full_text': ('str', ['extended_tweet.full_text', 'text']),
+    'lang': ('str', ['lang']),
+    'user_id': ('int', ['user.id']),
+    'user_name': ('str', ['user.name']),
+    'user_screen_name': ('str', ['user.screen_name']),
+    'friends_count': ('int', ['user.friends_count']),
+    'followers_count': ('int', ['user.followers_count']),
+    'in_reply_to_status_id': ('int', ['in_reply_to_status_id']),
+    'quoted_status_id': ('int', ['quoted_status_id']),
+    'retweeted_status_id': ('int', ['retweeted_status.id']),
+    'favorite_count': ('int', ['favorite_count']),
+    'retweet_count': ('int', ['retweet_count']),
+}
+
+DEFAULT_COLUMNS = [
+    'id',
+    'created_at',
+    'text',
+    'user_name',
+    'user_screen_name',
+    'friends_count',
+    'followers_count',
+]
+
+TYPES = ('int', 'float', 'bool', 'str', 'datetime', 'json')
+
+@attr.s(frozen=True, auto_attribs=True)
+class Column:
+    name: str
+    type: str
+    paths: tuple
+
+    @classmethod
+    def parse(cls, spec):
+        """
+        Parse a column from ``name``, one of the :data:`FIELDS`, or from
+        ``name=path[:type]`` where ``path`` is a dotted path into the status,
+        such as ``user.screen_name`` or ``entities.hashtags.0.text``.
+
+        """
+        if '=' not in spec:
+            if spec not in FIELDS:
+                raise ValueError(f'unknown column={spec}')
+            type, paths = FIELDS[spec]
+            return cls(spec, type, tuple(paths))
+        name, path = spec.split('=', 1)
+        type = 'str'
+        if ':' in path:
+            path, type = path.rsplit(':', 1)
+            if type not in TYPES:
+                raise ValueError(f'unknown type={type} for column={name}')
+        return cls(name, type, (path,))
+
+def make_getter(path):
+    keys = tuple(
+        int(key) if key.isdigit() else key
+        for key in path.split('.')
+    )
+
+    def get(obj):
+        try:
+            for key in keys:
+                obj = obj[key]
+            return obj
+        except (KeyError, IndexError, TypeError):
+            return None
+    return get
+
+def make_projection(columns):
+    """
+    Return a function extracting the values of ``columns`` from a status as
+    a tuple.
+
+    """
+    getters = []
+    for column in columns:
+        candidates = [make_getter(path) for path in column.paths]
+        if len(candidates) == 1:
+            getters.append(candidates[0])
+            continue
+
+        def get(obj, candidates=candidates):
+            for candidate in candidates:
+                value = candidate(obj)
+                if value is not None:
+                    return value
+        getters.append(get)
+
+    def project(obj):
+        return tuple([get(obj) for get in getters])
+    return project
+
+def csv_value(value, type):
+    if type == 'json' or isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+def csv_rows(rows, columns):
+    # the known fields are always scalars, only columns given by path may
+    # hold objects that need to be encoded
+    encoded = [
+        (idx, c.type)
+        for idx, c in enumerate(columns)
+        if c.name not in FIELDS or c.paths != tuple(FIELDS[c.name][1])
+    ]
+    if not encoded:
+        return rows
+    rows = [list(row) for row in rows]
+    for row in rows:
+        for idx, type in encoded:
+            row[idx] = csv_value(row[idx], type)
+    return rows
+
+def parse_datetime(value):
+    # "Wed Oct 10 20:19:24 +0000 2018", stored as naive utc like the database
+    value = datetime.strptime(value, '%a %b %d %H:%M:%S %z %Y')
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+def arrow_value(value, type):
+    if value is None:
+        return None
+    try:
+        if type == 'int':
+            return int(value)
+        if type == 'float':
+            return float(value)
+        if type == 'bool':
+            return bool(value)
+        if type == 'datetime':
+            return parse_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if type == 'json' or isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+def arrow_schema(columns):
+    import pyarrow as pa
+
+    types = {
+        'int': pa.int64(),
+        'float': pa.float64(),
+        'bool': pa.bool_(),
+        'str': pa.string(),
+        'datetime': pa.timestamp('us'),
+        'json': pa.string(),
+    }
+    return pa.schema([(c.name, types[c.type]) for c in columns])
+
+def iter_row_chunks(unit, columns, chunk_size):
+    project = make_projection(columns)
+    rows = []
+    for line in unit.iter_lines():
+        try:
+            # each status is parsed in full, orjson builds the objects
+            # quickly enough that picking the fields is cheaper than a
+            # projecting parser which can't skip a single malformed line
+            rows.append(project(orjson.loads(line)))
+        except Exception as ex:
+            log.error(f'failed parsing line in file={unit.path}, error={ex}')
+            continue
+        if len(rows) >= chunk_size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+def convert_unit(unit, *, columns, format, part_path, chunk_size):
+    """
+    Convert a :class:`tweeter.zstd.Unit` into a headerless part of the
+    output at ``part_path``.
+
+    Returns the number of rows written.
+
+    """
+    num_rows = 0
+    if format == 'csv':
+        with open(part_path, 'w', encoding='utf8', newline='') as fp:
+            writer = csv.writer(fp, lineterminator='\n')
+            for rows in iter_row_chunks(unit, columns, chunk_size):
+                writer.writerows(csv_rows(rows, columns))
+                num_rows += len(rows)
+
+    elif format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = arrow_schema(columns)
+        with pq.ParquetWriter(part_path, schema) as writer:
+            for rows in iter_row_chunks(unit, columns, chunk_size):
+                writer.write_table(pa.Table.from_arrays(
+                    [
+                        pa.array(
+                            [arrow_value(v, c.type) for v in values],
+                            type=field.type,
+                        )
+                        for c, field, values in zip(
+                            columns, schema, zip(*rows))
+                    ],
+                    schema=schema,
+                ))
+                num_rows += len(rows)
+    return num_rows
+
+def convert_part(item):
+    unit, tmp_dir, idx, columns, format, chunk_size = item
+    part_path = os.path.join(tmp_dir, f'part-{idx:06d}')
+    num_rows = convert_unit(
+        unit,
+        columns=columns,
+        format=format,
+        part_path=part_path,
+        chunk_size=chunk_size,
+    )
+    return part_path, num_rows
+
+def convert_files(
+    paths,
+    output_path,
+    *,
+    columns,
+    format,
+    jobs=1,
+    chunk_size=10000,
+    unit_lines=16000,
+    dict_paths=(),
+):
+    """
+    Convert the statuses in ``paths`` into a single csv or parquet file.
+
+    Files are split into units that are decompressed, parsed and written to
+    temporary parts by ``jobs`` worker processes, then joined in the order
+    of the input.
+
+    Returns the number of rows written.
+
+    """
+    tmp_dir = tempfile.mkdtemp(
+        prefix='.tweets-', dir=os.path.dirname(output_path) or '.')
+    units = zstd.iter_units(
+        paths, unit_lines=unit_lines, dict_paths=dict_paths)
+
+    items = (
+        (unit, tmp_dir, idx, columns, format, chunk_size)
+        for idx, unit in enumerate(units)
+    )
+    num_rows = 0
+    try:
+        with ExitStack() as stack:
+            if jobs > 1:
+                executor = stack.enter_context(
+                    ProcessPoolExecutor(max_workers=jobs))
+                parts = imap_ordered(
+                    executor, convert_part, items, max_pending=2 * jobs)
+            else:
+                parts = map(convert_part, items)
+
+            if format == 'csv':
+                fp = stack.enter_context(
+                    open(output_path, 'w', encoding='utf8', newline=''))
+                csv.writer(fp, lineterminator='\n').writerow(
+                    [c.name for c in columns])
+                for part_path, part_rows in parts:
+                    with open(part_path, 'r', encoding='utf8', newline='') as part:
+                        shutil.copyfileobj(part, fp, 1 << 20)
+                    os.unlink(part_path)
+                    num_rows += part_rows
+
+            elif format == 'parquet':
+                import pyarrow.parquet as pq
+
+                writer = stack.enter_context(
+                    pq.ParquetWriter(output_path, arrow_schema(columns)))
+                for part_path, part_rows in parts:
+                    part = pq.ParquetFile(part_path)
+                    # copied a row group at a time, as it was written
+                    for idx in range(part.num_row_groups):
+                        writer.write_table(part.read_row_group(idx))
+                    os.unlink(part_path)
+                    num_rows += part_rows
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return num_rows
 
 def parse_args(argv):
-    parser = argparse.ArgumentParser(prog=argv[0])
-    parser.add_argument('input_file')
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description=(
+            'Convert zstd archives of tweets into a csv or parquet file with '
+            'one row per status. The known columns are: '
+            + ', '.join(FIELDS)
+        ),
+    )
+    parser.add_argument('input_files', nargs='+', metavar='input_file')
     parser.add_argument('output_file')
+    parser.add_argument(
+        '-c',
+        '--column',
+        dest='columns',
+        action='append',
+        help=(
+            'a known column or name=path[:type], where path is dotted, such '
+            'as user.location, and type is one of: ' + ', '.join(TYPES)
+            + '. May be given several times, defaults to '
+            + ','.join(DEFAULT_COLUMNS)
+        ),
+    )
+    parser.add_argument('--format', choices=['csv', 'parquet'])
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument(
+        '--dict',
+        action='append',
+        help='a zstd dictionary used by some of the input files',
+    )
     return parser.parse_args(argv[1:])
 
 def main(argv=sys.argv):
     args = parse_args(argv)
 
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=logging.INFO,
         format='%(asctime)-15s %(levelname)-8s [%(name)s] %(message)s',
     )
 
-    tweets = parse_tweet_stream(args.input_file)
-    save_tweet_csv(tweets, args.output_file)
+    format = args.format
+    if not format:
+        _, ext = os.path.splitext(args.output_file)
+        if ext not in ('.csv', '.parquet'):
+            log.error('could not guess file format from extension')
+            return 1
+        format = ext[1:]
+    if format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            log.error('writing parquet files requires pyarrow to be installed')
+            return 1
+
+    try:
+        columns = [Column.parse(spec) for spec in args.columns or DEFAULT_COLUMNS]
+    except ValueError as ex:
+        log.error(str(ex))
+        return 1
+
+    num_rows = convert_files(
+        args.input_files,
+        args.output_file,
+        columns=columns,
+        format=format,
+        jobs=args.jobs,
+        chunk_size=args.chunk_size,
+        dict_paths=tuple(args.dict or ()),
+    )
+    log.info(f'wrote {num_rows} rows to path={args.output_file}')
 
 if __name__ == '__main__':
     sys.exit(main() or 0)